@@ -1,16 +1,29 @@
 import time
-from multiprocessing import Value, Lock
+import os
+import ctypes
+import errno
+import weakref
+import signal
+import sys
+from multiprocessing import Value, Lock, Process, RawArray, RawValue
 import threading
 from flask import Flask
+from eventserver import EventLoopServer
+
+
+def exit_on_sigterm(signum, frame):
+    """ Turn SIGTERM into a normal exit, so finally blocks run on the way out.
+    """
+    sys.exit(0)
 
 
 class CustomFlask(Flask):
     """ Essentially just a Flask server, but with a few extra methods for shutting down.
     """
 
-    def __init__(self, name, client_conns_dict, final_wait, log, first_request,
+    def __init__(self, name, client_table, final_wait, log, first_request,
                  shutdown_event, is_shutdown_event):
-        self.CC = client_conns_dict
+        self.CC = client_table
         self.final_wait = final_wait
         self.log = log
         self.first_request = first_request
@@ -18,16 +31,79 @@ class CustomFlask(Flask):
         self.is_shutdown_event = is_shutdown_event
         super(CustomFlask, self).__init__(name)
 
-    def run_with_monitors(self, port=5000):
-        """ Run the normal "Flask.run" command, but also kick off a monitor thread.
+    def run_with_monitors(self, port=5000, backend="flask", routes=None, workers=1, on_exit=None,
+                          **server_options):
+        """ Run the normal "Flask.run" command (or the event loop server), but also kick off a monitor
+        thread.
         :param int port: which port to run the server on.
+        :param str backend: "flask" for Flask's own server, "eventloop" for eventserver.EventLoopServer
+        :param dict routes: path -> handler, for the event loop server since it doesn't use Flask routing
+        :param int workers: how many event loop server processes to run on the port
+        :param function on_exit: called on the way out of every server process, even when it gets
+        terminated, to finish writing anything that's still queued
+        :param server_options: passed along to EventLoopServer (max_connections, idle_timeout, max_body,
+        max_outbuf, max_in_flight, retry_after)
         """
         monitor = threading.Thread(target=self.active_client_monitor)
         monitor.start()
 
-        # flask says this isn't safe for deployment.
-        # If you are running this, is it deployment, or employment?
-        self.run(port=port)
+        # the shutdown monitor stops us with terminate()
+        signal.signal(signal.SIGTERM, exit_on_sigterm)
+        try:
+            if backend == "eventloop":
+                server = EventLoopServer(routes, self.log, **server_options)
+                if workers > 1:
+                    self.run_workers(server, port, workers, on_exit)
+                else:
+                    server.serve_forever(port=port)
+            else:
+                if workers > 1:
+                    self.log.warning("Only the eventloop backend can run multiple workers. Running one.")
+
+                # flask says this isn't safe for deployment.
+                # If you are running this, is it deployment, or employment?
+                self.run(port=port)
+        finally:
+            if on_exit:
+                on_exit()
+
+    def run_worker(self, server, sock, on_exit=None):
+        """ What each worker process runs: serve requests until it gets terminated.
+        :param eventserver.EventLoopServer server: the server to run
+        :param socket.socket sock: the listening socket, opened before the workers were forked
+        :param function on_exit: called on the way out, like in run_with_monitors
+        """
+        signal.signal(signal.SIGTERM, exit_on_sigterm)
+        try:
+            server.serve_forever(sock=sock)
+        finally:
+            if on_exit:
+                on_exit()
+
+    def run_workers(self, server, port, workers, on_exit=None):
+        """ Open the port, then fork worker processes which all accept connections on it. This process
+        stays behind to run the monitors, and takes the workers down with it when it gets terminated.
+        :param eventserver.EventLoopServer server: the server each worker runs
+        :param int port: which port to run the server on
+        :param int workers: how many workers to start
+        :param function on_exit: called on the way out of each worker
+        """
+        sock = server.listen(port)
+        procs = [Process(target=self.run_worker, args=(server, sock, on_exit)) for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+        self.log.warning("Started {} server workers.".format(workers))
+
+        def stop_workers(signum, frame):
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.join()
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, stop_workers)
+        for proc in procs:
+            proc.join()
 
     def active_client_monitor(self):
         """ If there are active clients, just sleep and start over; if not, enter shutdown timer.
@@ -57,16 +133,12 @@ class CustomFlask(Flask):
             return
 
     def check_active_clients(self):
-        """ Look at the Client Connections request dictionary and see if the clients are listed as active
+        """ Ask the client table how many clients are active. It keeps count as clients say hello,
+        say goodbye or time out, so this doesn't have to look at every client.
         """
-        self.log.debug("Checking active clients!")
-        for key, val in self.CC.items():
-            self.log.debug("Found client {} with active val {}".format(val.name, val.active))
-            if val.active:
-                self.log.debug("Active client found.")
-                return True
-        self.log.debug("No active client found.")
-        return False
+        active = self.CC.active_count()
+        self.log.debug("Checking active clients! Found {}.".format(active))
+        return active > 0
 
     def shutdown_monitor(self, servproc):
         """ Check if the shutdown Event has been set; if so, terminate the given process.
@@ -115,14 +187,146 @@ class Counter(object):
         self.val = Value('i', init_val)
         self.lock = Lock()
 
-    def increment(self):
-        """ Acquire lock, increment by one
+    def increment(self, amount=1):
+        """ Acquire lock, increment by one (or by however many you ask for)
         """
         with self.lock:
-            self.val.value += 1
+            self.val.value += amount
 
     def value(self):
         """ Acquire lock, return value
         """
         with self.lock:
             return self.val.value
+
+
+def pid_alive(pid):
+    """ Whether there's still a process with this pid.
+    :param int pid: the process
+    :return bool: True if it's there (even if it isn't ours to signal)
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class ShardLease(object):
+    """ Gives a thread's shard back to its ShardedCounter when the thread finishes. It lives in the
+    thread's locals, which go when the thread does. It only holds a weak reference to the counter, since
+    the counter holds the locals and a cycle with a __del__ in it would never be collected.
+    """
+    def __init__(self, counter, shard):
+        self.counter = weakref.ref(counter)
+        self.shard = shard
+
+    def __del__(self, getpid=os.getpid):
+        # getpid is bound up front, since this can run at exit after the os module has been torn down
+        counter = self.counter()
+        if counter is not None:
+            counter._release(self.shard, getpid())
+
+
+class ShardedCounter(object):
+    """ Just like Counter, but without taking a lock on every increment.
+
+    Each thread in each process gets its own 64 bit shard in shared memory, and only ever adds to that
+    one, so nobody else is writing it. value() adds all the shards up. The lock is only taken the
+    first time a thread increments, to claim a shard. If there are more threads than shards, the
+    latecomers share shard 0 and go back to taking the lock.
+
+    Shards get handed out again once their thread is done with them: when a thread finishes, its shard
+    is added into shard 0 and freed. A process that exits doesn't get to clean up after its threads, so
+    the shards of processes that are gone are taken back the same way, the next time there isn't a free
+    one. So it's only more threads than shards at once that have to share.
+
+    A shard can hold more than one number (size), which is handy for things like histogram buckets.
+    """
+    def __init__(self, init_val=0, shards=64, size=1):
+        self.size = size
+        self.num_shards = shards
+        self.shards = RawArray(ctypes.c_int64, shards * size)
+        self.shards[0] = init_val
+        # which process has each shard, or 0 if it's free. shard 0 is the shared, locked one
+        self.owners = RawArray(ctypes.c_int, shards)
+        self.lock = Lock()
+        self.local = threading.local()
+
+    def _shard(self):
+        """ Find (or claim) this thread's shard.
+        :return int: the shard index, 0 if we have to share
+        """
+        # a forked process inherits its parent's thread locals, so make sure this one is really ours
+        if getattr(self.local, 'pid', None) != os.getpid():
+            with self.lock:
+                index = self._claim()
+                if index:
+                    self.owners[index] = os.getpid()
+            self.local.shard = index
+            self.local.pid = os.getpid()
+            self.local.lease = ShardLease(self, index) if index else None
+        return self.local.shard
+
+    def _claim(self):
+        """ Find a free shard, taking one back from a process that's gone if we have to. Only call this
+        with the lock held.
+        :return int: the shard index, 0 if there isn't one
+        """
+        for index in range(1, self.num_shards):
+            if not self.owners[index]:
+                return index
+        for index in range(1, self.num_shards):
+            if not pid_alive(self.owners[index]):
+                self._fold(index)
+                return index
+        return 0
+
+    def _fold(self, index):
+        """ Add a shard into shard 0 and free it. Only call this with the lock held, once nothing is
+        adding to the shard any more.
+        :param int index: the shard
+        """
+        start = index * self.size
+        for i in range(self.size):
+            self.shards[i] += self.shards[start + i]
+            self.shards[start + i] = 0
+        self.owners[index] = 0
+
+    def _release(self, index, pid):
+        """ Give back a shard a process is done with.
+        :param int index: the shard
+        :param int pid: the process giving it back
+        """
+        with self.lock:
+            # a lease a forked child inherited is for its parent's shard, which isn't the child's to give
+            if self.owners[index] == pid:
+                self._fold(index)
+
+    def increment(self, amount=1, index=0):
+        """ Add one (or however many you ask for) to this thread's shard
+        :param int amount: how much to add
+        :param int index: which of the shard's numbers to add to, if it holds more than one
+        """
+        shard = self._shard()
+        if shard:
+            self.shards[shard * self.size + index] += amount
+        else:
+            with self.lock:
+                self.shards[index] += amount
+
+    def value(self, index=0):
+        """ Add up all the shards. Under the lock, so we don't catch a shard halfway through being folded
+        into shard 0 and count it twice (or not at all).
+        :param int index: which of the shard's numbers to add up
+        """
+        with self.lock:
+            return sum(self.shards[index::self.size])
+
+    def values(self):
+        """ Add up all the shards, for every number they hold
+        :return list: one total per number
+        """
+        with self.lock:
+            everything = self.shards[:]
+        return [sum(everything[i::self.size]) for i in range(self.size)]
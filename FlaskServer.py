@@ -4,46 +4,117 @@ import json
 import time
 import threading
 from multiprocessing import Process, Event
-from CustomFlask import CustomFlask, Counter
+from CustomFlask import CustomFlask, ShardedCounter
+from liveness import LivenessScheduler
+from datasink import DataSink
+from clientstate import ClientTable, SharedClient
+import journal
+import procinfo
+import wire
+import asynclog
+from timeseries import TimeSeriesStore, FIELDS as SERIES_FIELDS, aggregate
+from metrics import Histogram, LATENCY_BUCKETS, IO_BUCKETS, bucket_counts, histogram_percentile, \
+    format_metric, format_histogram
 
 # TODO: Unit tests
 # TODO: make sure the clients' name is printed in the log
 # TODO: Print a report after shutdown
 
-log = logging.getLogger('server_app')
-log.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-fh = logging.FileHandler('server.log', mode='w')
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-log.addHandler(fh)
-
-ch = logging.StreamHandler()
-
-# you can turn this down, or off, since everything is in the log. I like to see updates on the console.
-ch.setLevel(logging.WARNING)
-ch.setFormatter(formatter)
-log.addHandler(ch)
-
 # These are configurable in the json file
 with open("FlaskServer_config.json", 'r') as c:
     config = json.load(c)
 
+# everything goes to server.log, on a writer thread so requests don't wait on the disk.
+# you can turn the console down, or off, since everything is in the log. I like to see updates on the console.
+# log_every and log_per_second thin out the chatty kinds of message: heartbeat, data, io and rejected
+log = asynclog.setup('server_app', 'server.log', console_level=logging.WARNING,
+                     every=config.get("log_every"), per_second=config.get("log_per_second"))
+
 TIMEOUT = config["timeout"]
+# how often we ask clients to send a heartbeat (or anything else) at the least. null means a quarter of
+# the timeout, so a few of them can go missing before a client times out
+HEARTBEAT_INTERVAL = config.get("heartbeat_interval") or TIMEOUT / 4.0
 PORT = config["port"]
 FINAL_WAIT = config["final_wait"]
+# "flask" uses Flask's development server; "eventloop" uses the one in eventserver.py
+BACKEND = config.get("backend", "flask")
+MAX_CONNECTIONS = config.get("max_connections", 10000)
+IDLE_TIMEOUT = config.get("idle_timeout", 60)
+MAX_BODY = config.get("max_body", 1048576)
+MAX_OUTBUF = config.get("max_outbuf", 262144)
+# how much work we take on before turning requests away with a 429 or 503, and how long we tell the
+# clients to wait before trying again. max_in_flight is per pass of the event loop, so eventloop only
+MAX_IN_FLIGHT = config.get("max_in_flight", 256)
+MAX_PENDING_BYTES = config.get("max_pending_bytes", 8388608)
+RETRY_AFTER = config.get("retry_after", 1)
+# more than one worker needs the eventloop backend, since the workers share its listening socket
+WORKERS = config.get("workers", 1)
+MAX_CLIENTS = config.get("max_clients", 10000)
+MAX_OPEN_FILES = config.get("max_open_files", 64)
+FLUSH_INTERVAL = config.get("data_flush_interval", 1.0)
+FLUSH_BYTES = config.get("data_flush_bytes", 65536)
+# .data files get closed off into gzipped segments once they're this big or this old. 0 turns either
+# off, and a compress level of 0 leaves the segments uncompressed
+ROTATE_BYTES = config.get("data_rotate_bytes", 67108864)
+ROTATE_SECONDS = config.get("data_rotate_seconds", 3600)
+COMPRESS_LEVEL = config.get("data_compress_level", 6)
+# recent process info points kept in memory for each client, and how often older ones get saved
+SERIES_DEPTH = config.get("series_depth", 64)
+COMPACT_INTERVAL = config.get("compact_interval", 10)
+# the journal lets a server that crashed pick its clients back up. null journal_dir turns it off
+JOURNAL_DIR = config.get("journal_dir", "journal")
+SNAPSHOT_INTERVAL = config.get("snapshot_interval", 10)
+WATERMARK_INTERVAL = config.get("watermark_interval", 1)
+JOURNAL_FSYNC = config.get("journal_fsync", False)
+# every server process can see every client through this, no matter which worker it talked to
+client_table = ClientTable(MAX_CLIENTS)
+# hellos, goodbyes and timeouts go in here, and the whole table gets saved every so often
+state_journal = journal.Journal(JOURNAL_DIR, client_table, fsync=JOURNAL_FSYNC)
+# and each process keeps its own ClientManagers for the clients it has talked to
 CCs = {}
+# every client's recent process info, for /series
+series = TimeSeriesStore(MAX_CLIENTS, SERIES_DEPTH)
 
 first_request = Event()
 shutdown = Event()
 is_shutdown = Event()
-report = {"total_requests": Counter(0),
-          "total_connections": Counter(0),
-          "total_timeouts": Counter(0),
-          "total_goodbyes": Counter(0)}
+report = {"total_requests": ShardedCounter(0),
+          "total_connections": ShardedCounter(0),
+          "total_timeouts": ShardedCounter(0),
+          "total_goodbyes": ShardedCounter(0),
+          "total_batched": ShardedCounter(0),
+          "total_rejected": ShardedCounter(0)}
+
+# live numbers for /metrics. Signals other than 0, 1 and 2 all get counted as "other"
+SIGNAL_LABELS = ("0", "1", "2", "other")
+signal_requests = ShardedCounter(0, size=len(SIGNAL_LABELS))
+handler_seconds = [Histogram() for _ in SIGNAL_LABELS]
+parse_seconds = Histogram()
+LAG_BUCKETS = (1, 2, 5, 10, 15, 30, 60, 120, 300)
+
+# what the clients tell us about their disk writes (signal 3), across the whole fleet
+io_write_seconds = Histogram(IO_BUCKETS)
+io_rollover_seconds = Histogram(IO_BUCKETS)
+
+
+def time_out(client):
+    """ Called by the liveness scheduler to mark a client as failed, and count and journal it.
+    :param ClientManager client: the client which timed out
+    :return bool: whether it was still active (a goodbye could have beaten us to it)
+    """
+    return state_journal.deactivate(client, journal.TIMEOUT, time.time(), report["total_timeouts"])
+
+
+# one thread watches every client's heartbeats, rather than one thread per client. clients are only
+# meant to be quiet for HEARTBEAT_INTERVAL, so that's when we start to worry about them
+liveness = LivenessScheduler(TIMEOUT, log, step=HEARTBEAT_INTERVAL, deactivate=time_out)
 
-app = CustomFlask(__name__, CCs, FINAL_WAIT, log, first_request, shutdown, is_shutdown)
+# and one thread writes every client's data file
+data_sink = DataSink(log, max_open_files=MAX_OPEN_FILES, flush_interval=FLUSH_INTERVAL,
+                     flush_bytes=FLUSH_BYTES, rotate=(".data",), rotate_bytes=ROTATE_BYTES,
+                     rotate_seconds=ROTATE_SECONDS, compress_level=COMPRESS_LEVEL)
+
+app = CustomFlask(__name__, client_table, FINAL_WAIT, log, first_request, shutdown, is_shutdown)
 app.debug = False
 app.use_reloader=False
 
@@ -58,7 +129,60 @@ def print_report(is_shutdown_event):
     report_to_print = {}
     for key, val in report.items():
         report_to_print[key] = val.value()
+    report_to_print["active_clients"] = client_table.active_count()
     log.warning("Usage report: {}".format(report_to_print))
+    log.warning("I/O report: {}".format(io_report()))
+    # that was a clean finish, so there's nothing to pick back up next time
+    state_journal.clear()
+
+
+def io_report():
+    """ Add up the disk write stats every client sent us into one report for the whole fleet.
+    :return dict: throughput, write latency and rollover numbers (empty if nobody wrote anything)
+    """
+    counts, write_seconds = io_write_seconds.snapshot()
+    writes = sum(counts)
+    if not writes:
+        return {}
+    clients = [client.slot for name, client in client_table.items() if client.slot.io_seconds]
+    client_rates = [slot.io_bytes / slot.io_seconds / 1e6 for slot in clients]
+    rollover_counts, rollover_seconds = io_rollover_seconds.snapshot()
+    rollovers = sum(rollover_counts)
+    return {"writes": writes,
+            "total_mb": sum(slot.io_bytes for slot in clients) / 1e6,
+            "aggregate_mb_per_s": sum(client_rates),
+            "client_mb_per_s_min": min(client_rates),
+            "client_mb_per_s_mean": sum(client_rates) / len(client_rates),
+            "client_mb_per_s_max": max(client_rates),
+            "write_s_mean": write_seconds / writes,
+            "write_s_p50": histogram_percentile(IO_BUCKETS, counts, 50),
+            "write_s_p99": histogram_percentile(IO_BUCKETS, counts, 99),
+            "rollovers": rollovers,
+            "rollover_s_mean": rollover_seconds / rollovers if rollovers else None,
+            "rollover_s_p99": histogram_percentile(IO_BUCKETS, rollover_counts, 99)}
+
+
+# what kind of message each of the per-request log lines is, for log_every and log_per_second
+HEARTBEAT = {"kind": "heartbeat"}
+DATA = {"kind": "data"}
+IO = {"kind": "io"}
+# there can be a lot of these when we're overloaded, and they're counted in /metrics anyway
+REJECTED = {"kind": "rejected"}
+
+# what we tell clients about heartbeats, in every response to the requests they send
+HEARTBEAT_HEADERS = {wire.HEARTBEAT_TIMEOUT: str(TIMEOUT), wire.HEARTBEAT_INTERVAL: str(HEARTBEAT_INTERVAL)}
+
+
+def to_message(request_data):
+    """ Check a request has all four fields, each of the right type, and pull them out.
+    :param dict request_data: dictionary from JSON request
+    :return wire.Message: the request's fields, or None if it was bad
+    """
+    try:
+        return wire.validate(request_data)
+    except wire.BadRequest as e:
+        log.warning("A bad request was received! Request will be discarded. Reason: {}".format(e))
+        log.debug("The bad request was: %r", request_data)
 
 
 def assert_request_format(request_data):
@@ -66,59 +190,126 @@ def assert_request_format(request_data):
     :param dict request_data: dictionary from JSON request
     :return bool: whether the request has the proper format or not
     """
-    if "name" and "time" and "signal" and "data" in request_data.keys():
-        return True
-    else:
-        log.warning("A bad request was received! Request will be discarded. Request: {}"
-                    .format(request_data))
-        return False
+    return to_message(request_data) is not None
 
 
 def map_requests(request_data, client_conns_dict):
     """ Do the correct thing with a request given its data and signal
-    :param dict request_data: dictionary from JSON request
+    :param request_data: dictionary from JSON request, or a wire.Message that's already been checked
     :param client_conns_dict: the dictionary of client connections
-    :return: None
+    :return wire.Message: the request's fields, or None if it was bad
     """
-    good_request = assert_request_format(request_data)
-    if not good_request:
-        return
+    if isinstance(request_data, wire.Message):
+        message = request_data
+    else:
+        message = to_message(request_data)
+        if message is None:
+            return
+    name, signal, sent, data = message
 
-    if request_data["name"] not in client_conns_dict.keys():
+    client = client_conns_dict.get(name)
+    if client is None:
 
         # is it weird to store objects in a dictionary?
         # I dunno, I feel like this made everything less readable
         # Something about this whole thing is weird, but it works? Can we talk about it??
-        client_conns_dict[request_data["name"]] = ClientManager(request_data["name"])
-        client = client_conns_dict[request_data["name"]]
-        report["total_connections"].increment()
-    else:
-        client = client_conns_dict[request_data["name"]]
-    if request_data["signal"] == 1:
-
-        client.current_data = request_data["data"]
-        log.info("Client {} sent some data: {}".format(request_data["name"],
-                                                       request_data["data"]))
-    if request_data["signal"] == 2:
+        shared, created = state_journal.hello(name, time.time(), report["total_connections"])
+        if shared is None:
+            log.warning("There is no room for client {}! Request will be discarded.".format(name))
+            return message
+        # another worker might have seen this client first, in which case it already counted it
+        client = client_conns_dict[name] = ClientManager(name, shared.slot, client_table, created)
+
+    # anything a client sends shows it's still alive, so it all counts as a heartbeat.
+    # we don't need to keep looking for heartbeats if we received a goodbye
+    active = client.active
+    if active and sent > client.current_heartbeat:
+        client.current_heartbeat = sent
+
+    # heartbeats are most of what we get, so they go first
+    if signal == 0:
+        if active:
+            log.info("Client %s sent a heartbeat at time %s", name, sent, extra=HEARTBEAT)
+
+    elif signal == 1:
+        client.write_data(data)
+        log.info("Client %s sent some data: %s", name, data, extra=DATA)
+
+    elif signal == 2:
         # this isn't really a warning, but it makes it pop up on the console
-        log.warning("Client {} says {}".format(request_data["name"],
-                                               request_data["data"]))
+        log.warning("Client {} says {}".format(name, data))
 
         # Set the client to inactive, since it told us so politely
-        if request_data["data"] == "Goodbye.":
-            client.active = False
-            report["total_goodbyes"].increment()
+        if data == "Goodbye.":
+            state_journal.deactivate(client, journal.GOODBYE, time.time(), report["total_goodbyes"])
 
-    if request_data["signal"] == 0 and client.active:
-        # we don't need to keep looking for heartbeats if we received a goodbye
-        client.current_heartbeat = request_data["time"]
-        log.info("Client {} sent a heartbeat at time {}".format(request_data["name"],
-                                                                request_data["time"]))
+    elif signal == 3:
+        client.record_io(data)
+        log.info("Client %s sent I/O stats: %s", name, data, extra=IO)
 
+    return message
 
-@app.route("/", methods=['POST', 'GET'])
-def request_handler():
-    """ Function for handling the requests that are sent to the server.
+
+def admit(batch):
+    """ Check a batch against our limits before any of it gets applied, so a client we turn away can
+    send the whole thing again later without any of it happening twice.
+    :param list batch: the requests, from parse_batch
+    :return: a response turning the batch away, or None if it can go ahead
+    """
+    new_clients = set()
+    data_bytes = {}
+    for request_data in batch:
+        if isinstance(request_data, wire.Message):
+            name, signal, data = request_data.name, request_data.signal, request_data.data
+        elif isinstance(request_data, dict):
+            name, signal, data = [request_data.get(key) for key in ("name", "signal", "data")]
+        else:
+            # map_requests will complain about it
+            continue
+        if not isinstance(name, basestring):
+            continue
+        if name not in CCs:
+            new_clients.add(name)
+        if signal == 1 and isinstance(data, basestring):
+            data_bytes[name] = data_bytes.get(name, 0) + len(data)
+
+    # clients we haven't seen might still be in the table, if another server process took them. only
+    # look when it matters, since looking for a name that isn't there means looking at every slot
+    room = client_table.capacity - len(client_table)
+    if len(new_clients) > room:
+        new_clients = [name for name in new_clients if client_table.get(name) is None]
+        if len(new_clients) > room:
+            report["total_rejected"].increment()
+            log.info("No room for %s new clients! Turning a request away.", len(new_clients), extra=REJECTED)
+            return "Too many clients", 503, {"Retry-After": str(RETRY_AFTER)}
+
+    for name, size in data_bytes.items():
+        client = CCs.get(name)
+        if client is None:
+            continue
+        if data_sink.backlog(client.datafile, client.procfile, client.windowfile) + size > MAX_PENDING_BYTES:
+            report["total_rejected"].increment()
+            log.info("Client %s has too much data waiting to be written! Turning a request away.", name,
+                     extra=REJECTED)
+            return "Too much data pending", 429, {"Retry-After": str(RETRY_AFTER)}
+
+
+def apply_request(request_data):
+    """ Run map_requests on a request, and record how long it took under the request's signal.
+    :param request_data: dictionary from JSON request, or a wire.Message
+    :return: None
+    """
+    start = time.time()
+    message = map_requests(request_data, CCs)
+    index = message.signal if message is not None and message.signal in (0, 1, 2) else 3
+    signal_requests.increment(1, index)
+    handler_seconds[index].observe(time.time() - start)
+
+
+def handle_request(req):
+    """ Function for handling the requests that are sent to the server. Both server backends call this,
+    so it only needs the request's .data
+    :param req: the request (flask.request, or an eventserver.Request)
     :return: Sets what to display on the browser at our server's port. This doesn't matter.
     """
     # ideally there would be a way to avoid setting this every time there's a new request
@@ -129,96 +320,331 @@ def request_handler():
 
     # if the request had zero length, it's probably the client code making sure the server is up.
     # Or it's someone refreshing the browser page. Stop that, it tickles!
-    if len(request.data) == 0:
+    if len(req.data) == 0:
         log.info("Received a zero length request. Nothing to do here.")
         return "Hi"
 
-    # if we sent a nonzero request, it should be in json format
+    # if we sent a nonzero request, it should be JSON, or binary frames if the Content-Type says so
+    start = time.time()
     try:
-        request_data = json.loads(request.data)
+        batch = parse_batch(req.data, req.headers.get('Content-Type'))
     except ValueError as e:
         log.error("A malformed request was received! error: {}".format(e))
-        raise
+        return "Malformed request", 400
+    parse_seconds.observe(time.time() - start)
+
+    turned_away = admit(batch)
+    if turned_away:
+        return turned_away
 
-    # go confirm that the request was correctly formatted, and then do stuff with it
-    map_requests(request_data, CCs)
+    # go confirm that each request was correctly formatted, and then do stuff with it
+    for request_data in batch:
+        apply_request(request_data)
 
     # it must return :/ if I understood Flask and requests better I could make this make more sense.
-    return "Hello"
+    # the headers are how a client saying hello finds out how often to send heartbeats
+    return "Hello", 200, HEARTBEAT_HEADERS
 
 
-class ClientManager(object):
-    """ Class for keeping track of whether a client is alive, and writing data streams
+def parse_batch(body, content_type=None):
+    """ Turn the body of a batch request into a list of requests.
+    The body can either be a JSON array of requests, newline-delimited JSON with one request per line,
+    or binary frames (see wire.py) if the Content-Type says so.
+    :param str body: the raw request body
+    :param str content_type: the request's Content-Type
+    :return list: the requests, in the order they were sent
     """
+    return wire.parse(body, content_type)
 
-    def __init__(self, name):
-        self.name = name
-        # treat the initialization as the first heartbeat
-        self.current_heartbeat = time.time()
-        self.current_data = 0
-        # how do we make sure we're not writing the same data twice?
-        self.previous_data = 0
-        self.datafile = "{}.data".format(self.name)
 
-        with open(self.datafile, 'a+') as datalog:
-            datalog.write("This is the data file for client: {} \n".format(self.name))
+def handle_batch(req):
+    """ Function for handling a batch of requests sent all at once, so a client can send lots of
+    heartbeats and data without paying for a request each.
+    :param req: the request (flask.request, or an eventserver.Request)
+    :return: How many requests were in the batch.
+    """
+    if not first_request.is_set():
+        first_request.set()
+    report["total_requests"].increment()
+
+    start = time.time()
+    try:
+        batch = parse_batch(req.data, req.headers.get('Content-Type'))
+    except ValueError as e:
+        log.error("A malformed batch was received! error: {}".format(e))
+        return "Malformed batch", 400
+    parse_seconds.observe(time.time() - start)
+
+    turned_away = admit(batch)
+    if turned_away:
+        return turned_away
+
+    for request_data in batch:
+        apply_request(request_data)
+    report["total_batched"].increment(len(batch))
+
+    return str(len(batch)), 200, HEARTBEAT_HEADERS
+
+
+def handle_metrics(req):
+    """ Function for showing live server numbers in the Prometheus text format.
+    :param req: the request (flask.request, or an eventserver.Request)
+    :return: the metrics, as plain text
+    """
+    now = time.time()
+    clients = [client for name, client in client_table.items()]
+    lags = [now - client.current_heartbeat for client in clients if client.active]
+    lag_counts, lag_sum = bucket_counts(lags, LAG_BUCKETS)
+
+    lines = []
+    lines += format_metric("server_requests_total", "counter", "HTTP requests received.",
+                           [({}, report["total_requests"].value())])
+    lines += format_metric("server_signals_total", "counter", "Client requests handled, by signal.",
+                           zip([{"signal": label} for label in SIGNAL_LABELS], signal_requests.values()))
+    lines += format_histogram("server_handler_seconds", "Time spent in map_requests, by signal.",
+                              LATENCY_BUCKETS,
+                              [({"signal": label},) + histogram.snapshot()
+                               for label, histogram in zip(SIGNAL_LABELS, handler_seconds)])
+    lines += format_histogram("server_json_parse_seconds", "Time spent parsing request bodies.",
+                              LATENCY_BUCKETS, [({},) + parse_seconds.snapshot()])
+    lines += format_metric("server_rejected_requests_total", "counter",
+                           "Requests turned away for too many clients or too much pending data.",
+                           [({}, report["total_rejected"].value())])
+    lines += format_metric("server_active_clients", "gauge", "Clients which are still active.",
+                           [({}, client_table.active_count())])
+    lines += format_metric("server_failed_clients", "gauge", "Clients marked as failed for no heartbeat.",
+                           [({}, report["total_timeouts"].value())])
+    lines += format_metric("server_data_bytes_written", "counter",
+                           "Bytes written for each client: data file lines, and process info records "
+                           "in its .proc and .window files.",
+                           [({"client": client.name}, client.slot.data_bytes) for client in clients])
+    lines += format_histogram("server_client_write_seconds", "How long clients took to write a chunk.",
+                              IO_BUCKETS, [({},) + io_write_seconds.snapshot()])
+    lines += format_histogram("server_client_rollover_seconds",
+                              "How long clients took to roll over to a new data file.",
+                              IO_BUCKETS, [({},) + io_rollover_seconds.snapshot()])
+    lines += format_histogram("server_heartbeat_lag_seconds",
+                              "Seconds since each active client's last heartbeat.",
+                              LAG_BUCKETS, [({}, lag_counts, lag_sum)])
+    return u"\n".join(lines) + u"\n", 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+def handle_series(req):
+    """ Function for looking at a client's process info while it runs.
+    ?client=name&last=N gets its last N points (all we have in memory if there's no N), and
+    ?client=name&start=T&end=T gets min/max/mean over that time range, reading from disk if need be.
+    :param req: the request (flask.request, or an eventserver.Request)
+    :return: the points or the summary, as JSON
+    """
+    name = req.args.get("client")
+    if not name:
+        return "Which client? Use ?client=name", 400
+    client = client_table.get(name)
+    if client is None:
+        return "No client named {}".format(name), 404
+    index = client_table.index_of(client.slot)
+
+    try:
+        last = req.args.get("last")
+        start = req.args.get("start")
+        end = req.args.get("end")
+        last = int(last) if last is not None else None
+        start = float(start) if start is not None else None
+        end = float(end) if end is not None else None
+    except ValueError as e:
+        return "Bad query: {}".format(e), 400
+
+    result = {"client": name, "fields": SERIES_FIELDS}
+    if start is None and end is None:
+        result["points"] = series.recent(index, last)
+    else:
+        result["summary"] = aggregate(series.query(index, "{}.ts".format(name), start, end))
+    return json.dumps(result), 200, {"Content-Type": "application/json"}
+
+
+def compact_series():
+    """ Every so often, save the points that have built up in memory to each client's .ts file.
+    """
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        clients = [(client_table.index_of(client.slot), "{}.ts".format(name))
+                   for name, client in client_table.items()]
+        saved = series.compact(clients, data_sink, log)
+        log.debug("Saved {} process info points to disk.".format(saved))
+
 
-        # When we initialize, the client is active
-        self.active = True
+def save_state():
+    """ Write a watermark to the journal every so often, so we know when we went down if we crash, and
+    snapshot the client table every so often, so there's not much journal to replay.
+    """
+    last_snapshot = time.time()
+    while True:
+        time.sleep(WATERMARK_INTERVAL)
+        now = time.time()
+        state_journal.record(journal.WATERMARK, "", now)
+        if now - last_snapshot >= SNAPSHOT_INTERVAL:
+            saved = state_journal.snapshot(report)
+            log.debug("Saved {} clients to a snapshot in {:.3f} seconds.".format(saved, time.time() - now))
+            last_snapshot = now
+
+
+def timed(handler):
+    """ Wrap a handler so its response says how long handling it took, in the wire.PROCESSING_TIME
+    header. Clients take that away from their round trip time to get the time spent on the network.
+    :param handler: a handler, which takes a request and returns what a Flask view would
+    :return: the wrapped handler, which always returns (body, status, headers)
+    """
+    def timed_handler(req):
+        start = time.time()
+        result = handler(req)
+        body, status, headers = result, 200, {}
+        if isinstance(result, tuple):
+            if len(result) == 3:
+                body, status, headers = result
+            else:
+                body, status = result
+        headers = dict(headers)
+        headers[wire.PROCESSING_TIME] = "{:.6f}".format(time.time() - start)
+        return body, status, headers
+    return timed_handler
+
+
+# the event loop backend doesn't go through Flask's routing, so it looks up handlers here
+ROUTES = {"/": timed(handle_request),
+          "/batch": timed(handle_batch),
+          "/metrics": handle_metrics,
+          "/series": handle_series}
 
-        log.debug("Initializing client {}!".format(self.name))
-        t1 = threading.Thread(target=self.heartbeat_monitor)
-        t2 = threading.Thread(target=self.data_monitor)
-        t1.start()
-        t2.start()
 
-    def heartbeat_monitor(self):
-        """ After initialization, self.hearbeat will be the timestamp of the last heartbeat sent.
-        Monitor it to tell if the client has gone away.
+@app.route("/", methods=['POST', 'GET'])
+def request_handler():
+    return ROUTES["/"](request)
+
+
+@app.route("/batch", methods=['POST'])
+def batch_handler():
+    return ROUTES["/batch"](request)
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_handler():
+    return handle_metrics(request)
+
+
+@app.route("/series", methods=['GET'])
+def series_handler():
+    return handle_series(request)
+
+
+class ClientManager(SharedClient):
+    """ Class for keeping track of whether a client is alive, and writing data streams.
+    Whether it's active and when it last sent a heartbeat live in the shared client table.
+    """
+
+    def __init__(self, name, slot, table, created=True):
+        """
+        :param str name: the client's name
+        :param clientstate.ClientSlot slot: the client's slot in the client table
+        :param clientstate.ClientTable table: the client table
+        :param bool created: whether this is the first time any server process has seen the client
+        """
+        super(ClientManager, self).__init__(name, slot, table)
+        # the last data payload we received, in case anyone wants to look at it
+        self.current_data = 0
+        self.datafile = "{}.data".format(self.name)
+        # process info records go in their own files, as fixed size binary records. see procinfo.py
+        self.procfile = "{}.proc".format(self.name)
+        self.windowfile = "{}.window".format(self.name)
+
+        if created:
+            self.write_line("This is the data file for client: {} \n".format(self.name))
+            log.debug("Initializing client {}!".format(self.name))
+
+    def write_data(self, data):
+        """ Hand a data payload off to the data sink, which writes it to this client's file.
+        Every payload gets queued in the order it arrived, so none of them get skipped or doubled.
+        Process info records get appended to the .proc (or .window) file as they are; anything else is
+        a line in the .data file.
+        :param data: the data sent by the client
         :return: None
         """
-        elapsed = 10
-
-        # this is clunky... I can't do "while self.current_heartbeat != 0"
-        # because it *IS* 0 at some point
-        while True:
-            time.sleep(1)
-            if self.active:
-                now = time.time()
-                while abs(now - self.current_heartbeat) > elapsed:
-                    log.info("The client {} hasn't sent a heartbeat in over {} seconds."
-                             .format(self.name, elapsed))
-                    time.sleep(10)
-                    elapsed += 10
-
-                if abs(now - self.current_heartbeat) > TIMEOUT:
-                    log.warning("Client {}: No heartbeat received for {} seconds - marking as failed."
-                                .format(self.name, TIMEOUT))
-                    self.active = False
-                    report["total_timeouts"].increment()
-
-                    # can't recover after this, so we might as well exit this thread
-                    return
-
-
-    def data_monitor(self):
-        """ While the client is considered active, write the process info data to a file.
+        self.current_data = data
+        self.slot.last_data = time.time()
+        record = procinfo.decode(data)
+        if record:
+            self.write_record(record)
+        else:
+            # text from JSON is unicode, and can be anything
+            self.write_line((data.encode('utf-8') if isinstance(data, unicode) else data) + "\n")
+
+    def write_record(self, record):
+        """ Queue a process info record for this client's file for that kind of record, and count its bytes.
+        :param record: a procinfo.ProcRecord or procinfo.WindowRecord
+        """
+        packed = procinfo.pack(record)
+        self.slot.data_bytes += len(packed)
+        data_sink.write("{}.{}".format(self.name, procinfo.extension(record)), packed)
+        series.add(self.table.index_of(self.slot), record)
+
+    def record_io(self, stats):
+        """ Add a client's disk write stats to the fleet-wide numbers.
+        :param dict stats: bytes written, and the time each write and rollover took in microseconds
         :return: None
         """
-        # I know there is some "proper" way to pass information between threads.
-        # but I don't see why using a self parameter is wrong. I'd love to know.
-        while self.active:
-            if self.current_data != 0:
-                with open(self.datafile, 'a+') as datalog:
-                    datalog.write(str(self.current_data) + "\n")
-                self.previous_data = self.current_data
-                self.current_data = 0
+        try:
+            latencies = [us / 1e6 for us in stats["latencies_us"]]
+            rollovers = [us / 1e6 for us in stats.get("rollovers_us", [])]
+            written = int(stats["bytes"])
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            log.warning("Client {} sent I/O stats we can't read! error: {}".format(self.name, e))
+            return
+        for latency in latencies:
+            io_write_seconds.observe(latency)
+        for rollover in rollovers:
+            io_rollover_seconds.observe(rollover)
+        self.slot.io_bytes += written
+        self.slot.io_seconds += sum(latencies)
+
+    def write_line(self, line):
+        """ Queue a line for this client's data file, and count its bytes.
+        A client's data all comes from its one monitor process, one request at a time, so only one
+        server process is ever adding to data_bytes for it.
+        :param str line: what to write
+        """
+        self.slot.data_bytes += len(line)
+        data_sink.write(self.datafile, line)
+
+
+def run_server():
+    """ What the server process runs: pick up where the last server left off if it crashed, watch every
+    client's heartbeats, then start serving requests.
+    """
+    restored = state_journal.restore(report)
+    if restored.get("clients"):
+        log.warning("Picked up {clients} clients ({active} active) from the journal, after {replayed} "
+                    "records. We were down for {down_s:.1f} seconds.".format(**restored))
+    liveness.watch(client_table)
+    saver = threading.Thread(target=save_state)
+    saver.daemon = True
+    saver.start()
+    # forked workers don't get this thread, so only this process saves points
+    compactor = threading.Thread(target=compact_series)
+    compactor.daemon = True
+    compactor.start()
+    # a client's requests can go to any worker, so the workers hand what they write to this process
+    if BACKEND == "eventloop" and WORKERS > 1:
+        data_sink.share()
+    # and it writes out what's still queued before it goes
+    app.run_with_monitors(port=PORT, backend=BACKEND, routes=ROUTES, workers=WORKERS, on_exit=data_sink.close,
+                          max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                          max_body=MAX_BODY, max_outbuf=MAX_OUTBUF, max_in_flight=MAX_IN_FLIGHT,
+                          retry_after=RETRY_AFTER)
 
 
 if __name__ == "__main__":
     # Start up the server in a process, and then send that process to the shutdown monitors.
     # This way we can kill it.
-    server = Process(target=app.run_with_monitors, kwargs={'port': PORT})
+    server = Process(target=run_server)
     server.start()
     log.warning("Server started here.")
 
@@ -0,0 +1,207 @@
+""" Logging that doesn't make the thread doing the logging wait on the disk.
+
+Loggers set up here hand their records to a queue and a writer thread does the formatting and writing.
+Records can say what kind of message they are with extra={"kind": ...}, and the chatty kinds can be
+sampled (only 1 in every N gets logged) or capped at so many a second, before they go on the queue.
+Warnings and worse always get logged.
+
+Log with %s and arguments, like log.info("Client %s sent a heartbeat", name), rather than formatting the
+message yourself. That way the message only gets put together if the record makes it past the level,
+the sampling and the rate limit, and then it happens on the writer thread.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+import Queue
+from multiprocessing import util
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class SampleFilter(logging.Filter):
+    """ Lets 1 in every N records of a kind through, and at most M a second.
+    """
+
+    def __init__(self, every=None, per_second=None):
+        """
+        :param dict every: kind -> N, to only log every Nth record of that kind
+        :param dict per_second: kind -> M, to log at most M records of that kind each second
+        """
+        logging.Filter.__init__(self)
+        self.every = every or {}
+        self.per_second = per_second or {}
+        # next() on these is atomic, so threads can share them without a lock
+        self.counts = dict((kind, itertools.count()) for kind in self.every)
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        kind = getattr(record, "kind", None)
+        if kind is None or record.levelno >= logging.WARNING:
+            return True
+        if kind in self.counts and next(self.counts[kind]) % self.every[kind]:
+            return False
+        limit = self.per_second.get(kind)
+        if limit:
+            now = int(time.time())
+            with self.lock:
+                second, count = self.seconds.get(kind, (now, 0))
+                if second != now:
+                    second, count = now, 0
+                if count >= limit:
+                    return False
+                self.seconds[kind] = (second, count + 1)
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """ Puts records on a queue, and writes them to the real handlers on a writer thread.
+
+    Every process gets its own queue and writer, started the first time it logs, since threads
+    don't survive a fork. Whatever is still queued gets written out when the process exits.
+
+    A fork can happen while the parent's writer is in the middle of writing, which would leave the
+    child with a handler lock that nobody is ever going to release. So a new process makes new locks
+    for the handlers before its writer starts, and this handler doesn't have a lock at all (the queue
+    is thread safe on its own).
+    """
+
+    def __init__(self, handlers):
+        """
+        :param list handlers: the handlers which actually write records out
+        """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def createLock(self):
+        self.lock = None
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self._start()
+        self.queue.put(record)
+
+    def _start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            for handler in self.handlers:
+                handler.createLock()
+            self.queue = Queue.Queue()
+            self.thread = threading.Thread(target=self.run, args=(self.queue,))
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+            # this runs when the process exits, whether it's the main process or a multiprocessing one
+            util.Finalize(None, self.stop, exitpriority=1)
+
+    def run(self, queue):
+        """ Write records out until we get the stop marker.
+        """
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """ Write out everything queued so far, and stop this process's writer.
+        """
+        if self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.pid = None
+
+    def close(self):
+        self.stop()
+        logging.Handler.close(self)
+
+
+class PerClientHandler(logging.Handler):
+    """ Writes each client's records to a file of its own too. A client's records are the ones from its
+    own logger, which is a child of the main one: client_app.<name> for a client called <name>.
+    Files are appended to, since all of a client's processes write to the same one.
+    """
+
+    def __init__(self, prefix, pattern):
+        """
+        :param str prefix: the main logger's name followed by a dot
+        :param str pattern: the file name, with {} where the client's name goes
+        """
+        logging.Handler.__init__(self)
+        self.prefix = prefix
+        self.pattern = pattern
+        self.files = {}
+
+    def emit(self, record):
+        if not record.name.startswith(self.prefix):
+            return
+        name = record.name[len(self.prefix):]
+        handler = self.files.get(name)
+        if handler is None:
+            handler = logging.FileHandler(self.pattern.format(name), mode='a')
+            handler.setFormatter(self.formatter)
+            self.files[name] = handler
+        handler.emit(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        logging.Handler.close(self)
+
+
+def setup(name, path, console_level=logging.WARNING, every=None, per_second=None, per_client=None):
+    """ Set up a logger which writes everything to a file, and the important stuff to the console, on a
+    writer thread.
+    :param str name: the logger's name
+    :param str path: the log file, which gets started fresh
+    :param int console_level: the lowest level that also goes to the console
+    :param dict every: kind -> N, to only log every Nth record of that kind
+    :param dict per_second: kind -> M, to log at most M records of that kind each second
+    :param str per_client: if given, also log each client to its own file named like this, with {} for
+    the client's name
+    :return logging.Logger: the logger
+    """
+    formatter = logging.Formatter(FORMAT)
+
+    fh = logging.FileHandler(path, mode='w')
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(console_level)
+    ch.setFormatter(formatter)
+
+    log = logging.getLogger(name)
+    log.setLevel(logging.DEBUG)
+    log.addHandler(QueueHandler([fh, ch]))
+    configure(log, every, per_second, per_client)
+    return log
+
+
+def configure(log, every=None, per_second=None, per_client=None):
+    """ Change the sampling of a logger made by setup, and turn on per-client files. Do this before
+    forking, so every process gets the same settings.
+    :param logging.Logger log: the logger
+    :param dict every: kind -> N, to only log every Nth record of that kind
+    :param dict per_second: kind -> M, to log at most M records of that kind each second
+    :param str per_client: if given, also log each client to its own file named like this, with {} for
+    the client's name
+    """
+    for handler in log.handlers:
+        if not isinstance(handler, QueueHandler):
+            continue
+        handler.filters = [SampleFilter(every, per_second)]
+        if per_client and not any(isinstance(h, PerClientHandler) for h in handler.handlers):
+            pc = PerClientHandler(log.name + '.', per_client)
+            pc.setFormatter(logging.Formatter(FORMAT))
+            handler.handlers.append(pc)
@@ -0,0 +1,128 @@
+""" Micro-benchmarks for the hot paths in the server and the clients.
+Run with: python benchmarks.py
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from multiprocessing import Process
+
+from CustomFlask import Counter, ShardedCounter
+import requester
+import wire
+
+
+def hammer(counter, increments):
+    for _ in xrange(increments):
+        counter.increment()
+
+
+def bench_counter(counter_class, workers, increments, use_processes):
+    """ Time a bunch of processes (or threads) all incrementing the same counter at once.
+    :param class counter_class: Counter or ShardedCounter
+    :param int workers: how many processes or threads to run
+    :param int increments: how many times each one increments
+    :param bool use_processes: processes if True, threads if False
+    :return float: increments per second
+    """
+    counter = counter_class(0)
+    runner = Process if use_processes else threading.Thread
+    jobs = [runner(target=hammer, args=(counter, increments)) for _ in range(workers)]
+    start = time.time()
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    elapsed = time.time() - start
+    assert counter.value() == workers * increments
+    return workers * increments / elapsed
+
+
+def counter_benchmarks(workers=4, increments=100000):
+    """ Compare Counter and ShardedCounter under contention.
+    :return dict: increments per second for each counter, with processes and with threads
+    """
+    results = {}
+    for counter_class in (Counter, ShardedCounter):
+        for use_processes in (True, False):
+            key = "{} {}".format(counter_class.__name__, "processes" if use_processes else "threads")
+            results[key] = bench_counter(counter_class, workers, increments, use_processes)
+    return results
+
+
+def writer_benchmarks(chunk_size=1000000, writes=200, file_size=20000000):
+    """ Compare write_and_roll (reopen, stat and urandom every chunk) with DataWriter.
+    :return dict: megabytes per second for each
+    """
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        base = os.path.join(directory, 'old')
+        gen = requester.files_gen(base)
+        current = None
+        start = time.time()
+        for _ in xrange(writes):
+            current, rolling = requester.write_and_roll(current, base, chunk_size, file_size, gen)
+        results["write_and_roll"] = chunk_size * writes / (time.time() - start) / 1e6
+
+        writer = requester.DataWriter(os.path.join(directory, 'new'), chunk_size, file_size)
+        start = time.time()
+        for _ in xrange(writes):
+            writer.write()
+        writer.close()
+        results["DataWriter"] = chunk_size * writes / (time.time() - start) / 1e6
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def old_parse(body, clients):
+    """ What handle_request and map_requests used to do with a request before getting to the signal:
+    json.loads, the old format check, and looking the client up in a list of names.
+    """
+    request_data = json.loads(body)
+    if "name" and "time" and "signal" and "data" in request_data.keys():
+        if request_data["name"] not in clients.keys():
+            return
+        return clients[request_data["name"]]
+
+
+def new_parse(body, clients, content_type=None):
+    """ What they do now: wire.parse, checking every field, and one dict lookup.
+    """
+    for request_data in wire.parse(body, content_type):
+        message = request_data if isinstance(request_data, wire.Message) else wire.validate(request_data)
+        return clients.get(message.name)
+
+
+def parse_benchmarks(requests=100000, clients=1000):
+    """ Compare parsing and checking heartbeats the old way with the new way, in JSON and binary.
+    :return dict: requests per second for each
+    """
+    known = dict(("client{}".format(i), object()) for i in range(clients))
+    message = wire.Message(u"client{}".format(clients - 1), 0, time.time(), u"Heartbeat")
+    json_body = wire.dumps(message._asdict())
+    binary_body = wire.encode(message)
+
+    results = {}
+    for name, parse, body, extra in [("old json", old_parse, json_body, ()),
+                                     ("new json", new_parse, json_body, ()),
+                                     ("new binary", new_parse, binary_body, (wire.BINARY_TYPE,))]:
+        start = time.time()
+        for _ in xrange(requests):
+            assert parse(body, known, *extra) is not None
+        results[name] = requests / (time.time() - start)
+    if wire.fastjson is None:
+        results = dict(("{} (stdlib json)".format(key), value) for key, value in results.items())
+    return results
+
+
+if __name__ == "__main__":
+    for name, rate in sorted(counter_benchmarks().items()):
+        print "{:<28} {:>12,.0f} increments/sec".format(name, rate)
+    for name, rate in sorted(writer_benchmarks().items()):
+        print "{:<28} {:>12,.1f} MB/sec".format(name, rate)
+    for name, rate in sorted(parse_benchmarks().items()):
+        print "{:<28} {:>12,.0f} requests/sec".format(name, rate)
@@ -0,0 +1,176 @@
+import ctypes
+import zlib
+from multiprocessing import Lock, RawArray, RawValue
+
+# client names longer than this won't fit in a slot
+NAME_SIZE = 64
+
+
+class ClientSlot(ctypes.Structure):
+    """ Everything the server processes need to agree on about one client, in a fixed size record.
+    """
+    _fields_ = [("name", ctypes.c_char * NAME_SIZE),
+                ("active", ctypes.c_bool),
+                ("heartbeat", ctypes.c_double),
+                ("last_data", ctypes.c_double),
+                ("data_bytes", ctypes.c_uint64),
+                ("io_bytes", ctypes.c_uint64),
+                ("io_seconds", ctypes.c_double)]
+
+
+class SharedClient(object):
+    """ A view of one client's slot in a ClientTable. Reading or setting .active and
+    .current_heartbeat goes straight to shared memory, so every process sees the same thing.
+    """
+
+    def __init__(self, name, slot, table):
+        self.name = name
+        self.slot = slot
+        self.table = table
+
+    @property
+    def active(self):
+        return self.slot.active
+
+    @active.setter
+    def active(self, value):
+        self.table.set_active(self.slot, value)
+
+    def deactivate(self):
+        """ Mark the client inactive.
+        :return bool: whether this call is the one that did it (False if it was already inactive)
+        """
+        return self.table.set_active(self.slot, False)
+
+    @property
+    def current_heartbeat(self):
+        return self.slot.heartbeat
+
+    @current_heartbeat.setter
+    def current_heartbeat(self, value):
+        self.slot.heartbeat = value
+
+
+class ClientTable(object):
+    """ A fixed size hash table of clients in shared memory, so forked server workers can all see
+    every client no matter which worker it talked to.
+
+    Slots are found by hashing the name and probing forward, and never get removed, so looking up a
+    client that already exists doesn't need the lock. Only adding a client does.
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        :param int capacity: the most clients the table can hold
+        """
+        self.capacity = capacity
+        self.slots = RawArray(ClientSlot, capacity)
+        # slot indexes in the order they were filled, so watchers can find new clients cheaply
+        self.order = RawArray(ctypes.c_int, capacity)
+        self.count = RawValue(ctypes.c_int, 0)
+        # kept up to date as clients come and go, so nobody has to count them
+        self.active = RawValue(ctypes.c_int, 0)
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.count.value
+
+    def active_count(self):
+        """ How many clients are active right now.
+        :return int: the number of active clients
+        """
+        return self.active.value
+
+    def set_active(self, slot, value):
+        """ Change whether a client is active, keeping the active count right.
+        :param ClientSlot slot: the client's slot
+        :param bool value: whether it should be active
+        :return bool: whether anything changed
+        """
+        with self.lock:
+            if slot.active == value:
+                return False
+            slot.active = value
+            self.active.value += 1 if value else -1
+            return True
+
+    def index_of(self, slot):
+        """ Work out where a slot is in the table, so other shared arrays can be indexed the same way.
+        :param ClientSlot slot: the client's slot
+        :return int: the slot index
+        """
+        return (ctypes.addressof(slot) - ctypes.addressof(self.slots)) // ctypes.sizeof(ClientSlot)
+
+    def _probe(self, key):
+        """ Find the slot for a name, or the empty slot where it would go.
+        :param str key: the encoded client name
+        :return int: the slot index, or None if the table is full
+        """
+        start = zlib.crc32(key) % self.capacity
+        for i in xrange(self.capacity):
+            index = (start + i) % self.capacity
+            name = self.slots[index].name
+            if not name or name == key:
+                return index
+
+    def get(self, name):
+        """ Look up a client without adding it.
+        :param str name: the client's name
+        :return SharedClient: the client, or None if it isn't in the table
+        """
+        key = name.encode('utf-8')
+        index = self._probe(key)
+        if index is not None and self.slots[index].name == key:
+            return SharedClient(name, self.slots[index], self)
+
+    def get_or_create(self, name, now):
+        """ Look up a client, adding it if this is the first time anyone has seen it.
+        :param str name: the client's name
+        :param float now: the time to use as its first heartbeat, if it's new
+        :return (SharedClient, bool): the client (None if there's no room), and whether we just added it
+        """
+        key = name.encode('utf-8')
+        if len(key) >= NAME_SIZE:
+            return None, False
+        client = self.get(name)
+        if client:
+            return client, False
+
+        with self.lock:
+            # someone else might have added it while we were waiting
+            index = self._probe(key)
+            if index is None or self.count.value >= self.capacity:
+                return None, False
+            slot = self.slots[index]
+            if slot.name == key:
+                return SharedClient(name, slot, self), False
+
+            # set everything else up before the name, since the name is what makes it visible
+            slot.active = True
+            slot.heartbeat = now
+            slot.last_data = 0
+            slot.data_bytes = 0
+            slot.io_bytes = 0
+            slot.io_seconds = 0
+            slot.name = key
+            self.order[self.count.value] = index
+            self.count.value += 1
+            self.active.value += 1
+            return SharedClient(name, slot, self), True
+
+    def clients_since(self, seen):
+        """ Get the clients added after the first `seen` ones.
+        :param int seen: how many clients the caller already knows about
+        :return list: SharedClients, in the order they were added
+        """
+        new = []
+        for i in range(seen, self.count.value):
+            slot = self.slots[self.order[i]]
+            new.append(SharedClient(slot.name.decode('utf-8'), slot, self))
+        return new
+
+    def items(self):
+        """ Like dict.items, so the table can be used wherever the client dictionary was.
+        :return list: (name, SharedClient) for every client
+        """
+        return [(client.name, client) for client in self.clients_since(0)]
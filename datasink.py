@@ -0,0 +1,417 @@
+import ctypes
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import threading
+import Queue
+from collections import OrderedDict
+from multiprocessing import RawArray
+from multiprocessing.queues import SimpleQueue
+
+# goes in place of a path, on the queue and on the closed queue, to mark where sync() was called
+SYNC = object()
+
+
+class DataSink(object):
+    """ One writer thread for every client's data file.
+
+    Payloads are put on a queue as they arrive, so nothing gets lost between polls, and the writer
+    pulls them off in order. Lines are batched per file and written when the batch gets big enough or
+    the flush interval passes. Open file handles are kept in a small LRU pool so we aren't reopening
+    a file for every line, but we also don't hold one open for every client that ever connected.
+
+    The queue itself has no limit, so the sink keeps count of how many bytes each file has waiting
+    (queued or batched, but not written yet). Whoever is putting lines in can look at that with backlog
+    and stop taking on more for a file that's falling behind.
+
+    Files with one of the rotate extensions get closed off once they get to rotate_bytes, or once
+    they've been going for rotate_seconds. The closed segment is moved to <file>.<n> and gets a line in
+    <file>.idx saying what time its lines came in between, so read_segments can skip straight to a time
+    range. Then it's gzipped on a thread of its own, and its line is changed to point at <file>.<n>.gz.
+    The file itself is always the segment being written.
+
+    Every file should only have the one writer, or two processes' batches can end up interleaved, in
+    the wrong order or even mixed up inside a line, and a segment can be written to after it's been
+    closed off. So when server workers get forked, call share first: from then on the workers hand
+    their lines over to this process, and only this one writes.
+    """
+
+    def __init__(self, log, max_open_files=64, flush_interval=1.0, flush_bytes=65536, rotate=(),
+                 rotate_bytes=0, rotate_seconds=0, compress_level=6):
+        """
+        :param logging.Logger log: where to log problems writing
+        :param int max_open_files: how many file handles to keep open at once
+        :param float flush_interval: max seconds a line can sit in a batch before it is written
+        :param int flush_bytes: write a file's batch as soon as it gets this big
+        :param tuple rotate: extensions of the files to rotate, like ".data"
+        :param int rotate_bytes: close off a segment once it's this big; 0 means never
+        :param float rotate_seconds: close off a segment once it's been going this long; 0 means never
+        :param int compress_level: gzip level for closed segments, 1 to 9; 0 leaves them as they are
+        """
+        self.log = log
+        self.max_open_files = max_open_files
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.rotate = tuple(rotate) if rotate_bytes or rotate_seconds else ()
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress_level = compress_level
+        # path -> the segment being written: when its first and last lines came in, and its size
+        self.segments = {}
+        # closed segments waiting to be compressed
+        self.closed = Queue.Queue()
+        self.compressor = None
+        # the writer adds segments to an index and the compressor changes them
+        self.index_lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.pending = OrderedDict()
+        self.pending_bytes = {}
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+        # path -> bytes put in with write that haven't been written to the file yet
+        self.queued = {}
+        self.queued_lock = threading.Lock()
+        self.thread = None
+        # set up by share: the process that does the writing, and the pipe the others send lines down
+        self.owner = None
+        self.channel = None
+        self.relay = None
+
+    def share(self, buckets=65536):
+        """ Let processes forked after this write through us. Their lines come down a pipe to this
+        process, which is the only one that writes, so each file has one writer and gets lines in the
+        order they were handed over.
+        :param int buckets: how many counters to keep the backlog in. Files are spread over them by a hash
+        of their name, and two files in the same bucket count against each other
+        """
+        self.owner = os.getpid()
+        self.channel = SimpleQueue()
+        # every process needs to see the backlog, so it goes in shared memory
+        self.queued = RawArray(ctypes.c_longlong, buckets)
+        self.queued_lock = multiprocessing.Lock()
+        self.relay = threading.Thread(target=self.relay_shared)
+        self.relay.daemon = True
+        self.relay.start()
+
+    def write(self, path, line):
+        """ Queue up a line to be appended to a file. Starts the writer thread the first time.
+        :param str path: the file to append to
+        :param str line: what to write, newline included
+        """
+        self.count(path, len(line))
+        if self.channel is not None and os.getpid() != self.owner:
+            # a SimpleQueue's put is in the pipe by the time it returns, so whatever we write next (after
+            # answering this request, say) can't get ahead of it, whichever process it comes from
+            self.channel.put((path, line))
+            return
+        self._start()
+        self.queue.put((path, line))
+
+    def count(self, path, size):
+        """ Add to (or take away from) how many bytes a file has waiting.
+        :param str path: the file
+        :param int size: the bytes
+        """
+        with self.queued_lock:
+            if self.channel is not None:
+                self.queued[hash(path) % len(self.queued)] += size
+                return
+            left = self.queued.get(path, 0) + size
+            if left > 0:
+                self.queued[path] = left
+            else:
+                self.queued.pop(path, None)
+
+    def backlog(self, *paths):
+        """ How much is waiting to be written to some files.
+        :param str paths: the files
+        :return int: how many bytes have been put in with write for them but not written yet
+        """
+        with self.queued_lock:
+            if self.channel is not None:
+                return sum(self.queued[hash(path) % len(self.queued)] for path in paths)
+            return sum(self.queued.get(path, 0) for path in paths)
+
+    def relay_shared(self):
+        """ Hand the lines the other processes send us to the writer thread, until close().
+        """
+        while True:
+            job = self.channel.get()
+            if job is None:
+                return
+            self._start()
+            self.queue.put(job)
+
+    def sync(self, timeout=None):
+        """ Block until everything queued before this call has been written out, and every segment closed
+        off before it has been compressed. Only the process that writes can wait for that.
+        :param float timeout: how long to wait, in seconds
+        :return bool: whether everything made it to disk in time
+        """
+        self._start()
+        done = threading.Event()
+        self.queue.put((SYNC, done))
+        done.wait(timeout)
+        return done.is_set()
+
+    def close(self):
+        """ Write out everything that's queued, close every file and stop the writer thread, once every
+        closed segment has been compressed. Anywhere but the process that writes, this does nothing, since
+        everything we wrote is already in the pipe.
+        """
+        if self.channel is not None and os.getpid() != self.owner:
+            return
+        if self.relay is not None:
+            # the other processes have stopped by now, so this goes in behind the last of their lines
+            self.channel.put(None)
+            self.relay.join()
+            self.relay = None
+        if self.thread is None:
+            return
+        self.queue.put((None, None))
+        self.thread.join()
+        self.thread = None
+        self.closed.put(None)
+        self.compressor.join()
+        self.compressor = None
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+                self.compressor = threading.Thread(target=self.compress_closed)
+                self.compressor.daemon = True
+                self.compressor.start()
+
+    def run(self):
+        """ Pull lines off the queue and batch them up until it's time to write.
+        """
+        next_flush = time.time() + self.flush_interval
+        while True:
+            try:
+                path, line = self.queue.get(timeout=max(next_flush - time.time(), 0))
+            except Queue.Empty:
+                path, line = None, None
+            else:
+                if path is SYNC:
+                    # it goes behind the segments waiting to be compressed
+                    self.flush_all()
+                    self.closed.put((SYNC, line))
+                elif path is not None:
+                    self.pending.setdefault(path, []).append(line)
+                    self.pending_bytes[path] = self.pending_bytes.get(path, 0) + len(line)
+                    if path.endswith(self.rotate):
+                        self.track(path, len(line))
+                    if self.pending_bytes[path] >= self.flush_bytes:
+                        self.flush(path)
+                elif line is None:
+                    # that's the close() marker
+                    self.flush_all()
+                    self.close_handles()
+                    return
+
+            if time.time() >= next_flush:
+                self.flush_all()
+                self.roll_old()
+                next_flush = time.time() + self.flush_interval
+
+    def flush_all(self):
+        """ Write out every file's batch.
+        """
+        for path in list(self.pending.keys()):
+            self.flush(path)
+
+    def flush(self, path):
+        """ Write out one file's batch.
+        :param str path: the file to write
+        """
+        lines = self.pending.pop(path, None)
+        written = self.pending_bytes.pop(path, 0)
+        if not lines:
+            return
+        try:
+            handle = self.get_handle(path)
+            handle.write("".join(lines))
+            handle.flush()
+        except IOError as e:
+            self.log.error("Could not write {} lines to {}! error: {}".format(len(lines), path, e))
+        # they're gone either way, so they don't count against the file any more
+        self.count(path, -written)
+
+        segment = self.segments.get(path)
+        if segment and self.rotate_bytes and segment["bytes"] >= self.rotate_bytes:
+            self.roll(path)
+
+    def track(self, path, size):
+        """ Count a line towards the segment it's going in.
+        :param str path: the file
+        :param int size: the line's size
+        """
+        now = time.time()
+        segment = self.segments.get(path)
+        if segment is None:
+            try:
+                existing = os.path.getsize(path)
+            except OSError:
+                existing = 0
+            # whatever's already there is from before we started, so we can't say when it came in
+            segment = self.segments[path] = {"first": now if not existing else 0, "last": now,
+                                             "lines": 0, "bytes": existing}
+        segment["last"] = now
+        segment["lines"] += 1
+        segment["bytes"] += size
+
+    def roll_old(self):
+        """ Close off every segment that's been going for longer than rotate_seconds.
+        """
+        if not self.rotate_seconds:
+            return
+        cutoff = time.time() - self.rotate_seconds
+        for path, segment in self.segments.items():
+            if segment["first"] <= cutoff and path not in self.pending:
+                self.roll(path)
+
+    def roll(self, path):
+        """ Close off a file's segment: move it out of the way for the compressor, and start a new one.
+        :param str path: the file
+        """
+        segment = self.segments.pop(path)
+        handle = self.handles.pop(path, None)
+        if handle is not None:
+            handle.close()
+        number = len(read_index(path))
+        while os.path.exists("{}.{}".format(path, number)) or os.path.exists("{}.{}.gz".format(path, number)):
+            number += 1
+        closed = "{}.{}".format(path, number)
+        try:
+            os.rename(path, closed)
+            # it goes in the index straight away, so a reader never misses it while it's being compressed
+            entry = dict(segment, segment=os.path.basename(closed), stored=segment["bytes"])
+            with self.index_lock:
+                with open(path + ".idx", 'a') as index:
+                    index.write(json.dumps(entry, sort_keys=True) + "\n")
+        except (IOError, OSError) as e:
+            self.log.error("Could not close off {}! error: {}".format(path, e))
+            return
+        self.closed.put((path, closed))
+
+    def compress_closed(self):
+        """ Compress closed segments and point their file's index at them, one at a time, until close().
+        """
+        while True:
+            job = self.closed.get()
+            if job is None:
+                return
+            path, closed = job
+            if path is SYNC:
+                closed.set()
+                continue
+            if not self.compress_level:
+                continue
+            try:
+                stored = self.compress(closed)
+                self.reindex(path, os.path.basename(closed), os.path.basename(stored),
+                             os.path.getsize(stored))
+                # anyone reading the old name from the index already has it open, or will find the .gz
+                os.remove(closed)
+            except (IOError, OSError) as e:
+                self.log.error("Could not compress {}! error: {}".format(closed, e))
+
+    def compress(self, closed):
+        """ Gzip a closed segment a bit at a time, so a big one doesn't all have to fit in memory.
+        :param str closed: the segment
+        :return str: where it ended up
+        """
+        target = closed + ".gz"
+        with open(closed, 'rb') as source:
+            compressed = gzip.open(target + ".tmp", 'wb', self.compress_level)
+            try:
+                shutil.copyfileobj(source, compressed, 1048576)
+            finally:
+                compressed.close()
+        # only a whole segment gets the .gz name
+        os.rename(target + ".tmp", target)
+        return target
+
+    def reindex(self, path, old, new, stored):
+        """ Point a segment's line in the index at where it lives now.
+        :param str path: the file the segment was closed off from
+        :param str old: the segment's name in the index
+        :param str new: its new name
+        :param int stored: its new size
+        """
+        with self.index_lock:
+            entries = read_index(path)
+            for entry in entries:
+                if entry["segment"] == old:
+                    entry["segment"], entry["stored"] = new, stored
+            with open(path + ".idx.tmp", 'w') as index:
+                index.writelines(json.dumps(entry, sort_keys=True) + "\n" for entry in entries)
+            # readers see either the old index or the new one, never half of one
+            os.rename(path + ".idx.tmp", path + ".idx")
+
+    def get_handle(self, path):
+        """ Get an open handle for the file, closing the least recently used one if the pool is full.
+        :param str path: the file we want to append to
+        :return file: the open file
+        """
+        handle = self.handles.pop(path, None)
+        if handle is None:
+            while len(self.handles) >= self.max_open_files:
+                old_path, old_handle = self.handles.popitem(last=False)
+                old_handle.close()
+            handle = open(path, 'ab')
+        self.handles[path] = handle
+        return handle
+
+    def close_handles(self):
+        """ Close every open file.
+        """
+        while self.handles:
+            path, handle = self.handles.popitem()
+            handle.close()
+
+
+def read_index(path):
+    """ What segments a rotated file has been closed off into.
+    :param str path: the file
+    :return list: a dict for each segment, oldest first: the segment's file name, when its first and last
+    lines came in (first is 0 if we don't know), how many lines, and its size before and after compressing
+    """
+    try:
+        with open(path + ".idx") as index:
+            return [json.loads(line) for line in index if line.strip()]
+    except IOError:
+        return []
+
+
+def read_segments(path, start=None, end=None):
+    """ Read a rotated file back, only opening the segments with lines from around a time range. Lines
+    aren't timed on their own, so this is to the nearest segment.
+    :param str path: the file
+    :param float start: leave out segments that finished before this
+    :param float end: leave out segments that started after this
+    :return generator: the lines, oldest first, ending with the segment still being written
+    """
+    directory = os.path.dirname(path)
+    for entry in read_index(path):
+        if start is not None and entry["last"] < start:
+            continue
+        if end is not None and entry["first"] > end:
+            break
+        segment = os.path.join(directory, entry["segment"])
+        if not segment.endswith(".gz") and not os.path.exists(segment):
+            # it got compressed after we read the index
+            segment += ".gz"
+        with (gzip.open(segment, 'rb') if segment.endswith(".gz") else open(segment, 'rb')) as f:
+            for line in f:
+                yield line
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                yield line
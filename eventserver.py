@@ -0,0 +1,366 @@
+import errno
+import select
+import socket
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+# epoll and poll use the same numbers for these on linux, so one set of flags works for both
+READ = select.POLLIN
+WRITE = select.POLLOUT
+HANGUP = select.POLLERR | select.POLLHUP
+
+
+class Headers(dict):
+    """ Header names aren't case sensitive, so they're stored lowercased.
+    """
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+
+class Request(object):
+    """ Just enough of flask.request for the handlers in FlaskServer to not know the difference.
+    """
+
+    def __init__(self, method, path, args, headers, data):
+        self.method = method
+        self.path = path
+        self.args = args
+        self.headers = headers
+        self.data = data
+
+
+class Connection(object):
+    """ Everything we need to remember about one client socket between events.
+    """
+    __slots__ = ('sock', 'inbuf', 'outbuf', 'last_active', 'closing')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = ''
+        self.outbuf = ''
+        self.last_active = time.time()
+        self.closing = False
+
+
+class Poller(object):
+    """ epoll where we have it, poll everywhere else. Either one copes with way more sockets than select.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            # epoll wants seconds
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            # poll wants milliseconds
+            self.scale = 1000
+
+    def register(self, fd, mask):
+        self.poller.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self.poller.modify(fd, mask)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        return self.poller.poll(timeout * self.scale)
+
+
+class EventLoopServer(object):
+    """ A single threaded, non-blocking HTTP/1.1 server which speaks the same protocol as the Flask app.
+
+    One loop waits on every socket at once and only does work for the ones which are ready, so idle
+    keep-alive connections cost a file descriptor and a couple of small buffers, not a thread. The
+    number of connections, the size of each request and how long a connection can sit idle are all
+    capped, so memory stays bounded no matter how many clients show up. So is how many unsent responses
+    a connection can pile up: once max_outbuf bytes of them are waiting, we stop reading from it and stop
+    handling the requests it already sent, until it reads some of what we've sent back.
+
+    Requests get handled one at a time, so the ones that come in together wait behind each other. Only
+    max_in_flight of them get handled each time round the loop; the rest are told to come back in
+    retry_after seconds (503 with a Retry-After header) rather than wait behind all the others.
+    """
+
+    def __init__(self, routes, log, max_connections=10000, idle_timeout=60, max_body=1048576,
+                 max_header=8192, max_in_flight=0, retry_after=1, max_outbuf=262144):
+        """
+        :param dict routes: path -> function which takes a Request and returns what a Flask view would
+        :param logging.Logger log: where to log
+        :param int max_connections: connections past this are closed as soon as they're accepted
+        :param int idle_timeout: seconds a connection can go without sending anything before we close it
+        :param int max_body: biggest request body we'll accept, in bytes
+        :param int max_header: biggest request line plus headers we'll accept, in bytes
+        :param int max_in_flight: most POSTs to handle each time round the loop; 0 means no limit
+        :param int retry_after: how long to tell the ones we turn away to wait, in seconds
+        :param int max_outbuf: how many bytes of responses a connection can have waiting to be sent
+        before we stop reading from it
+        """
+        self.routes = routes
+        self.log = log
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_body = max_body
+        self.max_header = max_header
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.max_outbuf = max_outbuf
+        self.in_flight = 0
+        self.connections = {}
+        self.poller = None
+        self.sock = None
+
+    def listen(self, port, host='127.0.0.1'):
+        """ Make a non-blocking listening socket.
+        :param int port: which port to listen on
+        :param str host: which address to listen on
+        :return socket.socket: the listening socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+        sock.setblocking(0)
+        return sock
+
+    def serve_forever(self, port=5000, sock=None):
+        """ Listen on the port (or use the listening socket we were given) and handle requests forever.
+        :param int port: which port to listen on
+        :param socket.socket sock: an already listening socket to use instead
+        """
+        self.sock = sock or self.listen(port)
+        self.sock.setblocking(0)
+        self.poller = Poller()
+        self.poller.register(self.sock.fileno(), READ)
+        self.log.warning("Event loop server listening on port {}".format(self.sock.getsockname()[1]))
+
+        last_sweep = time.time()
+        while True:
+            self.run_once(timeout=1)
+            if time.time() - last_sweep >= 1:
+                self.close_idle()
+                last_sweep = time.time()
+
+    def run_once(self, timeout):
+        """ Wait for sockets to be ready, and deal with the ones that are.
+        :param float timeout: how long to wait, in seconds
+        """
+        try:
+            events = self.poller.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        listen_fd = self.sock.fileno()
+        self.in_flight = 0
+        for fd, event in events:
+            if fd == listen_fd:
+                self.accept()
+                continue
+            conn = self.connections.get(fd)
+            if conn is None:
+                continue
+            if event & READ:
+                self.read(fd, conn)
+            if event & WRITE and fd in self.connections:
+                self.write(fd, conn)
+                if conn.inbuf and fd in self.connections:
+                    # requests that were left waiting while the output was full
+                    self.process(fd, conn)
+            if event & HANGUP and fd in self.connections:
+                self.close(fd)
+
+    def accept(self):
+        """ Accept everyone who is waiting to connect.
+        """
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.log.error("Could not accept a connection! error: {}".format(e))
+                return
+
+            if len(self.connections) >= self.max_connections:
+                self.log.warning("Already have {} connections, turning one away."
+                                 .format(self.max_connections))
+                sock.close()
+                continue
+
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[sock.fileno()] = Connection(sock)
+            self.poller.register(sock.fileno(), READ)
+
+    def read(self, fd, conn):
+        """ Read whatever the socket has for us and handle any requests that are now complete.
+        """
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            # they hung up on us
+            self.close(fd)
+            return
+
+        conn.last_active = time.time()
+        conn.inbuf += data
+        self.process(fd, conn)
+
+    def process(self, fd, conn):
+        """ Pull every complete request out of the connection's buffer and respond to it.
+        """
+        # a client that sends requests without reading the responses has to wait for them
+        while not conn.closing and len(conn.outbuf) < self.max_outbuf:
+            end = conn.inbuf.find('\r\n\r\n')
+            if end < 0:
+                if len(conn.inbuf) > self.max_header:
+                    self.respond(fd, conn, ("Headers too large", 431), keep_alive=False)
+                return
+
+            lines = conn.inbuf[:end].split('\r\n')
+            request_line = lines[0].split()
+            if len(request_line) != 3:
+                self.respond(fd, conn, ("Bad request line", 400), keep_alive=False)
+                return
+            method, target, version = request_line
+
+            headers = Headers()
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if 'chunked' in headers.get('transfer-encoding', ''):
+                self.respond(fd, conn, ("Content-Length required", 411), keep_alive=False)
+                return
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                self.respond(fd, conn, ("Bad Content-Length", 400), keep_alive=False)
+                return
+            if length > self.max_body:
+                self.respond(fd, conn, ("Request too large", 413), keep_alive=False)
+                return
+
+            start = end + 4
+            if len(conn.inbuf) < start + length:
+                # the rest of the body hasn't shown up yet
+                return
+            body = conn.inbuf[start:start + length]
+            conn.inbuf = conn.inbuf[start + length:]
+
+            connection = headers.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = connection != 'close'
+            else:
+                keep_alive = connection == 'keep-alive'
+
+            path, _, query = target.partition('?')
+            req = Request(method, path, dict(urlparse.parse_qsl(query)), headers, body)
+            # GETs are cheap, and they're how we keep an eye on the server, so they always get through
+            if method == 'POST' and self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.respond(fd, conn, ("Server busy", 503, {"Retry-After": str(self.retry_after)}),
+                             keep_alive)
+                continue
+            self.in_flight += 1
+            self.respond(fd, conn, self.dispatch(req), keep_alive)
+
+    def dispatch(self, req):
+        """ Find the handler for the request's path and run it.
+        :param Request req: the request
+        :return: whatever the handler returned
+        """
+        handler = self.routes.get(req.path)
+        if handler is None:
+            return "Not found", 404
+        try:
+            return handler(req)
+        except Exception as e:
+            self.log.exception("Handler for {} failed! error: {}".format(req.path, e))
+            return "Internal server error", 500
+
+    def respond(self, fd, conn, result, keep_alive):
+        """ Turn what a handler returned into an HTTP response and start sending it.
+        :param result: a body, or (body, status), or (body, status, headers), like a Flask view
+        :param bool keep_alive: whether to keep the connection open afterwards
+        """
+        status, headers = 200, {}
+        if isinstance(result, tuple):
+            if len(result) == 3:
+                result, status, headers = result
+            else:
+                result, status = result
+        if isinstance(result, unicode):
+            result = result.encode('utf-8')
+
+        reason = BaseHTTPRequestHandler.responses.get(status, ('Unknown',))[0]
+        head = ['HTTP/1.1 {} {}'.format(status, reason),
+                'Content-Length: {}'.format(len(result))]
+        if 'Content-Type' not in headers:
+            head.append('Content-Type: text/html; charset=utf-8')
+        for key, value in headers.items():
+            head.append('{}: {}'.format(key, value))
+        if not keep_alive:
+            head.append('Connection: close')
+            conn.closing = True
+
+        conn.outbuf += '\r\n'.join(head) + '\r\n\r\n' + result
+        self.write(fd, conn)
+
+    def write(self, fd, conn):
+        """ Send as much of the connection's pending output as the socket will take.
+        """
+        while conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close(fd)
+                return
+            conn.outbuf = conn.outbuf[sent:]
+
+        if len(conn.outbuf) >= self.max_outbuf:
+            # don't take anything more from them until they've read some of this
+            self.poller.modify(fd, WRITE)
+        elif conn.outbuf:
+            # come back when the socket can take more
+            self.poller.modify(fd, READ | WRITE)
+        elif conn.closing:
+            self.close(fd)
+        else:
+            self.poller.modify(fd, READ)
+
+    def close(self, fd):
+        """ Forget about a connection and close its socket.
+        """
+        conn = self.connections.pop(fd, None)
+        if conn is None:
+            return
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def close_idle(self):
+        """ Close every connection which hasn't sent us anything in a while.
+        """
+        cutoff = time.time() - self.idle_timeout
+        for fd, conn in list(self.connections.items()):
+            if conn.last_active < cutoff:
+                self.close(fd)
@@ -0,0 +1,306 @@
+""" A journal of client state changes, so a server that dies can pick up where it left off.
+
+Every hello (a client we've never seen), goodbye and timeout is appended to the journal as a fixed size
+record. Every few seconds the whole client table, last heartbeats and all, and the report counters are
+written to a snapshot, and the journal starts over in a new file. Starting up means loading the
+snapshot and replaying the journal written since.
+
+Heartbeats themselves aren't journaled: with 100k clients that would be far too many records to replay
+quickly. Instead the server writes a watermark every second or so, which says it was still up then, and
+a client's heartbeat is only ever as old as the last snapshot.
+
+A hello, goodbye or timeout changes the table, bumps its counter and gets journaled all while holding
+the journal's lock, and a snapshot copies the table and reads the counters while holding it too, as it
+starts the new journal. So whatever the snapshot saved is exactly what the old journals say, and every
+record in the new one is something it doesn't have yet. Replaying a record the snapshot does cover, if
+we died partway through taking one, does no harm: hellos for clients we have, and goodbyes and timeouts
+for clients that are already inactive, change nothing and count nothing.
+
+Each record has a CRC, so a record that got torn in half by a crash is spotted, and it and anything
+after it are ignored.
+"""
+import ctypes
+import json
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+from multiprocessing import RawValue
+
+from clientstate import ClientSlot, NAME_SIZE
+
+HELLO, WATERMARK, GOODBYE, TIMEOUT = 1, 2, 3, 4
+
+# crc32 of everything after it, kind, time, client name
+RECORD = struct.Struct("<IBd{}s".format(NAME_SIZE))
+# magic, generation, table capacity, time, clients, length of the counters (JSON). after that come the
+# counters, the table's order array and then its slots, as they are in memory
+SNAPSHOT = struct.Struct("<4sQIdII")
+MAGIC = "CSJ1"
+
+
+def pack(kind, name, when):
+    """ Make a journal record.
+    :param int kind: HELLO, WATERMARK, GOODBYE or TIMEOUT
+    :param str name: the client's name (nothing, for a watermark)
+    :param float when: when it happened
+    :return str: the record
+    """
+    body = RECORD.pack(0, kind, when, name.encode('utf-8'))[4:]
+    return struct.pack("<I", zlib.crc32(body) & 0xffffffff) + body
+
+
+def read_records(path):
+    """ Read every whole, uncorrupted record in a journal file, stopping at the first one that isn't.
+    :param str path: the journal file
+    :return list: (kind, time, name) for each record, in the order they were written
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return []
+    records = []
+    for offset in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+        crc, kind, when, name = RECORD.unpack_from(data, offset)
+        if zlib.crc32(data[offset + 4:offset + RECORD.size]) & 0xffffffff != crc:
+            break
+        records.append((kind, when, name.rstrip('\0')))
+    return records
+
+
+class Journal(object):
+    """ Writes the journal and snapshots, and reads them back when the server starts.
+
+    Make it before any server processes get forked, like the ClientTable, so they all share the lock and
+    the generation number. Any of them can write to the journal; one thread takes the snapshots.
+    """
+
+    def __init__(self, directory, table, fsync=False):
+        """
+        :param str directory: where the journal and snapshot go; if this is None nothing is journaled
+        :param clientstate.ClientTable table: the client table to save and restore
+        :param bool fsync: whether to fsync after every record, so they survive the machine crashing too
+        """
+        self.directory = directory
+        self.table = table
+        self.fsync = fsync
+        # which journal file is current. the lock makes sure nobody writes to the old one after a
+        # snapshot has started
+        self.generation = RawValue(ctypes.c_uint64, 0)
+        self.lock = multiprocessing.Lock()
+        self.fd = None
+        self.fd_generation = None
+        self.fd_pid = None
+
+    def path(self, generation):
+        return os.path.join(self.directory, "journal.{}".format(generation))
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, "snapshot")
+
+    def hello(self, name, when, counter):
+        """ Add a client to the table, if nobody has yet, and count and journal it if we did.
+        :param str name: the client's name
+        :param float when: when we heard from it
+        :param ShardedCounter counter: the total_connections counter
+        :return (SharedClient, bool): like ClientTable.get_or_create
+        """
+        with self.lock:
+            client, created = self.table.get_or_create(name, when)
+            if created:
+                counter.increment()
+                self._write(pack(HELLO, name, when))
+            return client, created
+
+    def deactivate(self, client, kind, when, counter):
+        """ Mark a client inactive, if nobody has yet, and count and journal it if we did.
+        :param SharedClient client: the client
+        :param int kind: GOODBYE or TIMEOUT
+        :param float when: when it happened
+        :param ShardedCounter counter: the total_goodbyes or total_timeouts counter
+        :return bool: whether this call is the one that did it
+        """
+        with self.lock:
+            changed = client.deactivate()
+            if changed:
+                counter.increment()
+                self._write(pack(kind, client.name, when))
+            return changed
+
+    def record(self, kind, name, when):
+        """ Append a record to the journal. Hellos, goodbyes and timeouts should go through hello and
+        deactivate instead, so they're counted at the same time.
+        :param int kind: HELLO, WATERMARK, GOODBYE or TIMEOUT
+        :param str name: the client's name (nothing, for a watermark)
+        :param float when: when it happened
+        """
+        with self.lock:
+            self._write(pack(kind, name, when))
+
+    def _write(self, data):
+        """ Append a record to the current journal file. Hold the lock.
+        :param str data: the record, from pack
+        """
+        if self.directory is None:
+            return
+        generation = self.generation.value
+        if self.fd is None or self.fd_pid != os.getpid() or self.fd_generation != generation:
+            # file descriptors are shared across a fork, so only close the one we opened
+            if self.fd is not None and self.fd_pid == os.getpid():
+                os.close(self.fd)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.fd = os.open(self.path(generation), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+            self.fd_generation = generation
+            self.fd_pid = os.getpid()
+        # one write of a whole record, to a file opened for appending, can't get mixed up with
+        # another process's
+        os.write(self.fd, data)
+        if self.fsync:
+            os.fsync(self.fd)
+
+    def snapshot(self, counters):
+        """ Save the client table and the counters, and start a new journal.
+        :param dict counters: the report counters (name -> ShardedCounter)
+        :return int: how many clients were saved
+        """
+        if self.directory is None:
+            return 0
+        table = self.table
+        size = ctypes.sizeof(ClientSlot)
+        # nothing can be added, leave, be counted or be journaled while we copy, so what we save is exactly
+        # what the old journal says, and anything after is in the new one
+        with self.lock:
+            self.generation.value += 1
+            generation = self.generation.value
+            count = len(table)
+            order = ctypes.string_at(ctypes.addressof(table.order), ctypes.sizeof(ctypes.c_int) * count)
+            slots = bytearray(ctypes.string_at(ctypes.addressof(table.slots), size * table.capacity))
+            values = json.dumps(dict((name, counter.value()) for name, counter in counters.items()))
+
+        temp = self.snapshot_path() + ".tmp"
+        with open(temp, 'wb') as f:
+            f.write(SNAPSHOT.pack(MAGIC, generation, table.capacity, time.time(), count, len(values)))
+            f.write(values)
+            f.write(order)
+            f.write(slots)
+            f.flush()
+            os.fsync(f.fileno())
+        # a rename either happens or it doesn't, so there's always one whole snapshot
+        os.rename(temp, self.snapshot_path())
+
+        for name in os.listdir(self.directory):
+            if name.startswith("journal.") and int(name.split(".")[1]) < generation:
+                os.remove(os.path.join(self.directory, name))
+        return count
+
+    def restore(self, counters, now=None):
+        """ Load the last snapshot and replay the journal after it into an empty client table.
+
+        Clients couldn't get heartbeats to us while we were down, and we don't know about any they sent
+        after the snapshot. So every active client gets the time since the snapshot added on to its
+        last heartbeat (though never past now). Nobody gets timed out for our downtime, but a client
+        that had already gone quiet before the snapshot still will.
+        :param dict counters: the report counters (name -> ShardedCounter) to add the saved counts to
+        :param float now: when the server came back
+        :return dict: how many clients were restored and how many are active, how many records were
+        replayed, and how long we were down for
+        """
+        if self.directory is None:
+            return {}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        now = time.time() if now is None else now
+        table = self.table
+        generation, taken = self._load_snapshot(counters)
+
+        # replay every journal from the snapshot's on, in case we died partway through taking one
+        generations = sorted(int(name.split(".")[1]) for name in os.listdir(self.directory)
+                             if name.startswith("journal."))
+        last_seen = taken
+        replayed = 0
+        for journal in [g for g in generations if g >= generation]:
+            for kind, when, name in read_records(self.path(journal)):
+                if kind != WATERMARK:
+                    self._replay(kind, when, name.decode('utf-8'), counters)
+                last_seen = max(last_seen, when)
+                replayed += 1
+
+        credit = now - taken
+        active = 0
+        for i in xrange(len(table)):
+            slot = table.slots[table.order[i]]
+            if slot.active:
+                slot.heartbeat = min(slot.heartbeat + credit, now)
+                active += 1
+        table.active.value = active
+        # new records go in a journal after every one we just read
+        self.generation.value = max(generations + [generation]) + 1
+        return {"clients": len(table), "active": active, "replayed": replayed,
+                "down_s": now - last_seen if last_seen else None}
+
+    def _load_snapshot(self, counters):
+        """ Copy the clients in the snapshot into the table, and add its counts to the counters.
+        :return (int, float): the snapshot's generation and when it was taken; 0s if there isn't one
+        """
+        try:
+            with open(self.snapshot_path(), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return 0, 0
+        magic, generation, capacity, taken, count, length = SNAPSHOT.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("{} isn't a snapshot".format(self.snapshot_path()))
+        offset = SNAPSHOT.size
+        for name, value in json.loads(data[offset:offset + length]).items():
+            if name in counters:
+                counters[name].increment(value)
+        offset += length
+        order = data[offset:offset + ctypes.sizeof(ctypes.c_int) * count]
+        offset += len(order)
+        size = ctypes.sizeof(ClientSlot)
+        slots = data[offset:offset + size * capacity]
+
+        table = self.table
+        if capacity == table.capacity:
+            # straight back where they were
+            ctypes.memmove(ctypes.addressof(table.order), order, len(order))
+            ctypes.memmove(ctypes.addressof(table.slots), slots, len(slots))
+            table.count.value = count
+            return generation, taken
+
+        # the clients hash to different places in a table of a different size, so they go in one by one
+        restored = 0
+        for index in struct.unpack("<{}i".format(count), order):
+            key = slots[index * size:index * size + NAME_SIZE].rstrip("\0")
+            new = table._probe(key)
+            if new is None:
+                break
+            ctypes.memmove(ctypes.addressof(table.slots[new]), slots[index * size:(index + 1) * size], size)
+            table.order[restored] = new
+            restored += 1
+        table.count.value = restored
+        return generation, taken
+
+    def _replay(self, kind, when, name, counters):
+        """ Apply a hello, goodbye or timeout to the table, the same way the server did the first time.
+        """
+        if kind == HELLO:
+            client, created = self.table.get_or_create(name, when)
+            if created:
+                counters["total_connections"].increment()
+            return
+        client = self.table.get(name)
+        if client is not None and client.deactivate():
+            counters["total_goodbyes" if kind == GOODBYE else "total_timeouts"].increment()
+
+    def clear(self):
+        """ Throw the journal and snapshot away, once a run has finished and there's nothing to resume.
+        """
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith("journal.") or name.startswith("snapshot"):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,189 @@
+""" Latency histograms that can be added together.
+
+An HdrHistogram counts values in microseconds. Below 2**sub_bucket_bits every microsecond gets its own
+bucket; above that the buckets double in width every power of two, with half as many buckets per
+power of two, so every value from a microsecond to an hour is kept to within 1% in a few thousand
+counters. Two histograms with the same settings add up by adding their counts, so every client process
+keeps its own and they get merged at the end of a run.
+"""
+import math
+
+# what goes in a latency report
+PERCENTILES = ((50, "p50"), (90, "p90"), (99, "p99"), (99.9, "p999"))
+
+
+class HdrHistogram(object):
+    """ A high dynamic range histogram of latencies.
+    """
+
+    def __init__(self, highest=3600 * 1000000, sub_bucket_bits=8):
+        """
+        :param int highest: the biggest value to keep, in microseconds; bigger ones count as this
+        :param int sub_bucket_bits: 8 keeps values to within 1%, each bit more halves that
+        """
+        self.highest = highest
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.half = self.sub_buckets >> 1
+        self.counts = [0] * (self.index(highest) + 1)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def index(self, value):
+        """ Which bucket a value goes in.
+        :param int value: the value, in microseconds
+        :return int: the bucket
+        """
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return self.sub_buckets + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def highest_equivalent(self, index):
+        """ The biggest value that goes in a bucket.
+        :param int index: the bucket
+        :return int: the value, in microseconds
+        """
+        if index < self.sub_buckets:
+            return index
+        shift = (index - self.sub_buckets) // self.half + 1
+        sub = (index - self.sub_buckets) % self.half + self.half
+        return ((sub + 1) << shift) - 1
+
+    def record(self, seconds):
+        """ Count one latency.
+        :param float seconds: the latency
+        """
+        value = min(max(int(round(seconds * 1000000)), 0), self.highest)
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """ Add another histogram's counts to this one.
+        :param HdrHistogram other: a histogram with the same settings
+        :return HdrHistogram: this one
+        """
+        if (other.highest, other.sub_bucket_bits) != (self.highest, self.sub_bucket_bits):
+            raise ValueError("Can't merge histograms with different settings.")
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        """ The value at a percentile, as the biggest value in the bucket it falls in.
+        :param float q: the percentile, from 0 to 100
+        :return float: the value in seconds, or None if nothing has been recorded
+        """
+        if not self.total:
+            return
+        target = max(int(math.ceil(q / 100.0 * self.total)), 1)
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return min(self.highest_equivalent(index), self.max) / 1000000.0
+
+    def summary(self):
+        """ Sum the histogram up.
+        :return dict: the count, mean, max and the PERCENTILES, in seconds
+        """
+        summary = {"count": self.total}
+        if not self.total:
+            return summary
+        summary["mean"] = self.sum / 1000000.0 / self.total
+        summary["max"] = self.max / 1000000.0
+        for q, name in PERCENTILES:
+            summary[name] = self.percentile(q)
+        return summary
+
+    def to_dict(self):
+        """ Write the histogram out as something that can be pickled or turned into JSON. Only the
+        buckets with something in them are kept.
+        :return dict: the histogram
+        """
+        return {"highest": self.highest,
+                "sub_bucket_bits": self.sub_bucket_bits,
+                "counts": [[index, count] for index, count in enumerate(self.counts) if count],
+                "sum": self.sum,
+                "min": self.min,
+                "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Read a histogram written by to_dict.
+        :param dict data: the histogram
+        :return HdrHistogram: the histogram
+        """
+        histogram = cls(data["highest"], data["sub_bucket_bits"])
+        for index, count in data["counts"]:
+            histogram.counts[index] = count
+            histogram.total += count
+        histogram.sum = data["sum"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+
+def merge_all(dumps):
+    """ Merge groups of histograms, like the ones each client process sends back at the end of a run.
+    :param list dumps: kind -> part -> HdrHistogram.to_dict(), one for each process
+    :return dict: kind -> part -> HdrHistogram, with everything for the same kind and part added up
+    """
+    merged = {}
+    for dump in dumps:
+        for kind, parts in dump.items():
+            for part, data in parts.items():
+                histogram = HdrHistogram.from_dict(data)
+                existing = merged.setdefault(kind, {}).get(part)
+                if existing is None:
+                    merged[kind][part] = histogram
+                else:
+                    existing.merge(histogram)
+    return merged
+
+
+def dump(histograms):
+    """ Write groups of histograms out for merge_all, or for a queue or JSON.
+    :param dict histograms: kind -> part -> HdrHistogram
+    :return dict: kind -> part -> HdrHistogram.to_dict()
+    """
+    return dict((kind, dict((part, histogram.to_dict()) for part, histogram in parts.items()))
+                for kind, parts in histograms.items())
+
+
+def report(histograms):
+    """ Sum up groups of histograms.
+    :param dict histograms: kind -> part -> HdrHistogram
+    :return dict: kind -> part -> HdrHistogram.summary()
+    """
+    return dict((kind, dict((part, histogram.summary()) for part, histogram in parts.items()))
+                for kind, parts in histograms.items())
+
+
+def format_report(summaries):
+    """ Lay a report out as a table, in milliseconds.
+    :param dict summaries: kind -> part -> HdrHistogram.summary(), from report
+    :return str: the table
+    """
+    names = [name for q, name in PERCENTILES]
+    lines = ["{:<12} {:<11} {:>8} ".format("kind", "part", "count") +
+             " ".join("{:>9}".format(name) for name in names + ["max"])]
+    for kind in sorted(summaries):
+        for part in sorted(summaries[kind]):
+            summary = summaries[kind][part]
+            if not summary["count"]:
+                continue
+            lines.append("{:<12} {:<11} {:>8} ".format(kind, part, summary["count"]) +
+                         " ".join("{:>9.3f}".format(summary[name] * 1000) for name in names + ["max"]))
+    return "\n".join(lines)
@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class LivenessScheduler(object):
+    """ One thread for the whole server which watches every client's heartbeat.
+
+    Instead of a thread per client polling its own timestamp, each client sits in a heap keyed by the
+    time we next need to look at it. Heartbeats just update client.current_heartbeat; we only touch the
+    heap when a deadline comes due, so each tick does work proportional to the clients that expired.
+    """
+
+    def __init__(self, timeout, log, on_timeout=None, step=10, resolution=1, deactivate=None):
+        """
+        :param int timeout: seconds without a heartbeat before a client is marked as failed
+        :param logging.Logger log: where to log escalations and failures
+        :param function on_timeout: called with the client object when it gets marked as failed
+        :param int step: how many seconds between "hasn't sent a heartbeat" log messages
+        :param int resolution: how many seconds between ticks of the scheduler thread
+        :param function deactivate: called with the client to mark it as failed, returning whether it
+        did; by default the client's own deactivate
+        """
+        self.timeout = timeout
+        self.log = log
+        self.on_timeout = on_timeout
+        self.deactivate = deactivate
+        self.step = step
+        self.resolution = resolution
+        self.heap = []
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.thread = None
+        self.table = None
+        self.seen = 0
+
+    def register(self, client):
+        """ Start watching a client. The client needs .name, .active and .current_heartbeat.
+        Kicks off the scheduler thread the first time it's called, so it lives in whichever process
+        is actually handling requests.
+        :param client: the ClientManager to watch
+        """
+        with self.lock:
+            self._push(client.current_heartbeat + min(self.step, self.timeout), client, self.step)
+            self._start()
+
+    def watch(self, table):
+        """ Watch every client in a clientstate.ClientTable, picking up new ones as they're added.
+        This is how the scheduler finds clients that server workers in other processes created.
+        :param clientstate.ClientTable table: the table to watch
+        """
+        with self.lock:
+            self.table = table
+            self.seen = 0
+            self._start()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _push(self, deadline, client, threshold):
+        heapq.heappush(self.heap, (deadline, next(self.seq), client, threshold))
+
+    def run(self):
+        """ Tick forever.
+        """
+        while True:
+            time.sleep(self.resolution)
+            self.tick(time.time())
+
+    def tick(self, now):
+        """ Look at every client whose deadline has passed, and either log, fail, or reschedule it.
+        :param float now: the current time
+        :return int: how many clients were looked at
+        """
+        expired = []
+        with self.lock:
+            if self.table is not None:
+                for client in self.table.clients_since(self.seen):
+                    self._push(client.current_heartbeat + min(self.step, self.timeout), client, self.step)
+                    self.seen += 1
+
+            while self.heap and self.heap[0][0] <= now:
+                expired.append(heapq.heappop(self.heap))
+
+            for deadline, seq, client, threshold in expired:
+                next_check = self._check(now, client, threshold)
+                if next_check:
+                    self._push(*next_check)
+        return len(expired)
+
+    def _check(self, now, client, threshold):
+        """ Decide what to do with a client whose deadline came up.
+        :return (float, client, int): when to look at this client next, or None if we're done with it
+        """
+        # we don't need to keep looking for heartbeats if we received a goodbye
+        if not client.active:
+            return
+
+        silence = now - client.current_heartbeat
+        if silence > self.timeout:
+            # a goodbye can come in between checking active and here, and whichever of us marks the client
+            # inactive first is the one that counts it
+            if self.deactivate is not None:
+                failed = self.deactivate(client)
+            elif hasattr(client, "deactivate"):
+                failed = client.deactivate()
+            else:
+                failed, client.active = client.active, False
+            if failed:
+                self.log.warning("Client {}: No heartbeat received for {} seconds - marking as failed."
+                                 .format(client.name, self.timeout))
+                if self.on_timeout:
+                    self.on_timeout(client)
+
+            # can't recover after this, so we can forget about it
+            return
+
+        if silence > threshold:
+            self.log.info("The client {} hasn't sent a heartbeat in over {} seconds."
+                          .format(client.name, threshold))
+            threshold += self.step
+        elif silence <= self.step:
+            # heartbeats came back, so start the escalation over
+            threshold = self.step
+
+        deadline = client.current_heartbeat + min(threshold, self.timeout)
+        return max(deadline, now + self.resolution), client, threshold
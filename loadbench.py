@@ -0,0 +1,471 @@
+""" End to end benchmarks: start the server, throw fleets of clients at it, and write down what happened.
+
+For every combination of client count, heartbeat rate and payload size in loadbench_config.json, this
+starts a fresh server on a free port in a scratch directory, runs the fleet against it for a while, and
+records:
+- the server's requests/sec, from its own /metrics
+- client side latency percentiles, merged from every client's histograms (see latency.py)
+- the server processes' CPU and RSS, sampled with psutil
+- how long the server took to notice the clients that stopped without saying goodbye
+
+The fleet is either synthetic clients, which send heartbeats and payloads of the given size but don't
+write or monitor anything so lots of them fit in a process, or real RequestClients writing payload
+sized chunks to disk. Either way they run on the EventLoopEngine, split over a few processes.
+
+Everything goes into a JSON file, so two versions can be compared with:
+python loadbench.py compare old.json new.json
+
+Run with: python loadbench.py [config file]
+"""
+import os
+import sys
+import json
+import time
+import Queue
+import shutil
+import socket
+import platform
+import itertools
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+import psutil
+import requests
+
+import requester
+import latency
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class FleetClient(requester.RequestClient):
+    """ A RequestClient which can be told to stop partway through without saying goodbye, like a
+    client that crashed, so we can time how long the server takes to notice.
+    """
+
+    def __init__(self, name, url, stall_after=None, **kwargs):
+        """
+        :param float stall_after: seconds after saying hello to go quiet; never, if this is None
+        """
+        requester.RequestClient.__init__(self, name, url, **kwargs)
+        self.stall_after = stall_after
+        self.last_sent = None
+
+    def schedule(self, kind, start=None):
+        start = self.start if start is None else start
+        for when in requester.RequestClient.schedule(self, kind, start):
+            if self.stall_after is not None and when - start >= self.stall_after:
+                return
+            yield when
+
+    def send_request(self, signal, data, intended=None, kind=None):
+        # a client that crashed doesn't say goodbye
+        if signal == 2 and data == "Goodbye." and self.stall_after is not None:
+            return
+        r = requester.RequestClient.send_request(self, signal, data, intended, kind)
+        self.last_sent = time.time()
+        return r
+
+    def report_schedule(self):
+        # the harness reports lateness from the "scheduled" histograms instead of a log line per client
+        self.send_times = []
+
+
+class SyntheticClient(FleetClient):
+    """ Sends its payload as data instead of writing it to disk, and never sends process info, so one
+    process can run hundreds of them.
+    """
+
+    def __init__(self, name, url, payload_size, **kwargs):
+        """
+        :param int payload_size: how many bytes of data to send each time
+        """
+        FleetClient.__init__(self, name, url, **kwargs)
+        self.payload = "x" * payload_size
+
+    def write_chunk(self, intended=None):
+        self.send_request(signal=1, data=self.payload, intended=intended, kind="data")
+
+    def finish_data(self):
+        pass
+
+
+def make_clients(names, url, run, settings):
+    """ Make the clients for one fleet process.
+    :param list names: (name, whether it should stall) for each client
+    :param str url: the server
+    :param dict run: this run's client count, heartbeat rate and payload size
+    :param dict settings: the rest of the config
+    :return list: the clients
+    """
+    arrival = settings.get("arrival", "fixed")
+    duration = settings["duration"]
+    data_rate = settings.get("data_rate", 0)
+    workload = {"heartbeat": {"kind": arrival, "interval": 1.0 / run["heartbeat_rate"]},
+                # an interval longer than the run means never
+                "data": {"kind": arrival, "interval": 1.0 / data_rate if data_rate else duration + 1},
+                "monitor": {"kind": "fixed", "interval": settings.get("report_interval", duration + 1)}}
+    clients = []
+    for name, stalls in names:
+        options = dict(runtime=duration, file_size=run["payload_size"] * 10, data_interval=1,
+                       rollovers=0, batch_window=settings.get("batch_window", 0),
+                       wire_format=settings.get("wire_format", "json"), workload=workload,
+                       adaptive_heartbeats=settings.get("adaptive_heartbeats", True),
+                       stall_after=settings.get("stall_after", duration / 2.0) if stalls else None)
+        if settings.get("driver", "synthetic") == "synthetic":
+            clients.append(SyntheticClient(name, url, run["payload_size"], chunk_size=10000000, **options))
+        else:
+            clients.append(FleetClient(name, url, chunk_size=run["payload_size"], **options))
+    return clients
+
+
+def run_fleet(names, url, run, settings, directory, results):
+    """ What each fleet process runs: its share of the clients, on an event loop, and then what they
+    measured goes back on the results queue.
+    """
+    # RequestClients write their data files wherever we are
+    os.chdir(directory)
+    requester.asynclog.configure(requester.log, every=settings.get("client_log_every"))
+    clients = make_clients(names, url, run, settings)
+    offsets = requester.launch_offsets(len(clients), "linear", ramp=settings.get("ramp", 0))
+    requester.EventLoopEngine(clients, workers=settings.get("engine_workers", 8), offsets=offsets).run()
+    merged = latency.merge_all([client.latency_dump() for client in clients])
+    results.put({"latencies": latency.dump(merged),
+                 "quiet": [client.last_sent for client in clients if client.stall_after is not None]})
+
+
+def collect(jobs, results, deadline):
+    """ Wait for every fleet process to send back what it measured.
+    :param list jobs: the fleet processes
+    :param multiprocessing.Queue results: the queue they were given
+    :param float deadline: when to give up on them
+    :return list: what each one sent, or None if one of them died or they ran out of time
+    """
+    done = []
+    while len(done) < len(jobs):
+        # a fleet that crashed is never going to send anything
+        if time.time() >= deadline or any(job.exitcode for job in jobs):
+            return
+        try:
+            done.append(results.get(timeout=min(1, max(deadline - time.time(), 0.01))))
+        except Queue.Empty:
+            pass
+    return done
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def scrape(url):
+    """ Read the unlabelled numbers off the server's /metrics page.
+    :param str url: the server
+    :return dict: metric name -> value
+    """
+    values = {}
+    for line in requests.get(url + "/metrics", timeout=5).text.splitlines():
+        if line.startswith("#") or "{" in line or not line.strip():
+            continue
+        name, value = line.rsplit(None, 1)
+        values[name] = float(value)
+    return values
+
+
+class Server(object):
+    """ FlaskServer.py running in its own scratch directory, with our config.
+    """
+
+    def __init__(self, directory, overrides):
+        """
+        :param str directory: where the server's config, logs and data files go
+        :param dict overrides: settings to change from FlaskServer_config.json
+        """
+        with open(os.path.join(HERE, "FlaskServer_config.json")) as c:
+            config = json.load(c)
+        config.update(overrides)
+        self.port = config["port"] = config["port"] or free_port()
+        with open(os.path.join(directory, "FlaskServer_config.json"), "w") as c:
+            json.dump(config, c)
+        self.directory = directory
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        self.popen = None
+
+    def start(self, wait=30):
+        """ Start the server, and wait until it answers.
+        :param float wait: how long to give it, in seconds
+        """
+        output = open(os.path.join(self.directory, "server.out"), "w")
+        self.popen = subprocess.Popen([sys.executable, os.path.join(HERE, "FlaskServer.py")],
+                                      cwd=self.directory, stdout=output, stderr=subprocess.STDOUT)
+        output.close()
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            try:
+                if requests.get(self.url, timeout=1).status_code == 200:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.1)
+        self.stop()
+        raise requester.FlaskServerNotUp
+
+    def processes(self):
+        """ The server's process and everything it forked.
+        :return list: psutil.Process for each
+        """
+        try:
+            main = psutil.Process(self.popen.pid)
+            return [main] + main.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+
+    def stop(self):
+        for proc in reversed(self.processes()):
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                pass
+        self.popen.wait()
+
+
+class ServerWatcher(threading.Thread):
+    """ Samples the server's CPU and memory, and its count of failed clients, until told to stop.
+    """
+
+    def __init__(self, server, interval=0.25):
+        """
+        :param Server server: the server to watch
+        :param float interval: seconds between samples
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.interval = interval
+        self.stopping = threading.Event()
+        # (time, cpu seconds so far, rss) for each sample
+        self.samples = []
+        # when the failed client count first reached 1, 2, 3...
+        self.failures = []
+
+    def run(self):
+        # a process which exits takes its cpu time with it, so keep the last we saw of every one
+        cpu = {}
+        while not self.stopping.is_set():
+            rss = 0
+            for proc in self.server.processes():
+                try:
+                    times = proc.cpu_times()
+                    cpu[proc.pid] = times.user + times.system
+                    rss += proc.memory_info().rss
+                except psutil.NoSuchProcess:
+                    continue
+            now = time.time()
+            self.samples.append((now, sum(cpu.values()), rss))
+            try:
+                failed = int(scrape(self.server.url).get("server_failed_clients", 0))
+            except (requests.RequestException, ValueError):
+                failed = len(self.failures)
+            while len(self.failures) < failed:
+                self.failures.append(now)
+            self.stopping.wait(self.interval)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def usage(self):
+        """ Sum up the samples.
+        :return dict: mean and max CPU (in percent of one core) and max RSS (in MB, summed over the
+        server's processes, so shared memory gets counted more than once)
+        """
+        if len(self.samples) < 2:
+            return {}
+        rates = [100.0 * (cpu - last_cpu) / (now - last_now)
+                 for (last_now, last_cpu, _), (now, cpu, _) in zip(self.samples, self.samples[1:])]
+        (first, first_cpu, _), (last, last_cpu, _) = self.samples[0], self.samples[-1]
+        return {"cpu_percent_mean": 100.0 * (last_cpu - first_cpu) / (last - first),
+                "cpu_percent_max": max(rates),
+                "rss_mb_max": max(rss for _, _, rss in self.samples) / 1e6}
+
+
+def run_once(run, settings):
+    """ Start a server, run one fleet against it, and stop it again.
+    :param dict run: the client count, heartbeat rate and payload size
+    :param dict settings: the rest of the config
+    :return dict: the run and what we measured
+    """
+    directory = tempfile.mkdtemp(prefix="loadbench-")
+    overrides = {"port": settings.get("port", 0), "timeout": settings.get("server_timeout", 5),
+                 # we stop the server ourselves
+                 "final_wait": 3600}
+    overrides.update(settings.get("server", {}))
+    server = Server(directory, overrides)
+    try:
+        server.start()
+        watcher = ServerWatcher(server)
+        watcher.start()
+
+        count = run["clients"]
+        stalled = min(settings.get("stalled", 0), count)
+        names = [("bench{}".format(i), i < stalled) for i in range(count)]
+        fleets = max(1, min(settings.get("fleets", 2), count))
+        results = multiprocessing.Queue()
+        jobs = [multiprocessing.Process(target=run_fleet, args=(names[i::fleets], server.url, run, settings,
+                                                                directory, results))
+                for i in range(fleets)]
+
+        before = scrape(server.url)
+        start = time.time()
+        for job in jobs:
+            job.start()
+        # the queue has to be emptied before the jobs can finish
+        deadline = start + settings["duration"] + settings.get("ramp", 0) + settings.get("fleet_grace", 60)
+        done = collect(jobs, results, deadline)
+        if done is None:
+            for job in jobs:
+                job.terminate()
+                job.join()
+            watcher.stop()
+            failed = "only {} of {} fleets finished".format(len([job for job in jobs if job.exitcode == 0]),
+                                                            len(jobs))
+            requester.log.error("Benchmark {} failed: {}".format(run, failed))
+            return dict(run, failed=failed)
+        for job in jobs:
+            job.join()
+        elapsed = time.time() - start
+        after = scrape(server.url)
+
+        # give the server long enough to notice everyone who went quiet
+        quiet = sorted(when for fleet in done for when in fleet["quiet"] if when is not None)
+        deadline = time.time() + overrides["timeout"] * 3 + 10
+        while len(watcher.failures) < len(quiet) and time.time() < deadline:
+            time.sleep(0.25)
+        watcher.stop()
+    finally:
+        server.stop()
+        if not settings.get("keep", False):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    requests_handled = after["server_requests_total"] - before["server_requests_total"]
+    report = latency.report(latency.merge_all([fleet["latencies"] for fleet in done]))
+    detected = watcher.failures[:len(quiet)]
+    result = dict(run)
+    result.update({"duration_s": elapsed,
+                   "server_requests": requests_handled,
+                   "server_rps": requests_handled / elapsed,
+                   "latency": report,
+                   "server": watcher.usage(),
+                   "timeouts": {"stalled": len(quiet), "detected": len(detected)}})
+    if detected:
+        # nth to be noticed against nth to go quiet, since we don't know which was which
+        lags = [found - went for went, found in zip(quiet, detected)]
+        result["timeouts"].update({"detect_s_min": min(lags), "detect_s_max": max(lags),
+                                   "detect_s_mean": sum(lags) / len(lags)})
+    return result
+
+
+def commit():
+    """ The git commit we're benchmarking, if we can tell.
+    :return str: the commit hash, or None
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+
+def sweep(settings):
+    """ Run every combination of client count, heartbeat rate and payload size.
+    :param dict settings: the config
+    :return dict: the results, with enough about where they came from to compare them later
+    """
+    runs = []
+    for clients, rate, size in itertools.product(settings["clients"], settings["heartbeat_rates"],
+                                                 settings["payload_sizes"]):
+        run = {"clients": clients, "heartbeat_rate": rate, "payload_size": size}
+        requester.log.warning("Benchmarking {}".format(run))
+        runs.append(run_once(run, settings))
+        print format_run(runs[-1])
+    return {"commit": commit(), "started": time.time(), "python": platform.python_version(),
+            "config": settings, "runs": runs}
+
+
+def format_run(result):
+    if result.get("failed"):
+        return "{clients:>6} clients {heartbeat_rate:>6} hb/s {payload_size:>8} B: failed, {failed}".format(
+            **result)
+    heartbeat = result["latency"].get("heartbeat", {}).get("round_trip", {})
+    return ("{clients:>6} clients {heartbeat_rate:>6} hb/s {payload_size:>8} B: {rps:>9,.0f} requests/sec, "
+            "heartbeat p50 {p50} p99 {p99}, cpu {cpu}%, timeouts noticed in {detect}s".format(
+                rps=result["server_rps"],
+                p50=ms(heartbeat.get("p50")), p99=ms(heartbeat.get("p99")),
+                cpu=round(result["server"].get("cpu_percent_mean", 0), 1),
+                detect=round(result["timeouts"].get("detect_s_max", float("nan")), 2), **result))
+
+
+def ms(seconds):
+    return "-" if seconds is None else "{:.2f}ms".format(seconds * 1000)
+
+
+def compare(old, new, tolerance=0.1):
+    """ Find the runs that got worse between two result files.
+    :param dict old: results from before
+    :param dict new: results from after
+    :param float tolerance: how much worse counts as a regression, as a fraction
+    :return list: (run, what got worse, old value, new value) for everything that did
+    """
+    def key(run):
+        return run["clients"], run["heartbeat_rate"], run["payload_size"]
+
+    before = dict((key(run), run) for run in old["runs"])
+    regressions = []
+    for run in new["runs"]:
+        previous = before.get(key(run))
+        if previous is None or previous.get("failed"):
+            continue
+        if run.get("failed"):
+            regressions.append((key(run), "failed", None, run["failed"]))
+            continue
+        # bigger is better for throughput, and worse for everything else
+        checks = [("server_rps", previous["server_rps"], run["server_rps"], -1)]
+        for kind in ("heartbeat", "data"):
+            for name in ("p50", "p99"):
+                was = previous["latency"].get(kind, {}).get("round_trip", {}).get(name)
+                now = run["latency"].get(kind, {}).get("round_trip", {}).get(name)
+                checks.append(("{} {}".format(kind, name), was, now, 1))
+        checks.append(("cpu_percent_mean", previous["server"].get("cpu_percent_mean"),
+                       run["server"].get("cpu_percent_mean"), 1))
+        checks.append(("detect_s_max", previous["timeouts"].get("detect_s_max"),
+                       run["timeouts"].get("detect_s_max"), 1))
+        for name, was, now, worse in checks:
+            if was and now is not None and (now - was) * worse > abs(was) * tolerance:
+                regressions.append((key(run), name, was, now))
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as f:
+            old = json.load(f)
+        with open(sys.argv[3]) as f:
+            new = json.load(f)
+        regressions = compare(old, new)
+        for run, name, was, now in regressions:
+            print "{} clients, {} heartbeats/sec, {} byte payloads: {} went from {} to {}".format(
+                run[0], run[1], run[2], name, was, now)
+        if not regressions:
+            print "No regressions."
+        sys.exit(1 if regressions else 0)
+
+    with open(sys.argv[1] if len(sys.argv) > 1 else "loadbench_config.json") as c:
+        config = json.load(c)
+    results = sweep(config)
+    with open(config.get("output", "loadbench_results.json"), "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
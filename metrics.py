@@ -0,0 +1,116 @@
+import bisect
+
+from CustomFlask import ShardedCounter
+
+# in seconds; request handling should be way down at the small end of these
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0)
+
+# in seconds; how long clients take to write a chunk to disk, or roll over to a new file
+IO_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+              2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """ Counts how many observations fall into each bucket, plus their total, in a ShardedCounter so
+    any thread in any server process can observe without taking a lock.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param tuple buckets: the upper bounds of each bucket, smallest first
+        """
+        self.buckets = buckets
+        # one number per bucket, one for everything bigger, and the sum in microseconds
+        self.counts = ShardedCounter(0, size=len(buckets) + 2)
+        self.sum_index = len(buckets) + 1
+
+    def observe(self, value):
+        """ Record one observation.
+        :param float value: what we observed, in seconds
+        """
+        self.counts.increment(1, bisect.bisect_left(self.buckets, value))
+        self.counts.increment(int(value * 1000000), self.sum_index)
+
+    def snapshot(self):
+        """ Get the current counts.
+        :return (list, float): the count in each bucket (the last one is everything bigger), and the sum
+        """
+        values = self.counts.values()
+        return values[:self.sum_index], values[self.sum_index] / 1000000.0
+
+
+def bucket_counts(values, buckets):
+    """ Sort a bunch of values into buckets, for things we measure all at once instead of as they happen.
+    :param list values: the values
+    :param tuple buckets: the upper bounds of each bucket, smallest first
+    :return (list, float): the count in each bucket (the last one is everything bigger), and the sum
+    """
+    counts = [0] * (len(buckets) + 1)
+    for value in values:
+        counts[bisect.bisect_left(buckets, value)] += 1
+    return counts, float(sum(values))
+
+
+def histogram_percentile(buckets, counts, q):
+    """ Estimate a percentile from bucket counts, as the upper bound of the bucket it falls in.
+    :param tuple buckets: the upper bounds of each bucket, smallest first
+    :param list counts: the count in each bucket, with everything bigger last
+    :param float q: the percentile, from 0 to 100
+    :return float: the estimate (inf if it's past the last bucket), or None if there are no counts
+    """
+    total = sum(counts)
+    if not total:
+        return
+    target = q / 100.0 * total
+    running = 0
+    for bound, count in zip(buckets + (float('inf'),), counts):
+        running += count
+        if running >= target:
+            return bound
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return u''
+    return u'{' + u','.join(u'{}="{}"'.format(key, escape(value))
+                            for key, value in sorted(labels.items())) + u'}'
+
+
+def format_metric(name, kind, help_text, samples):
+    """ Write out a counter or gauge in the Prometheus text format.
+    :param str name: the metric name
+    :param str kind: "counter" or "gauge"
+    :param str help_text: what it means
+    :param list samples: (labels dict, value) pairs
+    :return list: the lines
+    """
+    lines = ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+    for labels, value in samples:
+        lines.append(u'{}{} {}'.format(name, format_labels(labels), value))
+    return lines
+
+
+def format_histogram(name, help_text, buckets, series):
+    """ Write out a histogram in the Prometheus text format.
+    :param str name: the metric name
+    :param str help_text: what it means
+    :param tuple buckets: the upper bounds of each bucket
+    :param list series: (labels dict, counts, sum), with counts and sum like Histogram.snapshot
+    :return list: the lines
+    """
+    lines = ['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)]
+    for labels, counts, total in series:
+        # prometheus buckets are cumulative
+        running = 0
+        for bound, count in zip(buckets + ('+Inf',), counts):
+            running += count
+            bucket_labels = dict(labels, le=bound)
+            lines.append(u'{}_bucket{} {}'.format(name, format_labels(bucket_labels), running))
+        lines.append(u'{}_sum{} {}'.format(name, format_labels(labels), total))
+        lines.append(u'{}_count{} {}'.format(name, format_labels(labels), running))
+    return lines
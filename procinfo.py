@@ -0,0 +1,274 @@
+""" Process info records, shared by the clients (which sample them) and the server (which stores them).
+
+A record is a fixed layout struct, so it's small on the wire (base64 inside the usual JSON request) and
+every record in a client's .proc file is the same size. That means you can jump straight to record n,
+or binary search by time, without reading the whole file.
+
+There are two kinds: a ProcRecord is one sample, and a WindowRecord sums up lots of samples taken
+by a ProcSampler between two reports. Each kind has its own size, which is how decode tells them apart,
+and its own file on the server.
+"""
+import base64
+import binascii
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import psutil
+
+FIELDS = ("time", "cpu_user", "cpu_system", "rss", "vms", "read_count", "write_count", "read_bytes",
+          "write_bytes", "ctx_voluntary", "ctx_involuntary", "num_threads")
+ProcRecord = namedtuple("ProcRecord", FIELDS)
+LAYOUT = struct.Struct("<3d8QI")
+
+# cpu is in percent of one core, rss in bytes; the deltas are from the last sample before the window
+WINDOW_FIELDS = ("start", "end", "samples", "cpu_min", "cpu_mean", "cpu_max", "rss_min", "rss_max",
+                 "rss_mean", "rss_delta", "read_bytes_delta", "write_bytes_delta", "ctx_switches_delta",
+                 "num_threads")
+WindowRecord = namedtuple("WindowRecord", WINDOW_FIELDS)
+WINDOW_LAYOUT = struct.Struct("<2dI3d2Qdq3QI")
+
+# the struct that goes with each kind of record, and the extension of the file the server keeps it in
+KINDS = {ProcRecord: (LAYOUT, "proc"), WindowRecord: (WINDOW_LAYOUT, "window")}
+
+
+def sample(pid, now):
+    """ Gather a record for a process. Raises psutil.NoSuchProcess if the process has gone.
+    :param pid: the process to look at, or a psutil.Process for it so we don't have to look it up again
+    :param float now: the time to stamp on the record
+    :return ProcRecord: the record
+    """
+    p = pid if isinstance(pid, psutil.Process) else psutil.Process(pid)
+
+    # this is so we don't have to query the process multiple times for data. !
+    with p.oneshot():
+        cputime = p.cpu_times()
+        meminfo = p.memory_info()
+        ctx = p.num_ctx_switches()
+        threads = p.num_threads()
+        try:
+            io = p.io_counters()
+            io = (io.read_count, io.write_count, io.read_bytes, io.write_bytes)
+        except (AttributeError, NotImplementedError, psutil.AccessDenied):
+            # not every OS will tell us this (OSX won't)
+            io = (0, 0, 0, 0)
+    return ProcRecord(now, cputime.user, cputime.system, meminfo.rss, meminfo.vms, io[0], io[1], io[2],
+                      io[3], ctx.voluntary, ctx.involuntary, threads)
+
+
+def extension(record):
+    """ :return str: the extension of the file the server keeps this kind of record in """
+    return KINDS[type(record)][1]
+
+
+def pack(record):
+    """ :return str: the record as bytes """
+    return KINDS[type(record)][0].pack(*record)
+
+
+def unpack(data, offset=0, kind=ProcRecord):
+    """ :return: the record of the given kind in the bytes at offset """
+    return kind(*KINDS[kind][0].unpack_from(data, offset))
+
+
+def encode(record):
+    """ :return str: the record as base64, so it can go in a JSON request """
+    return base64.b64encode(pack(record))
+
+
+def decode(text):
+    """ Turn what encode made back into a record.
+    :param text: the base64 record
+    :return: a ProcRecord or WindowRecord, or None if that isn't what it was
+    """
+    if not isinstance(text, basestring):
+        return
+    try:
+        data = base64.b64decode(text)
+    except (TypeError, binascii.Error, UnicodeEncodeError):
+        # non-ASCII text can't be base64 either
+        return
+    for kind, (layout, _) in KINDS.items():
+        if len(data) == layout.size:
+            return unpack(data, kind=kind)
+
+
+def read_records(path, start=None, end=None, kind=ProcRecord):
+    """ Read the records in a .proc (or .window) file, optionally just the ones in a time range.
+    :param str path: the file
+    :param float start: the earliest time to include
+    :param float end: the latest time to include
+    :param kind: ProcRecord or WindowRecord, whichever the file holds
+    :return list: the records
+    """
+    return read_range(path, KINDS[kind][0], kind, start, end)
+
+
+def read_range(path, layout, kind, start=None, end=None):
+    """ Read fixed size records out of a file, optionally just the ones in a time range. Records are
+    appended in time order, so the range is found by binary search instead of reading everything.
+    :param str path: the file
+    :param struct.Struct layout: the layout of each record, with the time first
+    :param kind: the namedtuple to make each record into
+    :param float start: the earliest time to include
+    :param float end: the latest time to include
+    :return list: the records
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        count = os.fstat(f.fileno()).st_size // layout.size
+
+        def time_at(index):
+            f.seek(index * layout.size)
+            return layout.unpack(f.read(layout.size))[0]
+
+        def first_at_or_after(when):
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if time_at(middle) < when:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+
+        first = 0 if start is None else first_at_or_after(start)
+        last = count if end is None else first_at_or_after(end + 1e-9)
+        f.seek(first * layout.size)
+        data = f.read((last - first) * layout.size)
+    return [kind(*layout.unpack_from(data, i * layout.size)) for i in range(last - first)]
+
+
+def read_column(path, field, kind=ProcRecord):
+    """ Read one field out of every record in a .proc (or .window) file.
+    :param str path: the file
+    :param str field: which field, from FIELDS (or WINDOW_FIELDS)
+    :param kind: ProcRecord or WindowRecord, whichever the file holds
+    :return list: the values, in time order
+    """
+    index = kind._fields.index(field)
+    return [record[index] for record in read_records(path, kind=kind)]
+
+
+class Window(object):
+    """ Running min/max/mean of the samples a ProcSampler has taken since the last take().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # the last sample before this window, which the deltas are measured from
+        self.baseline = None
+        self.reset()
+
+    def reset(self):
+        self.start = None
+        self.last = None
+        self.samples = 0
+        self.cpu_min = self.cpu_max = self.cpu_total = 0.0
+        self.rss_min = self.rss_max = self.rss_total = 0
+
+    def add(self, record, cpu_percent):
+        """ Fold one sample into the window.
+        :param ProcRecord record: the sample
+        :param float cpu_percent: cpu use since the sample before it
+        """
+        with self.lock:
+            if self.baseline is None:
+                self.baseline = record
+            if not self.samples:
+                self.start = record.time
+                self.cpu_min = self.cpu_max = cpu_percent
+                self.rss_min = self.rss_max = record.rss
+            self.samples += 1
+            self.cpu_min = min(self.cpu_min, cpu_percent)
+            self.cpu_max = max(self.cpu_max, cpu_percent)
+            self.cpu_total += cpu_percent
+            self.rss_min = min(self.rss_min, record.rss)
+            self.rss_max = max(self.rss_max, record.rss)
+            self.rss_total += record.rss
+            self.last = record
+
+    def take(self):
+        """ Sum up the window and start a new one.
+        :return WindowRecord: the summary, or None if there haven't been any samples
+        """
+        with self.lock:
+            if not self.samples:
+                return
+            first, last = self.baseline, self.last
+            record = WindowRecord(self.start, last.time, self.samples, self.cpu_min,
+                                  self.cpu_total / self.samples, self.cpu_max, self.rss_min, self.rss_max,
+                                  float(self.rss_total) / self.samples, last.rss - first.rss,
+                                  max(last.read_bytes - first.read_bytes, 0),
+                                  max(last.write_bytes - first.write_bytes, 0),
+                                  max(last.ctx_voluntary + last.ctx_involuntary - first.ctx_voluntary
+                                      - first.ctx_involuntary, 0),
+                                  last.num_threads)
+            self.baseline = last
+            self.reset()
+            return record
+
+
+class ProcSampler(object):
+    """ Samples a process in its own thread, as often as every few tens of milliseconds, and works out
+    cpu % from each pair of samples. Samples are only kept as running numbers in each subscribed Window,
+    so sampling fast costs no memory, and only the summaries go over the network.
+    """
+
+    def __init__(self, pid, interval, log):
+        """
+        :param int pid: the process to sample
+        :param float interval: seconds between samples
+        :param logging.Logger log: where to log
+        """
+        self.pid = pid
+        self.interval = interval
+        self.log = log
+        self.windows = []
+        self.previous = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def subscribe(self):
+        """ :return Window: a window which gets every sample from now on """
+        window = Window()
+        self.windows.append(window)
+        return window
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """ Sample until we're stopped or the process goes away.
+        """
+        try:
+            # the process can be gone before we even start
+            process = psutil.Process(self.pid)
+            while not self.stopped.is_set():
+                self.add(sample(process, time.time()))
+                self.stopped.wait(self.interval)
+        except psutil.NoSuchProcess:
+            self.log.info("Stopped sampling process {}, it has exited.".format(self.pid))
+
+    def add(self, record):
+        """ Hand a sample to every window.
+        :param ProcRecord record: the sample
+        """
+        previous, self.previous = self.previous, record
+        if previous is None or record.time <= previous.time:
+            # need two samples to say anything about cpu
+            return
+        busy = record.cpu_user + record.cpu_system - previous.cpu_user - previous.cpu_system
+        cpu_percent = 100.0 * busy / (record.time - previous.time)
+        for window in self.windows:
+            window.add(record, cpu_percent)
@@ -5,32 +5,33 @@ import json
 import multiprocessing
 import psutil
 import os
+import heapq
+import itertools
+import threading
+import Queue
+import mmap
+import struct
+import random
+
+import procinfo
+import wire
+import asynclog
+import latency
 
 # TODO: Request headers!
 # TODO: Unit Tests!
-# TODO: Log different clients to different logfiles
 # TODO: configurable log location
-# TODO: Parse psutil info better
-
-
-log = logging.getLogger('client_app')
-log.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-fh = logging.FileHandler('client.log', mode='w')
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-log.addHandler(fh)
-
-ch = logging.StreamHandler()
-ch.setLevel(logging.WARNING)
-ch.setFormatter(formatter)
-log.addHandler(ch)
 
+# everything goes to client.log on a writer thread. each client logs through its own child of this
+# logger (client_app.<name>), so log_per_client in the config can give every client its own file too
+log = asynclog.setup('client_app', 'client.log', console_level=logging.WARNING)
 
 log.info("Logger for clients")
 
 STATUS_UP_CODES = [200, 201, 202, 203, 204, 205, 206]
+# the server is up, but too busy for us right now
+STATUS_BUSY_CODES = [429, 503]
 
 
 # Helper functions!
@@ -97,6 +98,134 @@ def write_and_roll(write_file, base_name, chunk_size, max_size, gen):
     return current_file, rolling
 
 
+# payloads are big, so every DataWriter on a thread with the same chunk size shares one. not across
+# threads though: each write stamps the payload first, and another thread could stamp it again mid-write
+payloads = threading.local()
+
+
+def get_payload(chunk_size, aligned):
+    """ Get this thread's buffer of random data for this chunk size, making it if we have to.
+    :param int chunk_size: how big the buffer is
+    :param bool aligned: whether it needs to start on a page boundary (for O_DIRECT)
+    :return: a writable buffer (bytearray, or mmap if aligned)
+    """
+    mine = payloads.__dict__.setdefault("by_size", {})
+    if (chunk_size, aligned) not in mine:
+        if aligned:
+            # anonymous mmaps always start on a page
+            payload = mmap.mmap(-1, chunk_size)
+            payload.write(os.urandom(chunk_size))
+        else:
+            payload = bytearray(os.urandom(chunk_size))
+        mine[(chunk_size, aligned)] = payload
+    return mine[(chunk_size, aligned)]
+
+
+class DataWriter(object):
+    """ Writes chunks of data and rolls over files exactly like write_and_roll, but fast enough to use
+    for real disk throughput testing.
+
+    The random payload is made once per thread instead of on every write, and every 4KB block of it gets
+    stamped with a write counter, so blocks on disk don't repeat (no cheating by dedupe or compression).
+    The current file stays open and we keep track of its size ourselves, rather than reopening and
+    stat-ing it for every chunk.
+    """
+    # how far apart to stamp the payload, and how big the stamp is
+    BLOCK = 4096
+    STAMP = struct.Struct('<Q')
+
+    def __init__(self, base_name, chunk_size, max_size, gen=None, fsync="never", direct=False):
+        """
+        :param str base_name: the naming schema for the files
+        :param int chunk_size: the number of bytes written at a time
+        :param int max_size: the max size of the files
+        :param generator gen: the generator which counts up files (one from files_gen if not given)
+        :param str fsync: "never", "write" to fsync after every chunk, or "rollover" to fsync each file
+        as we finish with it
+        :param bool direct: open files with O_DIRECT to skip the page cache, if the OS and chunk size
+        allow it (chunks have to be a multiple of 4KB)
+        """
+        assert isinstance(chunk_size, int)
+        assert fsync in ("never", "write", "rollover")
+        self.base_name = base_name
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.gen = gen or files_gen(base_name)
+        self.fsync = fsync
+        self.direct = direct and hasattr(os, 'O_DIRECT') and chunk_size % self.BLOCK == 0
+        if direct and not self.direct:
+            log.warning("Can't use O_DIRECT for {} with a chunk size of {}; using normal writes."
+                        .format(base_name, chunk_size))
+
+        self.writes = 0
+        self.current_file = None
+        self.fd = None
+        self.size = 0
+        # how long the last rollover took to close the old file and open the new one
+        self.last_rollover = 0
+
+    def open(self, path):
+        """ Open a file to append to, picking up its size in case it already has stuff in it.
+        :param str path: the file to open
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if self.direct:
+            try:
+                self.fd = os.open(path, flags | os.O_DIRECT, 0o644)
+            except OSError as e:
+                log.warning("Can't open {} with O_DIRECT ({}); using normal writes.".format(path, e))
+                self.direct = False
+        if not self.direct:
+            self.fd = os.open(path, flags, 0o644)
+        self.current_file = path
+        self.size = os.fstat(self.fd).st_size
+        if self.direct and self.size % self.BLOCK:
+            # O_DIRECT appends have to start on a block boundary, so every write to this file would fail
+            log.warning("{} is {} bytes, not a whole number of blocks; using normal writes for it."
+                        .format(path, self.size))
+            os.close(self.fd)
+            self.fd = os.open(path, flags, 0o644)
+
+    def close(self):
+        """ Close the current file, syncing it first if that's the policy.
+        """
+        if self.fd is None:
+            return
+        if self.fsync == "rollover":
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    def write(self):
+        """ Write one chunk, rolling over to the next file first if this chunk won't fit.
+        :return (str, bool): the file we wrote to, and whether we rolled over to get there
+        """
+        rolling = False
+        if self.fd is None:
+            self.open(next(self.gen))
+        elif self.size > self.max_size - self.chunk_size:
+            start = time.time()
+            self.close()
+            self.open(next(self.gen))
+            self.last_rollover = time.time() - start
+            rolling = True
+
+        self.writes += 1
+        # a writer can be handed from one sender thread to another, so get the payload for this one
+        payload = get_payload(self.chunk_size, self.direct)
+        for offset in range(0, self.chunk_size - self.STAMP.size + 1, self.BLOCK):
+            self.STAMP.pack_into(payload, offset, self.writes)
+
+        written = 0
+        while written < self.chunk_size:
+            # buffer rather than memoryview, since an mmap doesn't have the new buffer interface
+            written += os.write(self.fd, buffer(payload, written))
+        self.size += written
+        if self.fsync == "write":
+            os.fsync(self.fd)
+        return self.current_file, rolling
+
+
 def assert_rollover(chunk_size, max_size, interval, runtime, desired_rollovers=2):
     # move over once, move over twice
     # come on honey don't be cold as ice
@@ -119,23 +248,27 @@ def assert_rollover(chunk_size, max_size, interval, runtime, desired_rollovers=2
         return False
 
 
+def percentile(sorted_values, q):
+    """ Pick the value at a percentile, nearest rank style.
+    :param list sorted_values: the values, smallest first
+    :param float q: the percentile, from 0 to 100
+    :return: the value, or None if there aren't any
+    """
+    if not sorted_values:
+        return
+    rank = int(round(q / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
 def get_proc_info(proc):
     """ Given a process, gather some information on it so we can send this to the server
     :param MultiProcessing.Process proc: Process to monitor
-    :return (cputime, meminfo): returns None, if the PID has gone; returns process info otherwise
+    :return procinfo.ProcRecord: returns None, if the PID has gone; returns process info otherwise
     """
     if not proc.pid:
         return
     try:
-        p = psutil.Process(proc.pid)
-
-        # this is so we don't have to query the process multiple times for data. !
-        with p.oneshot():
-            cputime = p.cpu_times()
-            # memory_info probably returns something different between OSX and linux
-            # so we'll have to be careful
-            meminfo = p.memory_info()
-            return cputime, meminfo
+        return procinfo.sample(proc.pid, time.time())
 
     # since the process we are monitoring only runs for a while, we expect that sometimes it will exit
     # in between when we first check for it and when we query for information
@@ -150,123 +283,864 @@ def get_proc_info(proc):
         raise
 
 
+def arrivals(spec, start, rng=None):
+    """ Generate the times something is meant to happen at. This is open loop: when one send finishes
+    has no say in when the next one is due, so a slow server shows up as us running late (which we
+    record) rather than quietly slowing the load down.
+    :param dict spec: {"kind": "fixed", "interval": seconds between sends},
+    {"kind": "poisson", "interval": mean seconds between sends}, or
+    {"kind": "burst", "interval": seconds between sends in a burst, "burst": sends per burst,
+    "idle": seconds between bursts}
+    :param float start: when to count from
+    :param random.Random rng: where poisson gets its randomness
+    :return generator: the times, in order
+    """
+    kind = spec.get("kind", "fixed")
+    interval = spec["interval"]
+    rng = rng or random.Random()
+    if kind not in ("fixed", "poisson", "burst"):
+        raise ValueError("Unknown workload kind {}. Use fixed, poisson or burst.".format(kind))
+
+    def times():
+        when = start
+        while True:
+            if kind == "fixed":
+                when += interval
+                yield when
+            elif kind == "poisson":
+                when += rng.expovariate(1.0 / interval)
+                yield when
+            else:
+                for _ in range(spec.get("burst", 1)):
+                    when += interval
+                    yield when
+                when += spec.get("idle", 0)
+    return times()
+
+
+def schedule_report(records):
+    """ Sum up how far behind schedule we were. Lag is how late we started each send; latency counts
+    from when the send was meant to start, so time spent waiting behind a slow request still counts;
+    service is what a closed loop measurement would have said.
+    :param list records: (kind, intended, actual, done) for each send; done is None if it was batched
+    :return dict: kind -> count and p50/p99 of each, in seconds
+    """
+    report = {}
+    for kind in sorted(set(record[0] for record in records)):
+        mine = [record for record in records if record[0] == kind]
+        lags = sorted(actual - intended for _, intended, actual, done in mine)
+        latencies = sorted(done - intended for _, intended, actual, done in mine if done is not None)
+        service = sorted(done - actual for _, intended, actual, done in mine if done is not None)
+        report[kind] = {"count": len(mine),
+                        "lag_p50": percentile(lags, 50), "lag_p99": percentile(lags, 99),
+                        "latency_p50": percentile(latencies, 50), "latency_p99": percentile(latencies, 99),
+                        "service_p50": percentile(service, 50), "service_p99": percentile(service, 99)}
+    return report
+
+
+def sleep_until(when):
+    wait = when - time.time()
+    if wait > 0:
+        time.sleep(wait)
+
+
+def busy_delay(retry_after, backoff, busy, rng=None):
+    """ How long to wait after the server has told us it's too busy.
+    At least as long as it asked, doubling the backoff every time in a row it turns us away, and then a
+    random bit more so a whole fleet that got turned away at once doesn't all come back at once.
+    :param str retry_after: the Retry-After header, in seconds, if there was one
+    :param float backoff: the first backoff
+    :param int busy: how many times in a row we've been turned away
+    :param random.Random rng: where to get the random bit from
+    :return float: how long to wait, in seconds
+    """
+    try:
+        asked = float(retry_after)
+    except (TypeError, ValueError):
+        # it's allowed to be a date, but ours never is
+        asked = 0
+    return max(asked, backoff * 2 ** (busy - 1)) * (rng or random).uniform(1, 1.5)
+
+
 class FlaskServerNotUp(BaseException):
     pass
 
 
+# what kind of message the chatty log lines are, for log_every and log_per_second in the config
+HEARTBEAT = {"kind": "heartbeat"}
+DATA = {"kind": "data"}
+IO = {"kind": "io"}
+WRITE = {"kind": "write"}
+
+# what to call each signal in the latency report
+SIGNALS = ("heartbeat", "data", "client_info", "io")
+
+
 class RequestClient(object):
     """ A class for initializing a client which will send heartbeats, write data, and monitor the
     process which sends data.
     """
 
     def __init__(self, name, url, runtime=120, chunk_size=1000, file_size=1000, data_interval=10,
-                 rollovers=2):
+                 rollovers=2, batch_window=0, pool_size=2, retries=3, backoff=0.5, request_timeout=10,
+                 fsync="never", direct_io=False, io_report_every=10, sample_interval=0, report_interval=10,
+                 wire_format="json", workload=None, results=None, max_busy_wait=60,
+                 adaptive_heartbeats=True):
         self.name = name
+        self.log = logging.getLogger('client_app.{}'.format(name))
         self.runtime = runtime
         self.start = time.time()
         self.chunk_size = chunk_size
         if chunk_size < 10000000:
-            log.warning("The given chunk size for client {} is smaller than 10MB.".format(self.name))
+            self.log.warning("The given chunk size for client {} is smaller than 10MB.".format(self.name))
         self.file_size = file_size
         self.data_interval = data_interval
         self.url = url
+        self.batch_url = '{}/batch'.format(url.rstrip('/'))
+        # if this is more than 0, heartbeats and data get held for this many seconds and sent together
+        self.batch_window = batch_window
+        self.buffer = []
+        self.buffer_start = None
+        # "json", or "binary" for the smaller and quicker to parse frames in wire.py
+        self.wire_format = wire_format
+
+        # each process gets its own keep-alive session, so it isn't opening a new socket every request
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        # how long to keep at it when the server says it's too busy, before dropping what we're sending
+        self.max_busy_wait = max_busy_wait
+        self.request_timeout = request_timeout
+        self.session = None
+        self.session_pid = None
         self.rollovers = rollovers
         self.current_file = None
         self.end_data_tunnel = multiprocessing.Event()
 
         self.base_name = 'data_{}'.format(self.name)
         self.gen = files_gen(self.base_name)
+        # made the first time we write, so it's opened in whichever process does the writing
+        self.writer = None
+        self.fsync = fsync
+        self.direct_io = direct_io
+
+        # write timings, sent to the server every io_report_every writes
+        self.io_report_every = io_report_every
+        self.io_latencies = []
+        self.io_rollovers = []
+        self.io_bytes = 0
+
+        # with a sample_interval, the data writer gets sampled that often and every report_interval we
+        # send min/max/mean for the samples since the last report. without one, we send one sample.
+        self.sample_interval = sample_interval
+        self.report_interval = report_interval
+
+        # when to send heartbeats, write data and send process info. see arrivals for what goes in here
+        self.workload = {"heartbeat": {"kind": "fixed", "interval": 5},
+                         "data": {"kind": "fixed", "interval": data_interval},
+                         "monitor": {"kind": "fixed", "interval": report_interval}}
+        self.workload.update(workload or {})
+        for spec in self.workload.values():
+            arrivals(spec, 0)
+        # (kind, when it was meant to happen, when it did, when it finished) for everything on a schedule
+        self.send_times = []
+
+        # if the server tells us how often it wants to hear from us when we say hello, and it counts
+        # anything we send as a heartbeat, the heartbeat schedule only says when to check whether we need
+        # to send one. these are shared by all our processes, so the data and monitor processes sending
+        # things counts too
+        self.adaptive_heartbeats = adaptive_heartbeats
+        self.heartbeat_every = multiprocessing.RawValue('d', 0)
+        self.last_contact = multiprocessing.RawValue('d', 0)
+        self.heartbeats_skipped = 0
+        # kind -> part -> HdrHistogram of how long our requests took. each process sends its own back on
+        # the results queue when it's done, to be merged with everyone else's
+        self.latencies = {}
+        self.results = results
 
         if not assert_rollover(chunk_size=self.chunk_size,
                                max_size=self.file_size,
                                interval=self.data_interval,
                                runtime=self.runtime,
                                desired_rollovers=self.rollovers):
-            log.warning("The configuration for {} does not meet the specified rollover "
-                        "requirements ({}).".format(self.name, self.rollovers))
+            self.log.warning("The configuration for {} does not meet the specified rollover "
+                             "requirements ({}).".format(self.name, self.rollovers))
 
     def run(self):
         """ Kick off heartbeats, data writer, and data writer monitor in separate processes
         """
-        self.send_request(signal=2, data="Hello!")
-        log.debug("Logging client {} onto server...".format(self.name))
+        self.hello()
+        self.start_processes()
+
+    def hello(self):
+        """ Log on to the server, and start the clock on our runtime.
+        :return float: how long the server took to answer
+        """
+        self.start = time.time()
+        self.negotiate(self.send_request(signal=2, data="Hello!"))
+        self.log.debug("Logging client {} onto server...".format(self.name))
+        return time.time() - self.start
+
+    def negotiate(self, response):
+        """ Send heartbeats only as often as the server asks, if it said how often in its response.
+        :param requests.Response response: the response to our hello
+        """
+        if not self.adaptive_heartbeats or response is None:
+            return
+        interval = response.headers.get(wire.HEARTBEAT_INTERVAL)
+        if interval is None:
+            # an older server, which might only count heartbeats as heartbeats
+            return
+        self.heartbeat_every.value = float(interval)
+        self.log.debug("Server %s times clients out after %s seconds, and wants to hear from us every %s",
+                       self.url, response.headers.get(wire.HEARTBEAT_TIMEOUT), interval)
 
-        p1 = multiprocessing.Process(target=self.heartbeats)
-        p2 = multiprocessing.Process(target=self.data)
-        p3 = multiprocessing.Process(target=self.monitor, args=(p2,))
+    def contact(self, when):
+        """ Remember that the server has heard from us, as of a time.
+        Two processes doing this at once can lose one of the updates, which only costs a heartbeat.
+        :param float when: the time on the newest request the server got
+        """
+        if when > self.last_contact.value:
+            self.last_contact.value = when
+
+    def heartbeat(self, intended=None):
+        """ Send a heartbeat, unless something else we've sent will do. That's when the server has told
+        us how often it wants to hear from us, and we'll still be inside that at the next heartbeat.
+        :param float intended: when the schedule wanted this sent
+        """
+        every = self.heartbeat_every.value
+        if every and time.time() - self.last_contact.value + self.workload["heartbeat"]["interval"] <= every:
+            self.heartbeats_skipped += 1
+            return
+        self.send_request(signal=0, data="Heartbeat", intended=intended, kind="heartbeat")
+
+    def start_processes(self):
+        """ Fork the heartbeat, data writer and monitor processes.
+        """
+        p1 = multiprocessing.Process(target=self.forked, args=(self.heartbeats,))
+        p2 = multiprocessing.Process(target=self.forked, args=(self.data,))
+        p3 = multiprocessing.Process(target=self.forked, args=(self.monitor, p2))
         p1.start()
         p2.start()
         p3.start()
-        log.info("All processes started on {}".format(self.name))
+        self.log.info("All processes started on {}".format(self.name))
 
-    def send_request(self, signal, data):
-        """ Format a request to send to the server
-        :param int signal: What kind of request (heartbeat, data, client info)
-        :param str data: Data in addition to signal
+    def forked(self, target, *args):
+        """ Run one of our processes. Whatever latencies we'd counted before forking (the hello) get sent
+        back by the parent, so the child starts counting from nothing.
+        :param function target: heartbeats, data or monitor
+        """
+        self.latencies = {}
+        target(*args)
+
+    def send_request(self, signal, data, intended=None, kind=None):
+        """ Format a request to send to the server. If we're batching, heartbeats and data wait in the
+        buffer until the batch window is up; client information always goes out right away.
+        :param int signal: What kind of request (heartbeat, data, client info, I/O stats)
+        :param data: Data in addition to signal
+        :param float intended: when the schedule wanted this sent, if it's on one
+        :param str kind: which schedule it's on
+        :return requests.Response: the server's response, or None if it's waiting in the buffer or
+        the server was too busy for it
         """
         now = time.time()
-        payload = json.dumps({"name": self.name,
-                              "signal": signal,
-                              "time": now, "data": data})
-        r = requests.post(self.url, data=payload)
-        if r.status_code not in STATUS_UP_CODES:
-            log.error("Attempted to send data at time: {} but received status code: {}"
-                      .format(now, r.status_code))
-            raise FlaskServerNotUp
+        r = None
+        request_data = {"name": self.name,
+                        "signal": signal,
+                        "time": now, "data": data}
+        if self.batch_window and signal != 2:
+            self.buffer.append(request_data)
+            if self.buffer_start is None:
+                self.buffer_start = now
+            elif abs(now - self.buffer_start) >= self.batch_window:
+                self.flush()
+            done = None
+        else:
+            # send anything that's waiting first, so the server sees everything in order
+            self.flush()
+            r = self.post(self.url, self.encode([request_data]), now)
+            if r is not None:
+                self.contact(now)
+            kind_name = SIGNALS[signal] if signal < len(SIGNALS) else "signal_{}".format(signal)
+            done = self.record_latency(kind_name, now, r, intended)
+        if intended is not None:
+            self.send_times.append((kind, intended, now, done))
+
         if signal == 0:
-            log.debug("Sending heartbeat for time {}".format(now))
+            self.log.debug("Sending heartbeat for time %s", now, extra=HEARTBEAT)
         elif signal == 1:
-            log.debug("Sending data for time {}. Data: {}".format(now, data))
+            self.log.debug("Sending data for time %s. Data: %s", now, data, extra=DATA)
         elif signal ==2:
-            log.debug("Sending client information for time: {}. Information: {}".format(now, data))
+            self.log.debug("Sending client information for time: %s. Information: %s", now, data)
+        elif signal == 3:
+            self.log.debug("Sending I/O stats for time: %s. Stats: %s", now, data, extra=IO)
         else:
-            log.debug("An unrecognized signal was sent! Signal: {}. Data: {}".format(signal, data))
+            self.log.debug("An unrecognized signal was sent! Signal: %s. Data: %s", signal, data)
+        return r
+
+    def flush(self):
+        """ Send everything in the buffer to the server's batch endpoint, one request per line.
+        """
+        if not self.buffer:
+            return
+        payload = self.encode(self.buffer)
+        self.log.debug("Sending a batch of %s requests", len(self.buffer))
+        newest = self.buffer[-1]["time"]
+        self.buffer = []
+        self.buffer_start = None
+        start = time.time()
+        r = self.post(self.batch_url, payload, start)
+        if r is not None:
+            self.contact(newest)
+        self.record_latency("batch", start, r)
+
+    def flush_due(self):
+        """ When the batch window is up for the oldest thing in the buffer.
+        :return float: the time, or None if there's nothing waiting
+        """
+        if self.buffer_start is None:
+            return
+        return self.buffer_start + self.batch_window
+
+    def flush_if_due(self):
+        """ Send the buffer if its batch window is up, even if nothing new has come along to send it.
+        """
+        due = self.flush_due()
+        if due is not None and time.time() >= due:
+            self.flush()
+
+    def wait_until(self, when):
+        """ Sleep until it's time for the next thing on a schedule, sending the buffer on the way if its
+        batch window is up first. Otherwise a slow schedule would hold on to what it buffered until its
+        next send.
+        :param float when: when to wake up
+        """
+        due = self.flush_due()
+        if due is not None and due < when:
+            sleep_until(due)
+            self.flush()
+        sleep_until(when)
+
+    def record_latency(self, kind, start, response, intended=None):
+        """ Count how long a request took. If the server said how long it spent handling it, that's
+        counted too, and the rest is time spent on the network (and in the client library).
+        :param str kind: what kind of request it was
+        :param float start: when we started sending it
+        :param requests.Response response: what the server sent back
+        :param float intended: when the schedule wanted it sent, if it's on one
+        :return float: when it finished
+        """
+        done = time.time()
+        parts = self.latencies.setdefault(kind, {})
+        timings = [("round_trip", done - start)]
+        server = response.headers.get(wire.PROCESSING_TIME) if response is not None else None
+        if server is not None:
+            timings += [("server", float(server)), ("network", max(done - start - float(server), 0))]
+        if intended is not None:
+            timings.append(("scheduled", done - intended))
+        for part, seconds in timings:
+            if part not in parts:
+                parts[part] = latency.HdrHistogram()
+            parts[part].record(seconds)
+        return done
+
+    def latency_dump(self):
+        """ This process's latency histograms, in a form that can go on a queue or into JSON.
+        :return dict: kind -> part -> HdrHistogram.to_dict()
+        """
+        return latency.dump(self.latencies)
+
+    def send_latencies(self):
+        """ Send this process's latency histograms back to whoever started us, and start counting again.
+        """
+        if self.results is not None:
+            self.results.put(self.latency_dump())
+        self.latencies = {}
+
+    def encode(self, batch):
+        """ Write requests out in whichever wire format we're using: one JSON request per line, or one
+        binary frame after another.
+        :param list batch: the request dictionaries
+        :return str: the body to send
+        """
+        if self.wire_format == "binary":
+            return "".join(wire.encode(wire.Message(request_data["name"], request_data["signal"],
+                                                    request_data["time"], request_data["data"]))
+                           for request_data in batch)
+        return "\n".join(wire.dumps(request_data) for request_data in batch)
+
+    def get_session(self):
+        """ Get this process's HTTP session, making one if we don't have one yet. Sessions can't be
+        shared across a fork (the processes would be fighting over the same sockets), so a new process
+        gets a new session.
+        :return requests.Session: a session which keeps its connections to the server alive
+        """
+        if self.session is None or self.session_pid != os.getpid():
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            if self.wire_format == "binary":
+                # this is how the server knows which format we're sending
+                self.session.headers['Content-Type'] = wire.BINARY_TYPE
+            self.session_pid = os.getpid()
+        return self.session
+
+    def post(self, url, payload, now):
+        """ Actually send something to the server, retrying with backoff if it doesn't go through.
+        If the server says it's too busy (429 or 503), we wait as long as its Retry-After asks and try
+        again, and that doesn't use up a retry. If it's still too busy after max_busy_wait, what we're
+        sending gets dropped; the server is up, so there's no reason to give up on the whole run.
+        :param str url: where to send it
+        :param str payload: the body of the request
+        :param float now: when we're sending it, for the log
+        :return requests.Response: the server's response, or None if it was too busy to take it
+        """
+        failures = 0
+        busy = 0
+        give_up = time.time() + self.max_busy_wait
+        while failures <= self.retries:
+            try:
+                r = self.get_session().post(url, data=payload, timeout=self.request_timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.log.warning("Attempt {} to send data at time: {} failed: {}"
+                                 .format(failures + 1, now, e))
+            else:
+                if r.status_code in STATUS_UP_CODES:
+                    return r
+                if r.status_code in STATUS_BUSY_CODES:
+                    busy += 1
+                    delay = busy_delay(r.headers.get("Retry-After"), self.backoff, busy)
+                    if time.time() + delay > give_up:
+                        self.log.error("The server was still too busy for data from time: {} after {} "
+                                       "seconds. Dropping it.".format(now, self.max_busy_wait))
+                        return
+                    self.log.info("The server is too busy for data from time: %s. Trying again in %.2f "
+                                  "seconds.", now, delay)
+                    time.sleep(delay)
+                    continue
+                self.log.warning("Attempt {} to send data at time: {} received status code: {}"
+                                 .format(failures + 1, now, r.status_code))
+            failures += 1
+            busy = 0
+            if failures <= self.retries:
+                time.sleep(self.backoff * 2 ** (failures - 1))
+
+        self.log.error("Attempted to send data at time: {} but gave up after {} tries."
+                       .format(now, self.retries + 1))
+        raise FlaskServerNotUp
+
+    def running(self):
+        """ Whether this client still has time left to run.
+        :return bool: True until the runtime is up
+        """
+        return abs(self.start - time.time()) < self.runtime
+
+    def schedule(self, kind, start=None):
+        """ When to do things of this kind, until our runtime is up.
+        :param str kind: "heartbeat", "data" or "monitor"
+        :param float start: when to count from; when we said hello, if this is None
+        :return generator: the times
+        """
+        start = self.start if start is None else start
+        for when in arrivals(self.workload[kind], start):
+            if when - start >= self.runtime:
+                return
+            yield when
+
+    def report_schedule(self):
+        """ Log how well this process kept to its schedules, and start counting again.
+        """
+        if self.send_times:
+            self.log.warning("{} schedule report: {}".format(self.name, schedule_report(self.send_times)))
+        self.send_times = []
+        if self.heartbeats_skipped:
+            self.log.info("%s skipped %s heartbeats the server didn't need", self.name,
+                          self.heartbeats_skipped)
+        self.heartbeats_skipped = 0
 
     def heartbeats(self):
-        """ At intervals of 5 sec, send a heartbeat to the server
+        """ Send heartbeats to the server, on the heartbeat schedule
         """
-        while abs(self.start - time.time()) < self.runtime:
-            time.sleep(5)
-            self.send_request(signal=0, data="Heartbeat")
+        for when in self.schedule("heartbeat"):
+            self.wait_until(when)
+            self.heartbeat(when)
+        self.flush()
+        self.report_schedule()
 
         # to avoid race conditions, we wait until the monitor thread says it's done
         while not self.end_data_tunnel.is_set():
             time.sleep(1)
         self.send_request(signal=2, data="Goodbye.")
+        self.send_latencies()
 
     def data(self):
-        """ At a configurable interval, write random data to files
+        """ Write random data to files, on the data schedule
+        """
+        for when in self.schedule("data"):
+            self.wait_until(when)
+            self.write_chunk(intended=when)
+        self.finish_data()
+        self.flush()
+        self.report_schedule()
+        self.send_latencies()
+
+    def finish_data(self):
+        """ Close the data file we were writing, if we got as far as writing one, and send the last
+        of the write timings.
         """
-        while abs(self.start - time.time()) < self.runtime:
-            time.sleep(self.data_interval)
+        if self.writer:
+            self.writer.close()
+        self.send_io_stats()
 
-            log.info("{} - Writing {} byes of data".format(self.name, self.chunk_size))
-            self.current_file, rolling = write_and_roll(self.current_file, self.base_name,
-                                                        self.chunk_size, self.file_size,
-                                                        self.gen)
-            if rolling:
-                log.info("{} - Rolling over a new file.".format(self.name))
-                self.send_request(signal=2, data="Data writer has rolled over to a new file.")
+    def write_chunk(self, intended=None):
+        """ Write one chunk of random data, and tell the server if that rolled us over to a new file.
+        :param float intended: when the schedule wanted this written, if it's on one
+        """
+        self.log.info("%s - Writing %s byes of data", self.name, self.chunk_size, extra=WRITE)
+        if self.writer is None:
+            self.writer = DataWriter(self.base_name, self.chunk_size, self.file_size, gen=self.gen,
+                                     fsync=self.fsync, direct=self.direct_io)
+        start = time.time()
+        self.current_file, rolling = self.writer.write()
+        self.io_latencies.append(time.time() - start)
+        if intended is not None:
+            self.send_times.append(("data", intended, start, time.time()))
+        self.io_bytes += self.chunk_size
+        if rolling:
+            self.log.info("{} - Rolling over a new file.".format(self.name))
+            self.io_rollovers.append(self.writer.last_rollover)
+            self.send_request(signal=2, data="Data writer has rolled over to a new file.")
+        if len(self.io_latencies) >= self.io_report_every:
+            self.send_io_stats()
+
+    def send_io_stats(self):
+        """ Send the server the write timings since the last time we did this. Times go as whole
+        microseconds, to keep the request small.
+        """
+        if not self.io_latencies:
+            return
+        latencies = sorted(self.io_latencies)
+        seconds = sum(latencies)
+        self.log.info("{} - {} writes at {:.1f} MB/s, p50 {:.4f}s, p99 {:.4f}s".format(
+            self.name, len(latencies), self.io_bytes / seconds / 1e6 if seconds else 0,
+            percentile(latencies, 50), percentile(latencies, 99)))
+        self.send_request(signal=3, data={"bytes": self.io_bytes,
+                                          "latencies_us": [int(l * 1e6) for l in self.io_latencies],
+                                          "rollovers_us": [int(r * 1e6) for r in self.io_rollovers]})
+        self.io_latencies = []
+        self.io_rollovers = []
+        self.io_bytes = 0
 
-    def send_proc_info(self, proc):
+    def send_proc_info(self, proc, window=None, intended=None):
         """ Gather info on the given process and send that data to the server.
         :param  multiprocessing.Process proc: the process to monitor
+        :param procinfo.Window window: if we're sampling, the samples to sum up and send instead
+        :param float intended: when the schedule wanted this sent, if it's on one
         """
-        thread_info = get_proc_info(proc)
+        if window is not None:
+            thread_info = window.take()
+        else:
+            thread_info = get_proc_info(proc)
 
         # if the PID went to None, thread_info will be None.
         if thread_info:
-            self.send_request(signal=1, data=str(thread_info))
+            self.send_request(signal=1, data=procinfo.encode(thread_info), intended=intended, kind="monitor")
 
     def monitor(self, proc):
-        """ At intervals of 10 sec, run send_proc_info to gather and send process info
+        """ On the monitor schedule, run send_proc_info to gather and send process info
         :param  multiprocessing.Process proc: the process to monitor
         """
-        while abs(self.start - time.time()) < self.runtime:
-            time.sleep(10)
-            self.send_proc_info(proc)
+        sampler = window = None
+        if self.sample_interval:
+            sampler = procinfo.ProcSampler(proc.pid, self.sample_interval, self.log)
+            window = sampler.subscribe()
+            sampler.start()
+        for when in self.schedule("monitor"):
+            self.wait_until(when)
+            self.send_proc_info(proc, window, intended=when)
+        if sampler:
+            sampler.stop()
+        self.flush()
+        self.report_schedule()
+        self.send_latencies()
         self.end_data_tunnel.set()
 
+
+def launch_offsets(count, profile="all", ramp=0, wave_size=10, wave_interval=5):
+    """ Work out when each client should start, in seconds from the start of the launch.
+    :param int count: how many clients
+    :param str profile: "all" starts everyone at once, "linear" spreads them evenly over ramp seconds,
+    and "waves" starts wave_size of them every wave_interval seconds
+    :param float ramp: for "linear", how long until the last client starts
+    :param int wave_size: for "waves", how many clients start together
+    :param float wave_interval: for "waves", how long between each wave
+    :return list: one offset per client
+    """
+    if profile == "all":
+        return [0] * count
+    if profile == "linear":
+        step = float(ramp) / max(count - 1, 1)
+        return [i * step for i in range(count)]
+    if profile == "waves":
+        return [(i // max(wave_size, 1)) * wave_interval for i in range(count)]
+    raise ValueError("Unknown launch profile {}. Use all, linear or waves.".format(profile))
+
+
+def launch_report(start, connected, total):
+    """ Sum up how a launch went.
+    :param float start: when the launch started
+    :param list connected: (when the server answered, how long it took) for each client that said hello
+    :param int total: how many clients we tried to start
+    :return dict: how many got connected, how long until the last one did, and how long hellos took
+    """
+    report = {"clients": total, "connected": len(connected)}
+    if connected:
+        hellos = sorted(seconds for when, seconds in connected)
+        report["all_connected_s"] = max(when for when, seconds in connected) - start
+        report["hello_p50_s"] = percentile(hellos, 50)
+        report["hello_p99_s"] = percentile(hellos, 99)
+    return report
+
+
+def collect_latencies(results, expected, timeout):
+    """ Wait for client processes to send back their latency histograms.
+    :param multiprocessing.Queue results: the queue the clients were given
+    :param int expected: how many to wait for (a process-per-client client sends three)
+    :param float timeout: the longest to wait for all of them, in seconds
+    :return list: what each process sent, kind -> part -> HdrHistogram.to_dict()
+    """
+    dumps = []
+    deadline = time.time() + timeout
+    while len(dumps) < expected:
+        try:
+            dumps.append(results.get(timeout=max(deadline - time.time(), 0.01)))
+        except Queue.Empty:
+            log.warning("Only {} of {} client processes sent back their latencies."
+                        .format(len(dumps), expected))
+            break
+    return dumps
+
+
+class SenderThread(threading.Thread):
+    """ A worker which runs jobs for the event loop (or the Launcher), so it never has to wait on the
+    network or disk. Each client always goes to the same sender, so its requests still reach the server
+    in order.
+    """
+
+    def __init__(self):
+        super(SenderThread, self).__init__()
+        self.daemon = True
+        self.jobs = Queue.Queue()
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue up a function call to run on this thread.
+        """
+        self.jobs.put((func, args, kwargs))
+
+    def stop(self):
+        """ Finish whatever is queued, then exit.
+        """
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except (FlaskServerNotUp, EnvironmentError) as e:
+                log.error("A job on a sender thread failed: {} {}".format(type(e).__name__, e))
+
+
+class Launcher(object):
+    """ Starts process-per-client clients from a pool of threads, each client at its own offset.
+
+    Saying hello is the slow part, since it waits on the server, so lots of those happen at once.
+    Forking a client's processes is quick, and happens one client at a time.
+    """
+
+    def __init__(self, clients, offsets=None, threads=16):
+        """
+        :param list clients: the RequestClients to start
+        :param list offsets: when to start each client, in seconds from now (see launch_offsets)
+        :param int threads: how many clients can be saying hello at once
+        """
+        self.clients = clients
+        self.offsets = offsets or [0] * len(clients)
+        self.senders = [SenderThread() for _ in range(max(1, min(threads, len(clients))))]
+        self.fork_lock = threading.Lock()
+        self.connected = []
+
+    def run(self):
+        """ Start every client on schedule, and wait until they've all been started.
+        :return dict: the launch report
+        """
+        start = time.time()
+        # in order of offset, so no thread is stuck waiting on a late client while an early one waits
+        order = sorted(range(len(self.clients)), key=lambda i: self.offsets[i])
+        for n, i in enumerate(order):
+            self.senders[n % len(self.senders)].submit(self.launch, self.clients[i], start + self.offsets[i])
+        for sender in self.senders:
+            sender.start()
+            sender.stop()
+        for sender in self.senders:
+            sender.join()
+
+        report = launch_report(start, self.connected, len(self.clients))
+        log.warning("Launch report: {}".format(report))
+        return report
+
+    def launch(self, client, when):
+        """ Wait for a client's turn, then start it.
+        :param RequestClient client: the client
+        :param float when: when to start it
+        """
+        wait = when - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        seconds = client.hello()
+        self.connected.append((time.time(), seconds))
+        with self.fork_lock:
+            client.start_processes()
+
+
+class EventLoopEngine(object):
+    """ Runs lots of clients in one process instead of three processes per client.
+
+    Each client's heartbeats, data writes and monitoring are generators which yield how long they
+    want to sleep; one loop keeps them in a heap by wake-up time and steps whichever is due next.
+    The actual sending and writing happens on a small pool of sender threads, each with its own
+    keep-alive session.
+    """
+
+    def __init__(self, clients, workers=8, offsets=None):
+        """
+        :param list clients: the RequestClients to run
+        :param int workers: how many sender threads to use
+        :param list offsets: when to start each client, in seconds from the start (see launch_offsets)
+        """
+        self.clients = clients
+        self.offsets = offsets or [0] * len(clients)
+        self.launch_start = None
+        self.connected = []
+        self.senders = [SenderThread() for _ in range(max(1, min(workers, len(clients))))]
+        self.heap = []
+        self.seq = itertools.count()
+        # all the clients live in this process, so this is the process we monitor
+        self.proc = psutil.Process(os.getpid())
+        # and one sampler does for all of them, as fast as the most demanding client wants
+        intervals = [client.sample_interval for client in clients if client.sample_interval]
+        self.sampler = procinfo.ProcSampler(self.proc.pid, min(intervals), log) if intervals else None
+
+    def spawn(self, task, delay=0):
+        """ Schedule a generator to be stepped after the given delay.
+        :param generator task: yields how many seconds to sleep between steps
+        :param float delay: how long to wait before the first step
+        """
+        heapq.heappush(self.heap, (time.time() + delay, next(self.seq), task))
+
+    def run(self):
+        """ Say hello for every client when its turn comes, then run all of their tasks until they're
+        all done.
+        """
+        for sender in self.senders:
+            sender.start()
+
+        self.launch_start = time.time()
+        for i, client in enumerate(self.clients):
+            sender = self.senders[i % len(self.senders)]
+            # heartbeats says hello first, and none of them do anything else before their first sleep
+            self.spawn(self.heartbeats(client, sender), self.offsets[i])
+            self.spawn(self.data(client, sender), self.offsets[i])
+            self.spawn(self.monitor(client, sender), self.offsets[i])
+            if client.batch_window:
+                self.spawn(self.flushes(client, sender), self.offsets[i])
+        log.info("All tasks scheduled for {} clients".format(len(self.clients)))
+        if self.sampler:
+            self.sampler.start()
+
+        while self.heap:
+            when, seq, task = heapq.heappop(self.heap)
+            wait = when - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                delay = next(task)
+            except StopIteration:
+                continue
+            self.spawn(task, delay)
+
+        if self.sampler:
+            self.sampler.stop()
+        for sender in self.senders:
+            sender.stop()
+        for sender in self.senders:
+            sender.join()
+        if len(self.connected) < len(self.clients):
+            log.warning("Launch report: {}".format(launch_report(self.launch_start, self.connected,
+                                                                 len(self.clients))))
+
+    def hello(self, client):
+        """ Say hello for a client, on its sender thread, and report once every client has.
+        """
+        seconds = client.hello()
+        self.connected.append((time.time(), seconds))
+        if len(self.connected) == len(self.clients):
+            log.warning("Launch report: {}".format(launch_report(self.launch_start, self.connected,
+                                                                 len(self.clients))))
+
+    def heartbeats(self, client, sender):
+        """ The event loop version of RequestClient.heartbeats
+        """
+        sender.submit(self.hello, client)
+        for when in client.schedule("heartbeat", time.time()):
+            yield max(when - time.time(), 0)
+            sender.submit(client.heartbeat, when)
+        sender.submit(client.flush)
+
+        # the monitor's last job sets this, so by then everything it sent is ahead of us
+        while not client.end_data_tunnel.is_set():
+            yield 1
+        sender.submit(client.send_request, signal=2, data="Goodbye.")
+        sender.submit(client.report_schedule)
+
+    def data(self, client, sender):
+        """ The event loop version of RequestClient.data
+        """
+        for when in client.schedule("data", time.time()):
+            yield max(when - time.time(), 0)
+            sender.submit(client.write_chunk, intended=when)
+        sender.submit(client.finish_data)
+        sender.submit(client.flush)
+
+    def monitor(self, client, sender):
+        """ The event loop version of RequestClient.monitor
+        """
+        window = self.sampler.subscribe() if client.sample_interval else None
+        for when in client.schedule("monitor", time.time()):
+            yield max(when - time.time(), 0)
+            sender.submit(client.send_proc_info, self.proc, window, intended=when)
+        sender.submit(client.flush)
+        sender.submit(client.end_data_tunnel.set)
+
+    def flushes(self, client, sender):
+        """ Send a client's buffer when its batch window is up, the way RequestClient.wait_until does.
+        The buffer belongs to the sender thread, so this only peeks at when it's due; the sender checks
+        again before sending. With nothing waiting, look again in a quarter of the window, so nothing
+        waits much longer than the window.
+        """
+        while not client.end_data_tunnel.is_set():
+            due = client.flush_due()
+            if due is None:
+                yield client.batch_window / 4.0
+            else:
+                yield max(due - time.time(), 0)
+                sender.submit(client.flush_if_due)
+
+
 if __name__ == "__main__":
 
     # TODO: should this be in a try statement?
@@ -276,11 +1150,42 @@ if __name__ == "__main__":
     PORT = config["port"]
     URL = 'http://127.0.0.1:{}'.format(PORT)
     ROLLOVERS = config["desired_rollovers"]
+    BATCH_WINDOW = config.get("batch_window", 0)
+    POOL_SIZE = config.get("pool_size", 2)
+    RETRIES = config.get("retries", 3)
+    BACKOFF = config.get("backoff", 0.5)
+    # how long to keep trying when the server says it's too busy, before dropping what we're sending
+    MAX_BUSY_WAIT = config.get("max_busy_wait", 60)
+    # only send heartbeats as often as the server asks for them, when nothing else has been sent
+    ADAPTIVE_HEARTBEATS = config.get("adaptive_heartbeats", True)
+    REQUEST_TIMEOUT = config.get("request_timeout", 10)
+    FSYNC = config.get("fsync", "never")
+    DIRECT_IO = config.get("direct_io", False)
+    IO_REPORT_EVERY = config.get("io_report_every", 10)
+    # 0 sends one process sample every report_interval; otherwise sample this often and send summaries
+    SAMPLE_INTERVAL = config.get("sample_interval", 0)
+    REPORT_INTERVAL = config.get("report_interval", 10)
+    WIRE_FORMAT = config.get("wire_format", "json")
+    # when each client sends heartbeats, writes data and sends process info; see arrivals for the kinds
+    WORKLOAD = config.get("workload")
+    # how to start the clients: "all" at once, a "linear" ramp over launch_ramp seconds, or "waves" of
+    # launch_wave_size clients every launch_wave_interval seconds
+    LAUNCH_PROFILE = config.get("launch_profile", "all")
+    LAUNCH_RAMP = config.get("launch_ramp", 0)
+    LAUNCH_WAVE_SIZE = config.get("launch_wave_size", 10)
+    LAUNCH_WAVE_INTERVAL = config.get("launch_wave_interval", 5)
+    # how many clients can be saying hello at once
+    LAUNCH_THREADS = config.get("launch_threads", 16)
+    asynclog.configure(log, every=config.get("log_every"), per_second=config.get("log_per_second"),
+                       per_client="client_{}.log" if config.get("log_per_client") else None)
+    # "processes" runs every client in its own processes; "eventloop" runs them all in this one
+    ENGINE = config.get("engine", "processes")
+    WORKERS = config.get("workers", 8)
 
     # Make sure the given port is correct
     try:
         r = requests.get(URL)
-        if r.status_code not in STATUS_UP_CODES:
+        if r.status_code not in STATUS_UP_CODES + STATUS_BUSY_CODES:
             log.error("Server appears to not be up! Status code {} received.".format(r.status_code))
             raise FlaskServerNotUp
     except requests.ConnectionError:
@@ -298,6 +1203,8 @@ if __name__ == "__main__":
 
     # Now initialize the clients with the given information
     clients = []
+    # every client process sends its latency histograms back on this when it's done
+    results = multiprocessing.Queue()
     for i in range(config["count"]):
         clients.append(RequestClient(
             name=config["info"]["names"][i],
@@ -305,10 +1212,36 @@ if __name__ == "__main__":
             runtime=config["info"]["run_times"][i],
             chunk_size=config["info"]["chunk_sizes"][i],
             file_size=config["info"]["file_sizes"][i],
-            rollovers=ROLLOVERS
+            rollovers=ROLLOVERS,
+            batch_window=BATCH_WINDOW,
+            pool_size=POOL_SIZE,
+            retries=RETRIES,
+            backoff=BACKOFF,
+            request_timeout=REQUEST_TIMEOUT,
+            fsync=FSYNC,
+            direct_io=DIRECT_IO,
+            io_report_every=IO_REPORT_EVERY,
+            sample_interval=SAMPLE_INTERVAL,
+            report_interval=REPORT_INTERVAL,
+            wire_format=WIRE_FORMAT,
+            workload=WORKLOAD,
+            results=results,
+            max_busy_wait=MAX_BUSY_WAIT,
+            adaptive_heartbeats=ADAPTIVE_HEARTBEATS
         ))
 
     # run them all!
-    # Stress testing revealed this could be faster. This would be a future improvement.
-    for client in clients:
-        client.run()
+    offsets = launch_offsets(len(clients), LAUNCH_PROFILE, LAUNCH_RAMP, LAUNCH_WAVE_SIZE,
+                             LAUNCH_WAVE_INTERVAL)
+    if ENGINE == "eventloop":
+        EventLoopEngine(clients, workers=WORKERS, offsets=offsets).run()
+        dumps = [client.latency_dump() for client in clients]
+    else:
+        Launcher(clients, offsets, threads=LAUNCH_THREADS).run()
+        # hellos were timed here, and everything else in the clients' own processes
+        dumps = [client.latency_dump() for client in clients]
+        dumps += collect_latencies(results, 3 * len(clients), max(config["info"]["run_times"]) + 60)
+
+    latency_report = latency.report(latency.merge_all(dumps))
+    log.warning("Latency report: {}".format(latency_report))
+    print latency.format_report(latency_report)
@@ -4,6 +4,26 @@ import CustomFlask
 import multiprocessing
 import os
 import FlaskServer
+import liveness
+import datasink
+import eventserver
+import clientstate
+import journal
+import metrics
+import procinfo
+import timeseries
+import wire
+import asynclog
+import latency
+import loadbench
+import threading
+import socket
+import tempfile
+import shutil
+import logging
+import json
+import time
+import random
 
 
 class HelperFunctionTests(unittest.TestCase):
@@ -55,6 +75,92 @@ class GetNextFileTest(unittest.TestCase):
         self.assertEqual(rolling, False)
 
 
+class DataWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.base = os.path.join(self.dir, 'hello')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rolls_like_write_and_roll(self):
+        old_base = os.path.join(self.dir, 'old')
+        old_gen = requester.files_gen(old_base)
+        current = None
+        old_rolls = []
+        for i in range(12):
+            current, rolling = requester.write_and_roll(current, old_base, 100, 450, old_gen)
+            old_rolls.append((os.path.basename(current)[len('old'):], rolling))
+
+        writer = requester.DataWriter(self.base, 100, 450)
+        new_rolls = []
+        for i in range(12):
+            current, rolling = writer.write()
+            new_rolls.append((os.path.basename(current)[len('hello'):], rolling))
+        writer.close()
+        self.assertEqual(new_rolls, old_rolls)
+        self.assertEqual(os.path.getsize(self.base + '_0.data'), 400)
+
+    def test_picks_up_existing_file_size(self):
+        with open(self.base + '_0.data', 'w') as f:
+            f.write('x' * 350)
+        writer = requester.DataWriter(self.base, 100, 450, fsync="write")
+        self.assertEqual(writer.write(), (self.base + '_0.data', False))
+        self.assertEqual(writer.write(), (self.base + '_1.data', True))
+        writer.close()
+
+    def test_blocks_are_stamped(self):
+        writer = requester.DataWriter(self.base, 8192, 100000, fsync="rollover")
+        writer.write()
+        writer.write()
+        writer.close()
+        with open(self.base + '_0.data', 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(data), 16384)
+        self.assertNotEqual(data[:4096], data[8192:12288])
+
+    def test_direct_needs_whole_blocks(self):
+        self.assertEqual(requester.DataWriter(self.base, 100, 450, direct=True).direct, False)
+
+    def test_direct_appends_to_unaligned_file(self):
+        with open(self.base + '_0.data', 'w') as f:
+            f.write('x' * 100)
+        writer = requester.DataWriter(self.base, 4096, 100000, direct=True)
+        self.assertEqual(writer.write(), (self.base + '_0.data', False))
+        writer.close()
+        self.assertEqual(os.path.getsize(self.base + '_0.data'), 4196)
+
+    def test_payload_per_thread(self):
+        payloads = []
+        for _ in range(2):
+            thread = threading.Thread(target=lambda: payloads.append(requester.get_payload(8192, False)))
+            thread.start()
+            thread.join()
+        self.assertIsNot(payloads[0], payloads[1])
+        self.assertIs(requester.get_payload(8192, False), requester.get_payload(8192, False))
+
+    def test_writers_on_threads_keep_their_stamps(self):
+        writers = [requester.DataWriter(os.path.join(self.dir, str(i)), 8192, 10 ** 7) for i in range(4)]
+
+        def write(writer):
+            for _ in range(50):
+                writer.write()
+            writer.close()
+        threads = [threading.Thread(target=write, args=(writer,)) for writer in writers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for writer in writers:
+            with open(writer.current_file, 'rb') as f:
+                for i in range(50):
+                    chunk = f.read(8192)
+                    stamps = set(requester.DataWriter.STAMP.unpack_from(chunk, offset)[0]
+                                 for offset in range(0, 8192, requester.DataWriter.BLOCK))
+                    self.assertEqual(stamps, set([i + 1]))
+
+
 class TestCounterObject(unittest.TestCase):
     # test that multiple processes can modify the TestCounterObject
 
@@ -79,10 +185,74 @@ class TestCounterObject(unittest.TestCase):
         self.assertEqual(MyCounter.value(), 2)
 
 
+class TestShardedCounterObject(unittest.TestCase):
+    # same as TestCounterObject, plus threads and big numbers
+
+    def add_some(self, counter):
+        for _ in range(1000):
+            counter.increment()
+
+    def test_increment_processes(self):
+        MyCounter = CustomFlask.ShardedCounter(0)
+        procs = [multiprocessing.Process(target=self.add_some, args=(MyCounter,)) for _ in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.assertEqual(MyCounter.value(), 4000)
+
+    def test_increment_threads_past_shards(self):
+        MyCounter = CustomFlask.ShardedCounter(0, shards=3)
+        threads = [threading.Thread(target=self.add_some, args=(MyCounter,)) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(MyCounter.value(), 6000)
+
+    def test_threads_give_shards_back(self):
+        MyCounter = CustomFlask.ShardedCounter(0, shards=3)
+        claimed = []
+
+        def add_some_and_say_where():
+            self.add_some(MyCounter)
+            claimed.append(MyCounter._shard())
+        for _ in range(10):
+            t = threading.Thread(target=add_some_and_say_where)
+            t.start()
+            t.join()
+            # a thread's locals go just after join() returns, not before
+            deadline = time.time() + 5
+            while any(MyCounter.owners) and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(list(MyCounter.owners), [0, 0, 0])
+        self.assertEqual(0 in claimed, False)
+        self.assertEqual(MyCounter.value(), 10000)
+
+    def test_shards_taken_back_from_exited_processes(self):
+        MyCounter = CustomFlask.ShardedCounter(0, shards=2)
+        p = multiprocessing.Process(target=self.add_some, args=(MyCounter,))
+        p.start()
+        p.join()
+        self.assertEqual(MyCounter.owners[1], p.pid)
+        claimed = []
+        t = threading.Thread(target=lambda: claimed.append(MyCounter._shard()))
+        t.start()
+        t.join()
+        self.assertEqual(claimed, [1])
+        self.assertEqual(MyCounter.value(), 1000)
+
+    def test_64_bit(self):
+        MyCounter = CustomFlask.ShardedCounter(2 ** 31 - 1)
+        MyCounter.increment()
+        MyCounter.increment(2 ** 32)
+        self.assertEqual(MyCounter.value(), 2 ** 31 + 2 ** 32)
+
+
 class RequestMappingTest(unittest.TestCase):
 
     def test_assert_request_format_positive(self):
-        request = {"name": "nah", "signal": "bee", "time": "bah", "data": "fee"}
+        request = {"name": "nah", "signal": 1, "time": 12.5, "data": "fee"}
         self.assertEqual(FlaskServer.assert_request_format(request), True)
 
     def test_assert_request_format_negative_0(self):
@@ -93,6 +263,1411 @@ class RequestMappingTest(unittest.TestCase):
         request = {"name": "nah", "signal": "bee", "time": "bah"}
         self.assertEqual(FlaskServer.assert_request_format(request), False)
 
+    def test_assert_request_format_types(self):
+        good = {"name": "nah", "signal": 0, "time": 12, "data": "Heartbeat"}
+        self.assertEqual(FlaskServer.assert_request_format(good), True)
+        for key, value in [("name", ""), ("name", 5), ("name", "x" * 64), ("signal", "0"), ("signal", True),
+                           ("signal", 256), ("time", "12"), ("time", None), ("data", None), ("data", 5),
+                           ("data", {"cpu": 1}), ("data", ["Heartbeat"])]:
+            self.assertEqual(FlaskServer.assert_request_format(dict(good, **{key: value})), False)
+        self.assertEqual(FlaskServer.assert_request_format(["nah", 0, 12, None]), False)
+
+    def test_assert_request_format_io_stats(self):
+        stats = {"name": "nah", "signal": 3, "time": 12, "data": {"bytes": 0, "latencies_us": []}}
+        self.assertEqual(FlaskServer.assert_request_format(stats), True)
+        self.assertEqual(FlaskServer.assert_request_format(dict(stats, data="Heartbeat")), False)
+        self.assertEqual(FlaskServer.assert_request_format(dict(stats, signal=1)), False)
+
+
+class FakeClient(object):
+    def __init__(self, name, heartbeat):
+        self.name = name
+        self.current_heartbeat = heartbeat
+        self.active = True
+
+
+class RacingClient(clientstate.SharedClient):
+    # says goodbye right after the scheduler has looked at whether it's still active
+
+    goodbyes = 0
+
+    @property
+    def active(self):
+        active = self.slot.active
+        if self.deactivate():
+            self.goodbyes += 1
+        return active
+
+
+class LivenessSchedulerTest(unittest.TestCase):
+    # drive the scheduler with tick() directly so we don't have to wait around for a real clock
+
+    def setUp(self):
+        self.timed_out = []
+        self.scheduler = liveness.LivenessScheduler(timeout=30, log=logging.getLogger('test'),
+                                                    on_timeout=self.timed_out.append)
+        # pretend the thread is already running; we'll tick by hand
+        self.scheduler.thread = True
+
+    def test_times_out_silent_client(self):
+        client = FakeClient('quiet', 0)
+        self.scheduler.register(client)
+        for now in range(1, 40):
+            self.scheduler.tick(now)
+        self.assertEqual(client.active, False)
+        self.assertEqual(self.timed_out, [client])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_heartbeats_keep_client_alive(self):
+        client = FakeClient('chatty', 0)
+        self.scheduler.register(client)
+        for now in range(1, 100):
+            client.current_heartbeat = now - 5
+            self.scheduler.tick(now)
+        self.assertEqual(client.active, True)
+        self.assertEqual(self.timed_out, [])
+
+    def test_goodbye_drops_client(self):
+        client = FakeClient('polite', 0)
+        self.scheduler.register(client)
+        client.active = False
+        self.scheduler.tick(100)
+        self.assertEqual(self.timed_out, [])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_only_expired_clients_are_checked(self):
+        for i in range(100):
+            self.scheduler.register(FakeClient('client{}'.format(i), i))
+        self.assertEqual(self.scheduler.tick(15), 6)
+
+    def test_goodbye_racing_timeout_counts_once(self):
+        table = clientstate.ClientTable(10)
+        shared, created = table.get_or_create('racer', 0)
+        client = RacingClient(shared.name, shared.slot, table)
+        self.scheduler.register(client)
+        self.scheduler.tick(100)
+        self.assertEqual((client.goodbyes, self.timed_out), (1, []))
+        self.assertEqual(table.active_count(), 0)
+
+    def test_step_longer_than_timeout(self):
+        self.scheduler.step = 60
+        client = FakeClient('quiet', 0)
+        self.scheduler.register(client)
+        for now in range(1, 32):
+            self.scheduler.tick(now)
+        self.assertEqual(self.timed_out, [client])
+
+
+class DataSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sink = datasink.DataSink(logging.getLogger('test'), max_open_files=2,
+                                      flush_interval=0.05, flush_bytes=100)
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.dir)
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name)) as f:
+            return f.read()
+
+    def test_every_line_written_once_in_order(self):
+        # more files than open handles, so the LRU pool has to keep swapping
+        for i in range(200):
+            self.sink.write(os.path.join(self.dir, 'client{}.data'.format(i % 5)), "{}\n".format(i))
+        self.assertEqual(self.sink.sync(timeout=5), True)
+        for c in range(5):
+            self.assertEqual(self.read('client{}.data'.format(c)),
+                             "".join("{}\n".format(i) for i in range(c, 200, 5)))
+        self.assertEqual(len(self.sink.handles) <= 2, True)
+
+    def test_close_flushes(self):
+        self.sink.write(os.path.join(self.dir, 'a.data'), "hello\n")
+        self.sink.close()
+        self.assertEqual(self.read('a.data'), "hello\n")
+        self.assertEqual(self.sink.handles, {})
+
+    def test_backlog(self):
+        a, b = os.path.join(self.dir, 'a.data'), os.path.join(self.dir, 'a.proc')
+        # nothing gets written until this is released
+        release = threading.Event()
+        get_handle = self.sink.get_handle
+
+        def slow_handle(path):
+            release.wait()
+            return get_handle(path)
+        self.sink.get_handle = slow_handle
+        self.sink.write(a, "x" * 10)
+        self.sink.write(b, "y" * 5)
+        self.assertEqual(self.sink.backlog(a), 10)
+        self.assertEqual(self.sink.backlog(a, b), 15)
+        release.set()
+        self.assertEqual(self.sink.sync(timeout=5), True)
+        self.assertEqual(self.sink.backlog(a, b), 0)
+
+    def serve_with_queued_line(self, path, workers):
+        sink = datasink.DataSink(logging.getLogger('test'), flush_interval=60, flush_bytes=1000000)
+        sink.write(path, "hello\n")
+        FlaskServer.app.run_with_monitors(port=0, backend="eventloop", routes={}, workers=workers,
+                                          on_exit=sink.close)
+
+    def test_terminated_server_writes_out_queue(self):
+        for workers in (1, 2):
+            path = os.path.join(self.dir, 'workers{}.data'.format(workers))
+            server = multiprocessing.Process(target=self.serve_with_queued_line, args=(path, workers))
+            server.start()
+            time.sleep(0.5)
+            server.terminate()
+            server.join(5)
+            self.assertEqual(server.exitcode, 0)
+            self.assertEqual(self.read(os.path.basename(path)), "hello\n")
+
+    def take_turns(self, sink, path, me, turn, lock):
+        # lines are big, so one batch is lots of writes to the file
+        while turn.value < 40:
+            with lock:
+                if turn.value < 40 and turn.value % 2 == me:
+                    sink.write(path, "{:02}".format(turn.value) * 50000 + "\n")
+                    turn.value += 1
+
+    def test_shared_between_processes(self):
+        sink = datasink.DataSink(logging.getLogger('test'), flush_interval=0.05, flush_bytes=1000000)
+        sink.share()
+        path = os.path.join(self.dir, 'shared.data')
+        turn, lock = multiprocessing.RawValue('i', 0), multiprocessing.Lock()
+        workers = [multiprocessing.Process(target=self.take_turns, args=(sink, path, me, turn, lock))
+                   for me in (0, 1)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        sink.close()
+        self.assertEqual(sink.backlog(path), 0)
+        self.assertEqual(self.read('shared.data'),
+                         "".join("{:02}".format(i) * 50000 + "\n" for i in range(40)))
+
+    def rotating(self, **kwargs):
+        sink = datasink.DataSink(logging.getLogger('test'), flush_interval=0.05, flush_bytes=1,
+                                 rotate=(".data",), **kwargs)
+        self.addCleanup(sink.close)
+        return sink
+
+    def test_rotate_by_size(self):
+        sink = self.rotating(rotate_bytes=50)
+        path = os.path.join(self.dir, 'a.data')
+        lines = ["line {:02}\n".format(i) for i in range(20)]
+        for line in lines:
+            sink.write(path, line)
+        # .proc files don't rotate
+        sink.write(os.path.join(self.dir, 'a.proc'), "x" * 100)
+        self.assertEqual(sink.sync(timeout=5), True)
+        index = datasink.read_index(path)
+        # 8 byte lines, so a segment gets closed off every 7
+        self.assertEqual([entry["lines"] for entry in index], [7, 7])
+        self.assertEqual([entry["segment"] for entry in index], ["a.data.0.gz", "a.data.1.gz"])
+        self.assertEqual(index[0]["bytes"], 56)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ["a.data", "a.data.0.gz", "a.data.1.gz", "a.data.idx", "a.proc"])
+        self.assertEqual(list(datasink.read_segments(path)), lines)
+
+    def test_readable_while_compressing(self):
+        sink = self.rotating(rotate_bytes=50)
+        release = threading.Event()
+        # so close() doesn't wait forever if something fails before we let it go
+        self.addCleanup(release.set)
+        compress = sink.compress
+
+        def slow_compress(closed):
+            release.wait()
+            return compress(closed)
+        sink.compress = slow_compress
+        path = os.path.join(self.dir, 'a.data')
+        lines = ["line {:02}\n".format(i) for i in range(10)]
+        for line in lines:
+            sink.write(path, line)
+        self.assertEqual(sink.sync(timeout=0.5), False)
+        # closed off but not compressed yet, and still there for readers
+        self.assertEqual([entry["segment"] for entry in datasink.read_index(path)], ["a.data.0"])
+        self.assertEqual(list(datasink.read_segments(path)), lines)
+        release.set()
+        self.assertEqual(sink.sync(timeout=5), True)
+        self.assertEqual([entry["segment"] for entry in datasink.read_index(path)], ["a.data.0.gz"])
+        self.assertEqual(list(datasink.read_segments(path)), lines)
+
+    def test_read_time_range(self):
+        sink = self.rotating(rotate_bytes=49)
+        path = os.path.join(self.dir, 'a.data')
+        for i in range(7):
+            sink.write(path, "early {}\n".format(i))
+        self.assertEqual(sink.sync(timeout=5), True)
+        time.sleep(0.05)
+        middle = time.time()
+        time.sleep(0.05)
+        for i in range(7):
+            sink.write(path, "late {}\n".format(i))
+        self.assertEqual(sink.sync(timeout=5), True)
+        self.assertEqual(len(datasink.read_index(path)), 2)
+        self.assertEqual([line.split()[0] for line in datasink.read_segments(path, start=middle)],
+                         ["late"] * 7)
+        self.assertEqual([line.split()[0] for line in datasink.read_segments(path, end=middle)],
+                         ["early"] * 7)
+
+    def test_rotate_by_age_uncompressed(self):
+        sink = self.rotating(rotate_seconds=0.1, compress_level=0)
+        path = os.path.join(self.dir, 'a.data')
+        sink.write(path, "hello\n")
+        time.sleep(0.3)
+        self.assertEqual(sink.sync(timeout=5), True)
+        self.assertEqual(datasink.read_index(path)[0]["segment"], "a.data.0")
+        self.assertEqual(self.read('a.data.0'), "hello\n")
+        self.assertEqual(os.path.exists(path), False)
+        sink.write(path, "again\n")
+        sink.close()
+        self.assertEqual(list(datasink.read_segments(path)), ["hello\n", "again\n"])
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_parse_batch_array(self):
+        body = '[{"name": "a", "signal": 0}, {"name": "b", "signal": 1}]'
+        self.assertEqual([r["name"] for r in FlaskServer.parse_batch(body)], ["a", "b"])
+
+    def test_parse_batch_lines(self):
+        body = '{"name": "a", "signal": 0}\n{"name": "b", "signal": 1}\n'
+        self.assertEqual([r["name"] for r in FlaskServer.parse_batch(body)], ["a", "b"])
+
+    def test_parse_batch_single(self):
+        self.assertEqual(FlaskServer.parse_batch('{"name": "a"}'), [{"name": "a"}])
+
+
+class RecordingClient(requester.RequestClient):
+    # don't talk to a real server, just remember what we would have sent
+
+    def post(self, url, payload, now):
+        self.sent.append((url, payload))
+
+
+class BufferedSendTest(unittest.TestCase):
+
+    def make_client(self, batch_window):
+        client = RecordingClient('batcher', 'http://127.0.0.1:8000', chunk_size=10000000,
+                                 batch_window=batch_window)
+        client.sent = []
+        return client
+
+    def test_no_window_sends_right_away(self):
+        client = self.make_client(0)
+        client.send_request(signal=0, data="Heartbeat")
+        self.assertEqual(len(client.sent), 1)
+        self.assertEqual(client.sent[0][0], 'http://127.0.0.1:8000')
+
+    def test_window_coalesces(self):
+        client = self.make_client(60)
+        for i in range(10):
+            client.send_request(signal=0, data="Heartbeat")
+        self.assertEqual(client.sent, [])
+        client.flush()
+        self.assertEqual(len(client.sent), 1)
+        url, payload = client.sent[0]
+        self.assertEqual(url, 'http://127.0.0.1:8000/batch')
+        self.assertEqual(len(FlaskServer.parse_batch(payload)), 10)
+
+    def test_client_info_flushes_first(self):
+        client = self.make_client(60)
+        client.send_request(signal=1, data="some data")
+        client.send_request(signal=2, data="Goodbye.")
+        self.assertEqual([url for url, payload in client.sent],
+                         ['http://127.0.0.1:8000/batch', 'http://127.0.0.1:8000'])
+
+    def test_flushed_when_window_is_up(self):
+        client = self.make_client(0.05)
+        client.wait_until(time.time() + 0.01)
+        self.assertEqual(client.sent, [])
+        client.send_request(signal=1, data="some data")
+        due = client.flush_due()
+        # the next send on the schedule is a long way off, but the batch can't wait that long
+        client.wait_until(time.time() + 0.2)
+        self.assertEqual(len(client.sent), 1)
+        self.assertEqual(client.flush_due(), None)
+        self.assertEqual(json.loads(client.sent[0][1])["time"] + 0.05, due)
+
+    def test_event_loop_flushes_when_window_is_up(self):
+        client = self.make_client(0.05)
+        engine = requester.EventLoopEngine([client])
+        flushes = engine.flushes(client, ImmediateSender())
+        self.assertEqual(next(flushes), 0.0125)
+        client.send_request(signal=1, data="some data")
+        time.sleep(next(flushes))
+        self.assertEqual(client.sent, [])
+        next(flushes)
+        self.assertEqual(len(client.sent), 1)
+        client.end_data_tunnel.set()
+        self.assertRaises(StopIteration, next, flushes)
+
+
+class ImmediateSender(object):
+    # run jobs right away instead of on a thread
+
+    def submit(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FlakySession(object):
+    # fails a few times before it lets a request through
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def post(self, url, data, timeout):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise requester.requests.ConnectionError("nope")
+        return FakeResponse(200)
+
+
+class SessionRetryTest(unittest.TestCase):
+
+    def make_client(self, failures, retries):
+        client = requester.RequestClient('retrier', 'http://127.0.0.1:8000', chunk_size=10000000,
+                                         retries=retries, backoff=0)
+        client.session = FlakySession(failures)
+        client.session_pid = os.getpid()
+        return client
+
+    def test_retries_until_success(self):
+        client = self.make_client(failures=2, retries=3)
+        self.assertEqual(client.post(client.url, "{}", 0).status_code, 200)
+        self.assertEqual(client.session.calls, 3)
+
+    def test_gives_up_after_budget(self):
+        client = self.make_client(failures=10, retries=2)
+        self.assertRaises(requester.FlaskServerNotUp, client.post, client.url, "{}", 0)
+        self.assertEqual(client.session.calls, 3)
+
+    def test_busy_doesnt_use_up_retries(self):
+        client = self.make_client(failures=0, retries=0)
+        responses = [FakeResponse(503, {"Retry-After": "0"}), FakeResponse(429), FakeResponse(200)]
+        client.session.post = lambda url, data, timeout: responses.pop(0)
+        self.assertEqual(client.post(client.url, "{}", 0).status_code, 200)
+        self.assertEqual(responses, [])
+
+    def test_drops_when_busy_too_long(self):
+        client = self.make_client(failures=0, retries=3)
+        client.max_busy_wait = 0.5
+        client.session.post = lambda url, data, timeout: FakeResponse(503, {"Retry-After": "1"})
+        self.assertEqual(client.post(client.url, "{}", 0), None)
+
+    def test_busy_delay(self):
+        rng = random.Random(4)
+        self.assertEqual(1 <= requester.busy_delay("1", 0.5, 1, rng) <= 1.5, True)
+        # the backoff doubles every time, past what the server asked for
+        self.assertEqual(4 <= requester.busy_delay("1", 0.5, 4, rng) <= 6, True)
+        self.assertEqual(0.5 <= requester.busy_delay("Fri, 31 Dec 1999 23:59:59 GMT", 0.5, 1, rng) <= 0.75,
+                         True)
+
+    def test_new_session_after_fork(self):
+        client = requester.RequestClient('forker', 'http://127.0.0.1:8000', chunk_size=10000000)
+        session = client.get_session()
+        self.assertEqual(client.get_session() is session, True)
+        client.session_pid = -1
+        self.assertEqual(client.get_session() is session, False)
+
+
+class EventLoopEngineTest(unittest.TestCase):
+
+    def test_clients_say_hello_and_goodbye_in_order(self):
+        clients = []
+        for i in range(5):
+            client = RecordingClient('looper{}'.format(i), 'http://127.0.0.1:8000', runtime=0,
+                                     chunk_size=10000000)
+            client.sent = []
+            clients.append(client)
+        requester.EventLoopEngine(clients, workers=2).run()
+        for client in clients:
+            self.assertEqual([json.loads(payload)["data"] for url, payload in client.sent],
+                             ["Hello!", "Goodbye."])
+
+    def test_staggered_start(self):
+        clients = []
+        for i in range(3):
+            client = RecordingClient('stagger{}'.format(i), 'http://127.0.0.1:8000', runtime=0,
+                                     chunk_size=10000000)
+            client.sent = []
+            clients.append(client)
+        engine = requester.EventLoopEngine(clients, workers=3, offsets=[0, 0.1, 0.2])
+        engine.run()
+        starts = [json.loads(client.sent[0][1])["time"] for client in clients]
+        self.assertEqual(starts[1] - starts[0] >= 0.09, True)
+        self.assertEqual(starts[2] - starts[0] >= 0.19, True)
+        self.assertEqual(len(engine.connected), 3)
+
+
+class LaunchingClient(RecordingClient):
+    # remember when each step happened instead of forking anything
+
+    def start_processes(self):
+        self.started = time.time()
+
+
+class LaunchTest(unittest.TestCase):
+
+    def test_offsets(self):
+        self.assertEqual(requester.launch_offsets(3), [0, 0, 0])
+        self.assertEqual(requester.launch_offsets(5, "linear", ramp=8), [0, 2, 4, 6, 8])
+        self.assertEqual(requester.launch_offsets(5, "waves", wave_size=2, wave_interval=3), [0, 0, 3, 3, 6])
+        self.assertRaises(ValueError, requester.launch_offsets, 5, "sideways")
+
+    def test_report(self):
+        report = requester.launch_report(100, [(101, 0.5), (103, 0.25)], 3)
+        self.assertEqual((report["connected"], report["all_connected_s"]), (2, 3))
+        self.assertEqual(requester.launch_report(100, [], 3), {"clients": 3, "connected": 0})
+
+    def test_launcher(self):
+        clients = []
+        for i in range(6):
+            client = LaunchingClient('launched{}'.format(i), 'http://127.0.0.1:8000', chunk_size=10000000)
+            client.sent = []
+            clients.append(client)
+        start = time.time()
+        report = requester.Launcher(clients, requester.launch_offsets(6, "waves", wave_size=3,
+                                                                      wave_interval=0.2), threads=4).run()
+        self.assertEqual(report["connected"], 6)
+        self.assertEqual(report["all_connected_s"] >= 0.2, True)
+        for i, client in enumerate(clients):
+            self.assertEqual([json.loads(payload)["data"] for url, payload in client.sent], ["Hello!"])
+            # the second wave starts later, and the clock on its runtime starts when it does
+            self.assertEqual(client.start - start >= (0.19 if i >= 3 else 0), True)
+            self.assertEqual(client.started >= client.start, True)
+
+
+class SlowClient(RecordingClient):
+    # a server that takes a while to answer
+
+    def post(self, url, payload, now):
+        time.sleep(0.05)
+        self.sent.append((url, payload))
+
+
+class NegotiatingClient(RecordingClient):
+    # a server that wants a heartbeat every second
+
+    def post(self, url, payload, now):
+        self.sent.append((url, payload))
+        return FakeResponse(200, {wire.HEARTBEAT_INTERVAL: "1", wire.HEARTBEAT_TIMEOUT: "4"})
+
+
+class AdaptiveHeartbeatTest(unittest.TestCase):
+
+    def make_client(self, **kwargs):
+        client = NegotiatingClient('adaptive', 'http://127.0.0.1:8000', chunk_size=10000000,
+                                   workload={"heartbeat": {"kind": "fixed", "interval": 0.25}}, **kwargs)
+        client.sent = []
+        client.hello()
+        return client
+
+    def test_skips_heartbeats_when_other_things_were_sent(self):
+        client = self.make_client()
+        self.assertEqual(client.heartbeat_every.value, 1)
+        client.send_request(signal=1, data="some data")
+        client.heartbeat()
+        self.assertEqual(len(client.sent), 2)
+        self.assertEqual(client.heartbeats_skipped, 1)
+        # by the next check it'd have been quiet for longer than the server wants
+        client.last_contact.value = time.time() - 0.8
+        client.heartbeat()
+        self.assertEqual(len(client.sent), 3)
+        self.assertEqual(json.loads(client.sent[-1][1])["signal"], 0)
+
+    def test_batched_sends_count_once_they_go(self):
+        client = self.make_client(batch_window=60)
+        client.last_contact.value = 0
+        client.send_request(signal=1, data="held")
+        self.assertEqual(client.last_contact.value, 0)
+        client.flush()
+        self.assertEqual(client.last_contact.value > 0, True)
+
+    def test_turned_off(self):
+        client = self.make_client(adaptive_heartbeats=False)
+        self.assertEqual(client.heartbeat_every.value, 0)
+        client.send_request(signal=1, data="some data")
+        client.heartbeat()
+        self.assertEqual(len(client.sent), 3)
+
+
+class WorkloadTest(unittest.TestCase):
+
+    def take(self, times, count):
+        return [round(next(times), 6) for _ in range(count)]
+
+    def test_arrivals(self):
+        self.assertEqual(self.take(requester.arrivals({"kind": "fixed", "interval": 2}, 10), 3), [12, 14, 16])
+        burst = requester.arrivals({"kind": "burst", "interval": 1, "burst": 2, "idle": 5}, 0)
+        self.assertEqual(self.take(burst, 5), [1, 2, 8, 9, 15])
+        times = self.take(requester.arrivals({"kind": "poisson", "interval": 2}, 0, random.Random(1)), 2000)
+        self.assertEqual(times, sorted(times))
+        self.assertAlmostEqual(times[-1] / 2000, 2, delta=0.2)
+        self.assertRaises(ValueError, requester.arrivals, {"kind": "sometimes", "interval": 1}, 0)
+        self.assertRaises(ValueError, requester.RequestClient, 'bad', 'http://127.0.0.1:8000',
+                          workload={"data": {"kind": "sometimes", "interval": 1}})
+
+    def test_schedule_stops_at_runtime(self):
+        client = RecordingClient('scheduled', 'http://127.0.0.1:8000', runtime=10, chunk_size=10000000,
+                                 workload={"heartbeat": {"kind": "fixed", "interval": 3}})
+        self.assertEqual(list(client.schedule("heartbeat", 0)), [3, 6, 9])
+        self.assertEqual(list(client.schedule("monitor", 0)), [])
+
+    def test_latency_counts_from_intended_time(self):
+        # heartbeats are due every 10ms but each one takes 50ms, so they fall further and further behind
+        client = SlowClient('behind', 'http://127.0.0.1:8000', runtime=0.295, chunk_size=10000000,
+                            workload={"heartbeat": {"kind": "fixed", "interval": 0.01}})
+        client.sent = []
+        client.end_data_tunnel.set()
+        client.start = time.time()
+        client.heartbeats()
+        # 29 heartbeats and a goodbye, even though sending them took far longer than the runtime
+        self.assertEqual(len(client.sent), 30)
+        report = requester.schedule_report([("heartbeat", 0, 1, 1.5), ("heartbeat", 0, 3, 3.5),
+                                            ("data", 2, 2, None)])
+        self.assertEqual(report["heartbeat"]["count"], 2)
+        self.assertEqual((report["heartbeat"]["lag_p99"], report["heartbeat"]["latency_p99"],
+                          report["heartbeat"]["service_p99"]), (3, 3.5, 0.5))
+        self.assertEqual(report["data"]["latency_p50"], None)
+
+    def test_recorded_send_times(self):
+        client = SlowClient('recorded', 'http://127.0.0.1:8000', chunk_size=10000000)
+        client.sent = []
+        intended = time.time() - 1
+        client.send_request(signal=0, data="Heartbeat", intended=intended, kind="heartbeat")
+        kind, when, actual, done = client.send_times[0]
+        self.assertEqual((kind, when), ("heartbeat", intended))
+        self.assertEqual(actual - when >= 1, True)
+        self.assertEqual(done - actual >= 0.05, True)
+
+
+class LatencyTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = latency.HdrHistogram()
+        # exact below 256us, and within 1% after that
+        for value in (0, 1, 255, 256, 1000, 123456, 3600 * 1000000):
+            bucket = histogram.index(value)
+            self.assertEqual(histogram.highest_equivalent(bucket) >= value, True)
+            self.assertEqual(histogram.highest_equivalent(bucket) - value <= value / 100.0, True)
+            self.assertEqual(bucket == 0 or histogram.highest_equivalent(bucket - 1) < value, True)
+
+    def test_percentiles(self):
+        histogram = latency.HdrHistogram()
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000.0)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 1000)
+        self.assertAlmostEqual(summary["p50"], 0.5, delta=0.005)
+        self.assertAlmostEqual(summary["p99"], 0.99, delta=0.01)
+        self.assertAlmostEqual(summary["p999"], 0.999, delta=0.01)
+        self.assertEqual(summary["max"], 1.0)
+        self.assertEqual(latency.HdrHistogram().percentile(50), None)
+
+    def test_merge(self):
+        fast, slow = latency.HdrHistogram(), latency.HdrHistogram()
+        for i in range(99):
+            fast.record(0.001)
+        slow.record(2)
+        dumps = [{"heartbeat": {"round_trip": fast.to_dict()}},
+                 {"heartbeat": {"round_trip": slow.to_dict()}, "data": {"round_trip": slow.to_dict()}}]
+        # through JSON, like a benchmark run would save them
+        merged = latency.merge_all(json.loads(json.dumps(dumps)))
+        summary = latency.report(merged)["heartbeat"]["round_trip"]
+        self.assertEqual((summary["count"], summary["max"]), (100, 2))
+        # the top of the bucket 1ms is in
+        self.assertAlmostEqual(summary["p50"], 0.001, delta=0.00001)
+        self.assertEqual(summary["p999"], 2)
+        self.assertEqual(latency.report(merged)["data"]["round_trip"]["count"], 1)
+        self.assertRaises(ValueError, fast.merge, latency.HdrHistogram(sub_bucket_bits=10))
+        self.assertEqual(latency.format_report(latency.report(merged)).splitlines()[0].split()[-1], "max")
+
+    def test_client_records_and_sends_back(self):
+        results = multiprocessing.Queue()
+        client = SlowClient('timed', 'http://127.0.0.1:8000', chunk_size=10000000, results=results)
+        client.sent = []
+        client.send_request(signal=0, data="Heartbeat", intended=time.time() - 1, kind="heartbeat")
+        response = FakeResponse(200)
+        response.headers = {wire.PROCESSING_TIME: "0.010000"}
+        client.record_latency("batch", time.time() - 0.05, response)
+        self.assertEqual(sorted(client.latencies["heartbeat"]), ["round_trip", "scheduled"])
+        self.assertEqual(client.latencies["heartbeat"]["scheduled"].max >= 1000000, True)
+        self.assertEqual(client.latencies["batch"]["server"].max, 10000)
+        self.assertAlmostEqual(client.latencies["batch"]["network"].max / 1e6, 0.04, delta=0.01)
+        client.send_latencies()
+        self.assertEqual(client.latencies, {})
+        dump = results.get(timeout=5)
+        self.assertEqual(dump["heartbeat"]["round_trip"]["counts"][0][1], 1)
+
+    def test_hello_counted_once_across_processes(self):
+        results = multiprocessing.Queue()
+        client = RecordingClient('forked', 'http://127.0.0.1:8000', runtime=0, chunk_size=10000000,
+                                 results=results)
+        client.sent = []
+        client.hello()
+        client.start_processes()
+        dumps = [client.latency_dump()] + requester.collect_latencies(results, 3, 20)
+        self.assertEqual(len(dumps), 4)
+        report = latency.report(latency.merge_all(dumps))
+        # the hello and the goodbye, and nothing else
+        self.assertEqual(report.keys(), ["client_info"])
+        self.assertEqual(report["client_info"]["round_trip"]["count"], 2)
+
+
+class LoadBenchTest(unittest.TestCase):
+
+    def test_stalled_client_goes_quiet(self):
+        client = loadbench.SyntheticClient('stalls', 'http://127.0.0.1:8000', 100, runtime=10,
+                                           chunk_size=10000000, stall_after=3,
+                                           workload={"heartbeat": {"kind": "fixed", "interval": 1}})
+        client.post = lambda url, payload, now: None
+        self.assertEqual(list(client.schedule("heartbeat", 0)), [1, 2])
+        client.send_request(signal=2, data="Goodbye.")
+        self.assertEqual(client.last_sent, None)
+        client.write_chunk(intended=time.time())
+        self.assertEqual(client.latencies["data"]["scheduled"].total, 1)
+        self.assertEqual(client.last_sent is not None, True)
+
+    def test_compare(self):
+        def results(rps, p99):
+            return {"runs": [{"clients": 10, "heartbeat_rate": 1, "payload_size": 100, "server_rps": rps,
+                              "latency": {"heartbeat": {"round_trip": {"p50": 0.001, "p99": p99}}},
+                              "server": {"cpu_percent_mean": 10}, "timeouts": {}}]}
+        self.assertEqual(loadbench.compare(results(100, 0.01), results(95, 0.0105)), [])
+        regressions = loadbench.compare(results(100, 0.01), results(50, 0.02))
+        self.assertEqual([name for run, name, was, now in regressions], ["server_rps", "heartbeat p99"])
+        failed = {"runs": [{"clients": 10, "heartbeat_rate": 1, "payload_size": 100, "failed": "crashed"}]}
+        self.assertEqual([name for run, name, was, now in loadbench.compare(results(100, 0.01), failed)],
+                         ["failed"])
+        self.assertEqual(loadbench.compare(failed, results(100, 0.01)), [])
+
+    def test_collect_gives_up_on_crashed_fleet(self):
+        results = multiprocessing.Queue()
+        jobs = [multiprocessing.Process(target=results.put, args=({"quiet": []},)),
+                multiprocessing.Process(target=os._exit, args=(1,))]
+        for job in jobs:
+            job.start()
+        start = time.time()
+        self.assertEqual(loadbench.collect(jobs, results, time.time() + 30), None)
+        self.assertEqual(time.time() - start < 5, True)
+        for job in jobs:
+            job.join()
+
+    def test_collect_deadline(self):
+        results = multiprocessing.Queue()
+        job = multiprocessing.Process(target=time.sleep, args=(5,))
+        job.start()
+        self.assertEqual(loadbench.collect([job], results, time.time() + 0.2), None)
+        job.terminate()
+        job.join()
+        job = multiprocessing.Process(target=results.put, args=({"quiet": []},))
+        job.start()
+        self.assertEqual(loadbench.collect([job], results, time.time() + 5), [{"quiet": []}])
+        job.join()
+
+
+class EventLoopServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.seen = []
+        routes = {"/": self.echo, "/slow": FlaskServer.timed(self.slow), "/big": self.big}
+        self.server = eventserver.EventLoopServer(routes, logging.getLogger('test'), max_body=1000)
+        sock = self.server.listen(0)
+        self.url = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+        t = threading.Thread(target=self.server.serve_forever, kwargs={'sock': sock})
+        t.daemon = True
+        t.start()
+
+    def echo(self, req):
+        self.seen.append(req)
+        return req.data or "Hi", 200, {"X-Seen": str(len(self.seen))}
+
+    def slow(self, req):
+        time.sleep(0.02)
+        return "Hello"
+
+    def big(self, req):
+        self.seen.append(req)
+        return "x" * 100000
+
+    def test_processing_time_header(self):
+        client = requester.RequestClient('timed', self.url + "/slow", chunk_size=10000000)
+        client.send_request(signal=0, data="Heartbeat")
+        parts = client.latencies["heartbeat"]
+        self.assertEqual(parts["server"].max >= 20000, True)
+        self.assertEqual(parts["round_trip"].max >= parts["server"].max, True)
+        self.assertEqual(parts["network"].total, 1)
+
+    def test_keep_alive_requests(self):
+        session = requester.requests.Session()
+        for i in range(5):
+            r = session.post(self.url, data="hello {}".format(i))
+            self.assertEqual(r.text, "hello {}".format(i))
+            self.assertEqual(r.headers["X-Seen"], str(i + 1))
+        # everything came over the one connection
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_query_args_and_headers(self):
+        requester.requests.get(self.url + "/?last=5", headers={"X-Thing": "yes"})
+        self.assertEqual(self.seen[0].args, {"last": "5"})
+        self.assertEqual(self.seen[0].headers.get("X-THING"), "yes")
+
+    def test_not_found(self):
+        self.assertEqual(requester.requests.get(self.url + "/nope").status_code, 404)
+
+    def test_body_too_large(self):
+        self.assertEqual(requester.requests.post(self.url, data="x" * 2000).status_code, 413)
+
+    def test_pipelined_requests(self):
+        sock = socket.create_connection(('127.0.0.1', int(self.url.rsplit(':', 1)[1])))
+        sock.sendall("POST / HTTP/1.1\r\nContent-Length: 1\r\n\r\na"
+                     "POST / HTTP/1.1\r\nContent-Length: 1\r\nConnection: close\r\n\r\nb")
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        self.assertEqual(response.count("HTTP/1.1 200 OK"), 2)
+        self.assertEqual(response.endswith("b"), True)
+
+    def test_pipelining_without_reading(self):
+        self.server.max_outbuf = 200000
+        sock = socket.create_connection(('127.0.0.1', int(self.url.rsplit(':', 1)[1])))
+        sock.sendall("GET /big HTTP/1.1\r\n\r\n" * 199 + "GET /big HTTP/1.1\r\nConnection: close\r\n\r\n")
+        time.sleep(0.5)
+        # 20MB of responses, but only a couple of them are kept waiting for us at once
+        conn = self.server.connections.values()[0]
+        self.assertEqual(len(conn.outbuf) < 300000, True)
+        self.assertEqual(len(self.seen) < 200, True)
+        received = 0
+        while True:
+            data = sock.recv(1048576)
+            if not data:
+                break
+            received += len(data)
+        sock.close()
+        self.assertEqual(len(self.seen), 200)
+        self.assertEqual(received > 200 * 100000, True)
+
+    def test_busy_past_max_in_flight(self):
+        self.server.max_in_flight = 1
+        sock = socket.create_connection(('127.0.0.1', int(self.url.rsplit(':', 1)[1])))
+        # both of these come in together, so only the first one gets handled
+        sock.sendall("POST / HTTP/1.1\r\nContent-Length: 1\r\n\r\na"
+                     "POST / HTTP/1.1\r\nContent-Length: 1\r\nConnection: close\r\n\r\nb")
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        self.assertEqual(response.count("HTTP/1.1 200 OK"), 1)
+        self.assertEqual("HTTP/1.1 503 Service Unavailable" in response, True)
+        self.assertEqual("Retry-After: 1" in response, True)
+        self.assertEqual([req.data for req in self.seen], ["a"])
+        # and GETs always get through
+        self.assertEqual(requester.requests.get(self.url).status_code, 200)
+
+
+class ClientTableTest(unittest.TestCase):
+
+    def add_client(self, table, name):
+        table.get_or_create(name, 100)
+
+    def test_create_then_get(self):
+        table = clientstate.ClientTable(10)
+        client, created = table.get_or_create(u'hello', 100)
+        self.assertEqual(created, True)
+        self.assertEqual(client.current_heartbeat, 100)
+        again, created = table.get_or_create(u'hello', 200)
+        self.assertEqual(created, False)
+        again.active = False
+        self.assertEqual(client.active, False)
+
+    def test_collisions_and_full_table(self):
+        table = clientstate.ClientTable(4)
+        for i in range(4):
+            self.assertEqual(table.get_or_create('client{}'.format(i), 0)[1], True)
+        self.assertEqual(table.get_or_create('one too many', 0), (None, False))
+        self.assertEqual(sorted(name for name, client in table.items()),
+                         ['client0', 'client1', 'client2', 'client3'])
+
+    def test_visible_across_processes(self):
+        table = clientstate.ClientTable(10)
+        p = multiprocessing.Process(target=self.add_client, args=(table, 'forked'))
+        p.start()
+        p.join()
+        self.assertEqual(table.get('forked').current_heartbeat, 100)
+        self.assertEqual(table.get_or_create('forked', 0)[1], False)
+
+    def test_active_count(self):
+        table = clientstate.ClientTable(10)
+        for i in range(3):
+            table.get_or_create('client{}'.format(i), 0)
+        self.assertEqual(table.active_count(), 3)
+        self.assertEqual(table.get('client0').deactivate(), True)
+        # saying goodbye twice only counts once
+        self.assertEqual(table.get('client0').deactivate(), False)
+        table.get('client1').active = False
+        self.assertEqual(table.active_count(), 1)
+
+    def test_liveness_watches_table(self):
+        table = clientstate.ClientTable(10)
+        timed_out = []
+        scheduler = liveness.LivenessScheduler(timeout=30, log=logging.getLogger('test'),
+                                               on_timeout=timed_out.append)
+        scheduler.thread = True
+        scheduler.watch(table)
+        table.get_or_create('watched', 0)
+        for now in range(1, 40):
+            scheduler.tick(now)
+        self.assertEqual([client.name for client in timed_out], ['watched'])
+        self.assertEqual(table.get('watched').active, False)
+        self.assertEqual(table.active_count(), 0)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def counters(self):
+        return dict((name, CustomFlask.ShardedCounter(0))
+                    for name in ("total_connections", "total_goodbyes", "total_timeouts"))
+
+    def test_torn_record(self):
+        path = os.path.join(self.dir, "journal.0")
+        with open(path, 'wb') as f:
+            f.write(journal.pack(journal.HELLO, u'first', 1.0))
+            f.write(journal.pack(journal.GOODBYE, u'first', 2.0))
+            # the server died halfway through writing this one
+            f.write(journal.pack(journal.HELLO, u'second', 3.0)[:30])
+        self.assertEqual(journal.read_records(path),
+                         [(journal.HELLO, 1.0, 'first'), (journal.GOODBYE, 2.0, 'first')])
+        # and one that got garbled stops everything after it too
+        with open(path, 'r+b') as f:
+            f.seek(10)
+            f.write("x")
+        self.assertEqual(journal.read_records(path), [])
+
+    def test_snapshot_and_replay(self):
+        table = clientstate.ClientTable(10)
+        saved = journal.Journal(self.dir, table)
+        counters = self.counters()
+        for i in range(3):
+            table.get_or_create('client{}'.format(i), 100)
+        counters["total_connections"].increment(3)
+        table.get('client0').deactivate()
+        counters["total_goodbyes"].increment()
+        self.assertEqual(saved.snapshot(counters), 3)
+        # this is already in the snapshot, so replaying it changes nothing
+        saved.record(journal.GOODBYE, 'client0', 105)
+        table.get_or_create('client3', 110)
+        saved.record(journal.HELLO, 'client3', 110)
+        saved.record(journal.TIMEOUT, 'client1', 115)
+        saved.record(journal.WATERMARK, '', 120)
+
+        for capacity in (10, 20):
+            restored_table = clientstate.ClientTable(capacity)
+            restored = journal.Journal(self.dir, restored_table)
+            restored_counters = self.counters()
+            taken = journal.SNAPSHOT.unpack_from(open(saved.snapshot_path(), 'rb').read())[3]
+            result = restored.restore(restored_counters, now=taken + 50)
+            self.assertEqual(result["clients"], 4)
+            self.assertEqual(result["active"], 2)
+            self.assertEqual(result["replayed"], 4)
+            self.assertEqual(dict((name, counter.value()) for name, counter in restored_counters.items()),
+                             {"total_connections": 4, "total_goodbyes": 1, "total_timeouts": 1})
+            self.assertEqual(sorted(name for name, client in restored_table.items() if client.active),
+                             ['client2', 'client3'])
+            # nobody gets charged for the time since the snapshot
+            self.assertAlmostEqual(restored_table.get('client2').current_heartbeat, 150)
+            self.assertAlmostEqual(restored_table.get('client3').current_heartbeat, 160)
+            self.assertEqual(restored_table.get('client0').current_heartbeat, 100)
+            # anything new goes after the journal that got replayed
+            self.assertEqual(restored.generation.value, 2)
+
+    def test_hello_during_snapshot(self):
+        table = clientstate.ClientTable(10)
+        saved = journal.Journal(self.dir, table)
+        counters = self.counters()
+        connections = counters["total_connections"]
+        saved.hello('first', 100, connections)
+        late = []
+        value = connections.value
+
+        def hello_while_reading():
+            # someone says hello just as the snapshot reads the counters
+            if not late:
+                late.append(threading.Thread(target=saved.hello, args=('late', 101, connections)))
+                late[0].start()
+                late[0].join(0.2)
+            return value()
+        connections.value = hello_while_reading
+        self.assertEqual(saved.snapshot(counters), 1)
+        late[0].join()
+        self.assertEqual(value(), 2)
+
+        restored_counters = self.counters()
+        result = journal.Journal(self.dir, clientstate.ClientTable(10)).restore(restored_counters)
+        self.assertEqual((result["clients"], result["replayed"]), (2, 1))
+        self.assertEqual(restored_counters["total_connections"].value(), 2)
+
+    def test_deactivate_counts_once(self):
+        table = clientstate.ClientTable(10)
+        saved = journal.Journal(self.dir, table)
+        counters = self.counters()
+        client, created = saved.hello('leaving', 100, counters["total_connections"])
+        self.assertEqual(saved.hello('leaving', 101, counters["total_connections"])[1], False)
+        self.assertEqual(saved.deactivate(client, journal.GOODBYE, 102, counters["total_goodbyes"]), True)
+        self.assertEqual(saved.deactivate(client, journal.TIMEOUT, 103, counters["total_timeouts"]), False)
+        self.assertEqual([counter.value() for name, counter in sorted(counters.items())], [1, 1, 0])
+        self.assertEqual([kind for kind, when, name in journal.read_records(saved.path(0))],
+                         [journal.HELLO, journal.GOODBYE])
+
+    def test_journal_without_snapshot(self):
+        saved = journal.Journal(self.dir, clientstate.ClientTable(10))
+        saved.record(journal.HELLO, 'early', 10)
+        saved.record(journal.HELLO, 'early', 11)
+        table = clientstate.ClientTable(10)
+        counters = self.counters()
+        result = journal.Journal(self.dir, table).restore(counters, now=30)
+        self.assertEqual((result["clients"], result["active"], result["down_s"]), (1, 1, 19))
+        self.assertEqual(counters["total_connections"].value(), 1)
+        self.assertEqual(table.get('early').current_heartbeat, 30)
+
+    def test_clear(self):
+        saved = journal.Journal(self.dir, clientstate.ClientTable(10))
+        saved.record(journal.HELLO, 'gone', 10)
+        saved.snapshot(self.counters())
+        saved.clear()
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(journal.Journal(self.dir, clientstate.ClientTable(10)).restore(self.counters()),
+                         {"clients": 0, "active": 0, "replayed": 0, "down_s": None})
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram(buckets=(1, 2, 5))
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+        counts, total = histogram.snapshot()
+        self.assertEqual(counts, [2, 1, 1, 1])
+        self.assertAlmostEqual(total, 16)
+
+    def test_bucket_counts(self):
+        self.assertEqual(metrics.bucket_counts([0.5, 1.5, 9], (1, 2)), ([1, 1, 1], 11.0))
+
+    def test_format_histogram_is_cumulative(self):
+        lines = metrics.format_histogram("lag", "Lag.", (1, 2), [({"who": "me"}, [1, 2, 3], 4.5)])
+        self.assertEqual(lines[2:], ['lag_bucket{le="1",who="me"} 1',
+                                     'lag_bucket{le="2",who="me"} 3',
+                                     'lag_bucket{le="+Inf",who="me"} 6',
+                                     'lag_sum{who="me"} 4.5',
+                                     'lag_count{who="me"} 6'])
+
+    def test_labels_escaped(self):
+        self.assertEqual(metrics.format_labels({"client": 'say "hi"'}), u'{client="say \\"hi\\""}')
+
+
+class IOStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_percentile(self):
+        self.assertEqual(requester.percentile(range(1, 101), 50), 51)
+        self.assertEqual(requester.percentile(range(1, 101), 99), 99)
+        self.assertEqual(requester.percentile([], 99), None)
+
+    def test_histogram_percentile(self):
+        self.assertEqual(metrics.histogram_percentile((1, 2, 5), [50, 40, 9, 1], 50), 1)
+        self.assertEqual(metrics.histogram_percentile((1, 2, 5), [50, 40, 9, 1], 99), 5)
+        self.assertEqual(metrics.histogram_percentile((1, 2, 5), [0, 0, 0, 1], 99), float('inf'))
+
+    def test_client_sends_stats_every_n_writes(self):
+        client = RecordingClient('writer', 'http://127.0.0.1:8000', chunk_size=100, file_size=250,
+                                 io_report_every=3)
+        client.sent = []
+        client.base_name = os.path.join(self.dir, 'writer')
+        client.gen = requester.files_gen(client.base_name)
+        for i in range(4):
+            client.write_chunk()
+        client.finish_data()
+        stats = [json.loads(payload)["data"] for url, payload in client.sent
+                 if json.loads(payload)["signal"] == 3]
+        self.assertEqual([len(s["latencies_us"]) for s in stats], [3, 1])
+        self.assertEqual([s["bytes"] for s in stats], [300, 100])
+        # 250 byte files fit two chunks, so the third write rolls over
+        self.assertEqual(sum(len(s["rollovers_us"]) for s in stats), 1)
+
+    def test_server_records_stats(self):
+        table = clientstate.ClientTable(10)
+        shared, created = table.get_or_create('writer', 0)
+        client = FlaskServer.ClientManager('writer', shared.slot, table, created=False)
+        before = sum(FlaskServer.io_write_seconds.snapshot()[0])
+        client.record_io({"bytes": 2000000, "latencies_us": [500000, 500000], "rollovers_us": [10]})
+        self.assertEqual(sum(FlaskServer.io_write_seconds.snapshot()[0]) - before, 2)
+        self.assertEqual(shared.slot.io_bytes, 2000000)
+        self.assertAlmostEqual(shared.slot.io_seconds, 1.0)
+        # garbage gets logged and ignored
+        client.record_io("nope")
+        self.assertEqual(shared.slot.io_bytes, 2000000)
+
+
+class ProcInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sample_and_round_trip(self):
+        record = procinfo.sample(os.getpid(), 1.5)
+        self.assertEqual(record.time, 1.5)
+        self.assertEqual(record.rss > 0, True)
+        self.assertEqual(record.num_threads >= 1, True)
+        self.assertEqual(procinfo.decode(procinfo.encode(record)), record)
+
+    def test_decode_rejects_other_data(self):
+        self.assertEqual(procinfo.decode("(pcputimes(user=0.1, system=0.0), pmem(rss=1, vms=2))"), None)
+        self.assertEqual(procinfo.decode("aGVsbG8="), None)
+        self.assertEqual(procinfo.decode({"cpu": 1}), None)
+        self.assertEqual(procinfo.decode(u'caf\xe9'), None)
+
+    def test_read_time_range(self):
+        path = os.path.join(self.dir, 'client.proc')
+        with open(path, 'wb') as f:
+            for i in range(10):
+                f.write(procinfo.pack(procinfo.ProcRecord(float(i), 0, 0, i * 100, 0, 0, 0, 0, 0, 0, 0, 1)))
+        self.assertEqual(len(procinfo.read_records(path)), 10)
+        self.assertEqual([r.time for r in procinfo.read_records(path, start=3, end=5)], [3, 4, 5])
+        self.assertEqual(procinfo.read_records(path, start=20), [])
+        self.assertEqual(procinfo.read_column(path, "rss")[-1], 900)
+
+    def test_server_writes_records_to_proc_file(self):
+        table = clientstate.ClientTable(10)
+        shared, created = table.get_or_create('prober', 0)
+        client = FlaskServer.ClientManager(os.path.join(self.dir, 'prober'), shared.slot, table,
+                                           created=False)
+        record = procinfo.sample(os.getpid(), 2.0)
+        client.write_data(procinfo.encode(record))
+        client.write_data("just text")
+        self.assertEqual(FlaskServer.data_sink.sync(timeout=5), True)
+        self.assertEqual(procinfo.read_records(client.procfile), [record])
+        with open(client.datafile) as f:
+            self.assertEqual(f.read(), "just text\n")
+        FlaskServer.data_sink.close()
+
+    def test_server_writes_non_ascii_text(self):
+        table = clientstate.ClientTable(10)
+        shared, created = table.get_or_create('accented', 0)
+        client = FlaskServer.ClientManager(os.path.join(self.dir, 'accented'), shared.slot, table,
+                                           created=False)
+        client.write_data(u'caf\xe9 \u2603')
+        self.assertEqual(FlaskServer.data_sink.sync(timeout=5), True)
+        with open(client.datafile) as f:
+            self.assertEqual(f.read().decode('utf-8'), u'caf\xe9 \u2603\n')
+        FlaskServer.data_sink.close()
+
+    def make_record(self, when, cpu, rss, written):
+        return procinfo.ProcRecord(when, cpu, 0, rss, 0, 0, 0, 0, written, 10, 0, 3)
+
+    def test_window_min_max_mean(self):
+        sampler = procinfo.ProcSampler(os.getpid(), 0.1, logging.getLogger('test'))
+        window = sampler.subscribe()
+        self.assertEqual(window.take(), None)
+        # half a core, then a whole core, then idle
+        for when, cpu, rss in [(0, 0, 100), (1, 0.5, 200), (2, 1.5, 400), (3, 1.5, 300)]:
+            sampler.add(self.make_record(when, cpu, rss, when * 1000))
+        record = window.take()
+        self.assertEqual((record.start, record.end, record.samples), (1, 3, 3))
+        self.assertEqual((record.cpu_min, record.cpu_max), (0, 100))
+        self.assertAlmostEqual(record.cpu_mean, 50)
+        self.assertEqual((record.rss_min, record.rss_max, record.rss_mean), (200, 400, 300))
+        self.assertEqual((record.rss_delta, record.write_bytes_delta), (100, 2000))
+        # the next window's deltas pick up where this one left off
+        sampler.add(self.make_record(4, 1.5, 250, 5000))
+        record = window.take()
+        self.assertEqual((record.samples, record.rss_delta, record.write_bytes_delta), (1, -50, 2000))
+        self.assertEqual(procinfo.decode(procinfo.encode(record)), record)
+
+    def test_sampler_thread(self):
+        sampler = procinfo.ProcSampler(os.getpid(), 0.01, logging.getLogger('test'))
+        window = sampler.subscribe()
+        sampler.start()
+        threading.Event().wait(0.3)
+        sampler.stop()
+        self.assertEqual(window.take().samples > 5, True)
+
+    def test_sampler_process_already_gone(self):
+        proc = multiprocessing.Process(target=time.sleep, args=(0,))
+        proc.start()
+        proc.join()
+        sampler = procinfo.ProcSampler(proc.pid, 0.01, logging.getLogger('test'))
+        window = sampler.subscribe()
+        sampler.run()
+        self.assertEqual(window.take(), None)
+
+    def test_server_writes_windows_to_window_file(self):
+        table = clientstate.ClientTable(10)
+        shared, created = table.get_or_create('sampled', 0)
+        client = FlaskServer.ClientManager(os.path.join(self.dir, 'sampled'), shared.slot, table,
+                                           created=False)
+        record = procinfo.WindowRecord(1.0, 2.0, 20, 0.0, 12.5, 50.0, 100, 300, 200.0, -20, 0, 4096, 7, 3)
+        client.write_data(procinfo.encode(record))
+        self.assertEqual(FlaskServer.data_sink.sync(timeout=5), True)
+        self.assertEqual(procinfo.read_records(client.windowfile, kind=procinfo.WindowRecord), [record])
+        self.assertEqual(procinfo.read_column(client.windowfile, "cpu_max", procinfo.WindowRecord), [50.0])
+        FlaskServer.data_sink.close()
+
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = timeseries.TimeSeriesStore(capacity=4, depth=5)
+        self.sink = datasink.DataSink(logging.getLogger('test'), flush_interval=0.05)
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.dir)
+
+    def add(self, index, when):
+        # a quarter of a core, and 100 bytes written, every second
+        return self.store.add(index, procinfo.ProcRecord(float(when), when * 0.25, 0, 1000 + when, 0, 0, 0, 0,
+                                                         when * 100, 0, 0, 2))
+
+    def test_rates_and_ring(self):
+        first = self.add(1, 0)
+        self.assertEqual((first.cpu_percent, first.io_bytes), (0, 0))
+        for when in range(1, 10):
+            self.add(1, when)
+        points = self.store.recent(1)
+        # the ring holds 5, and we leave one out for a writer to use
+        self.assertEqual([p.time for p in points], [6, 7, 8, 9])
+        self.assertEqual([p.time for p in self.store.recent(1, 2)], [8, 9])
+        self.assertAlmostEqual(points[-1].cpu_percent, 25)
+        self.assertEqual(points[-1].io_bytes, 100)
+        # other clients have their own rings
+        self.assertEqual(self.store.recent(2), [])
+
+    def test_compact_then_query(self):
+        path = os.path.join(self.dir, 'client.ts')
+        for when in range(3):
+            self.add(0, when)
+        self.assertEqual(self.store.compact([(0, path)], self.sink, logging.getLogger('test')), 3)
+        for when in range(3, 6):
+            self.add(0, when)
+        # 0-2 come off disk, 3-5 out of memory, and nothing twice
+        self.assertEqual([p.time for p in self.store.query(0, path)], range(6))
+        self.assertEqual([p.time for p in self.store.query(0, path, start=2, end=4)], [2, 3, 4])
+        summary = timeseries.aggregate(self.store.query(0, path, start=1))
+        self.assertEqual((summary["count"], summary["io_bytes"]), (5, 500))
+        self.assertEqual(summary["rss"]["max"], 1005)
+        self.assertEqual(self.store.compact([(0, path)], self.sink, logging.getLogger('test')), 3)
+        self.assertEqual(len(procinfo.read_range(path, timeseries.LAYOUT, timeseries.Point)), 6)
+
+    def test_series_endpoint(self):
+        client, created = FlaskServer.client_table.get_or_create('series_client', 0)
+        index = FlaskServer.client_table.index_of(client.slot)
+        FlaskServer.series.add(index, procinfo.WindowRecord(1.0, 2.0, 20, 0.0, 12.5, 50.0, 100, 300, 200.0,
+                                                            -20, 0, 4096, 7, 3))
+
+        def get(**args):
+            return FlaskServer.handle_series(eventserver.Request('GET', '/series', args,
+                                                                 eventserver.Headers(), ''))
+        body, status, headers = get(client='series_client', last='5')
+        self.assertEqual(json.loads(body)["points"], [[2.0, 12.5, 200, 4096, 3]])
+        body, status, headers = get(client='series_client', start='0', end='10')
+        self.assertEqual(json.loads(body)["summary"]["cpu_percent"]["max"], 12.5)
+        self.assertEqual(get(client='nobody')[1], 404)
+        self.assertEqual(get(client='series_client', last='many')[1], 400)
+
+
+class WireTest(unittest.TestCase):
+
+    def test_binary_round_trip(self):
+        messages = [wire.Message(u'caf\xe9', 0, 1.5, u'Heartbeat'),
+                    wire.Message(u'b', 3, 2.0, {u"bytes": 10, u"latencies_us": [1, 2]})]
+        body = "".join(wire.encode(message) for message in messages)
+        self.assertEqual(wire.parse(body, wire.BINARY_TYPE), messages)
+
+    def test_bad_frames(self):
+        frame = wire.encode(wire.Message(u'a', 0, 1.0, u'Heartbeat'))
+        for body in (frame[:5], frame[:-1], frame + frame[:3]):
+            self.assertRaises(wire.BadRequest, wire.parse, body, wire.BINARY_TYPE)
+        self.assertRaises(wire.BadRequest, wire.parse, "not json")
+        self.assertRaises(wire.BadRequest, wire.parse, "5")
+
+    def test_json_formats(self):
+        self.assertEqual(wire.parse('{"name": "a"}'), [{"name": "a"}])
+        self.assertEqual(len(wire.parse('[{"name": "a"}, {"name": "b"}]')), 2)
+        self.assertEqual(len(wire.parse('{"name": "a"}\n{"name": "b"}\n')), 2)
+
+    def test_binary_client(self):
+        client = RecordingClient('framer', 'http://127.0.0.1:8000', chunk_size=10000000, batch_window=60,
+                                 wire_format="binary")
+        client.sent = []
+        client.send_request(signal=0, data="Heartbeat")
+        client.send_request(signal=3, data={"bytes": 5})
+        client.flush()
+        self.assertEqual(client.get_session().headers['Content-Type'], wire.BINARY_TYPE)
+        messages = FlaskServer.parse_batch(client.sent[0][1], wire.BINARY_TYPE)
+        self.assertEqual([(m.name, m.signal, m.data) for m in messages],
+                         [('framer', 0, 'Heartbeat'), ('framer', 3, {'bytes': 5})])
+
+    def test_admit(self):
+        table, FlaskServer.client_table = FlaskServer.client_table, clientstate.ClientTable(2)
+        ccs, FlaskServer.CCs = FlaskServer.CCs, {}
+        try:
+            FlaskServer.client_table.get_or_create(u'elsewhere', 0)
+            shared, created = FlaskServer.client_table.get_or_create(u'here', 0)
+            # made like another worker saw it first, so it doesn't write a data file
+            FlaskServer.CCs[u'here'] = FlaskServer.ClientManager(u'here', shared.slot,
+                                                                FlaskServer.client_table, created=False)
+            self.assertEqual(FlaskServer.admit([{"name": "here", "signal": 0}, {"name": "elsewhere"}]), None)
+            body, status, headers = FlaskServer.admit([{"name": "here"}, wire.Message(u'new', 0, 1.0, u'')])
+            self.assertEqual((status, headers), (503, {"Retry-After": str(FlaskServer.RETRY_AFTER)}))
+
+            too_much = "x" * (FlaskServer.MAX_PENDING_BYTES + 1)
+            self.assertEqual(FlaskServer.admit([{"name": "here", "signal": 1, "data": too_much}])[1], 429)
+        finally:
+            FlaskServer.client_table, FlaskServer.CCs = table, ccs
+
+    def test_map_requests_takes_messages(self):
+        ccs = {}
+        # already in the table, so no data file gets made for it
+        FlaskServer.client_table.get_or_create(u'wired', 0)
+        message = wire.Message(u'wired', 0, 99.0, u'Heartbeat')
+        self.assertEqual(FlaskServer.map_requests(message, ccs), message)
+        self.assertEqual(ccs[u'wired'].current_heartbeat, 99.0)
+        self.assertEqual(FlaskServer.map_requests({"name": "wired", "signal": 0}, ccs), None)
+
+    def test_anything_counts_as_a_heartbeat(self):
+        ccs = {}
+        FlaskServer.client_table.get_or_create(u'chatty', 0)
+        FlaskServer.map_requests(wire.Message(u'chatty', 3, 120.0, {"bytes": 0, "latencies_us": []}), ccs)
+        self.assertEqual(ccs[u'chatty'].current_heartbeat, 120.0)
+        # one that got held up on the way doesn't take it back
+        FlaskServer.map_requests(wire.Message(u'chatty', 0, 110.0, u'Heartbeat'), ccs)
+        self.assertEqual(ccs[u'chatty'].current_heartbeat, 120.0)
+
+    def test_responses_say_how_often_to_heartbeat(self):
+        FlaskServer.client_table.get_or_create(u'told', 0)
+        req = eventserver.Request('POST', '/', {}, eventserver.Headers(),
+                                  wire.dumps({"name": "told", "signal": 0, "time": 1.0, "data": "Heartbeat"}))
+        body, status, headers = FlaskServer.ROUTES["/"](req)
+        self.assertEqual(float(headers[wire.HEARTBEAT_INTERVAL]), FlaskServer.HEARTBEAT_INTERVAL)
+        self.assertEqual(float(headers[wire.HEARTBEAT_TIMEOUT]), FlaskServer.TIMEOUT)
+
+
+class ListHandler(logging.Handler):
+    # remember what got written, and which thread wrote it
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+def log_in_child(log):
+    for i in range(100):
+        log.info("child %s", i)
+
+
+class AsyncLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, kind=None, level=logging.INFO):
+        record = logging.LogRecord('test', level, __file__, 0, "message", (), None)
+        if kind:
+            record.kind = kind
+        return record
+
+    def test_sampling(self):
+        sample = asynclog.SampleFilter(every={"heartbeat": 3})
+        self.assertEqual([sample.filter(self.record("heartbeat")) for _ in range(6)],
+                         [True, False, False, True, False, False])
+        self.assertEqual(sample.filter(self.record("data")), True)
+        self.assertEqual(sample.filter(self.record()), True)
+        self.assertEqual(sample.filter(self.record("heartbeat", logging.WARNING)), True)
+
+    def test_rate_limit(self):
+        limit = asynclog.SampleFilter(per_second={"data": 5})
+        self.assertEqual(sum(limit.filter(self.record("data")) for _ in range(20)) <= 10, True)
+
+    def test_written_on_writer_thread(self):
+        target = ListHandler()
+        handler = asynclog.QueueHandler([target])
+        log = logging.getLogger('asynclog_test')
+        log.setLevel(logging.DEBUG)
+        log.propagate = False
+        log.addHandler(handler)
+        try:
+            for i in range(50):
+                log.info("line %s", i)
+            handler.stop()
+        finally:
+            log.removeHandler(handler)
+        self.assertEqual(target.lines, ["line {}".format(i) for i in range(50)])
+        self.assertEqual(threading.current_thread().name in target.threads, False)
+
+    def test_per_client_files_and_forked_writers(self):
+        path = os.path.join(self.dir, 'main.log')
+        log = asynclog.setup('asynclog_fork', path,
+                             per_client=os.path.join(self.dir, 'client_{}.log'))
+        log.propagate = False
+        try:
+            # the child starts its own writer, and finishes writing before it exits
+            child = multiprocessing.Process(target=log_in_child,
+                                            args=(logging.getLogger('asynclog_fork.c1'),))
+            child.start()
+            child.join()
+            log.info("parent")
+            log.handlers[0].stop()
+        finally:
+            for handler in log.handlers:
+                handler.close()
+            log.handlers = []
+        with open(path) as f:
+            self.assertEqual(f.read().count(" - INFO - "), 101)
+        with open(os.path.join(self.dir, 'client_c1.log')) as f:
+            self.assertEqual(f.read().count("child"), 100)
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,177 @@
+""" Recent telemetry for every client, so you can look at a live run without digging through files.
+
+Each client gets a small ring buffer of points in shared memory, in the same slot as it has in the
+ClientTable, so whichever server worker handles a query sees what every other worker stored. Every so
+often the points nobody has saved yet get appended to <client>.ts as fixed size records, so queries
+further back than the ring goes can still be answered from disk.
+"""
+import ctypes
+import struct
+from collections import namedtuple
+from multiprocessing import RawArray
+
+import procinfo
+
+# cpu is in percent of one core; io_bytes is how much was read and written since the point before
+FIELDS = ("time", "cpu_percent", "rss", "io_bytes", "num_threads")
+Point = namedtuple("Point", FIELDS)
+LAYOUT = struct.Struct("<2d2QI")
+
+
+class PointSlot(ctypes.Structure):
+    _fields_ = [("time", ctypes.c_double),
+                ("cpu_percent", ctypes.c_double),
+                ("rss", ctypes.c_uint64),
+                ("io_bytes", ctypes.c_uint64),
+                ("num_threads", ctypes.c_uint32)]
+
+
+class Cursor(ctypes.Structure):
+    """ Where each client's ring buffer is up to, and what its last process sample said, so the next
+    sample can be turned into rates.
+    """
+    _fields_ = [("head", ctypes.c_uint64),
+                ("compacted", ctypes.c_uint64),
+                ("sampled", ctypes.c_bool),
+                ("last_time", ctypes.c_double),
+                ("cpu_seconds", ctypes.c_double),
+                ("io_total", ctypes.c_uint64)]
+
+
+def to_point(record, cursor):
+    """ Turn a process info record into a point.
+    :param record: a procinfo.ProcRecord or procinfo.WindowRecord
+    :param Cursor cursor: the client's cursor, which remembers the last ProcRecord
+    :return Point: the point
+    """
+    if isinstance(record, procinfo.WindowRecord):
+        return Point(record.end, record.cpu_mean, int(record.rss_mean),
+                     record.read_bytes_delta + record.write_bytes_delta, record.num_threads)
+
+    cpu_seconds = record.cpu_user + record.cpu_system
+    io_total = record.read_bytes + record.write_bytes
+    cpu_percent, io_bytes = 0.0, 0
+    # the very first sample has nothing to compare with
+    if cursor.sampled and record.time > cursor.last_time:
+        cpu_percent = 100.0 * (cpu_seconds - cursor.cpu_seconds) / (record.time - cursor.last_time)
+        io_bytes = max(io_total - cursor.io_total, 0)
+    cursor.sampled = True
+    cursor.last_time = record.time
+    cursor.cpu_seconds = cpu_seconds
+    cursor.io_total = io_total
+    return Point(record.time, cpu_percent, record.rss, io_bytes, record.num_threads)
+
+
+def aggregate(points):
+    """ Sum up a bunch of points.
+    :param list points: the points
+    :return dict: how many there were, min/max/mean of the gauges, and the total io
+    """
+    summary = {"count": len(points)}
+    if not points:
+        return summary
+    for field in ("cpu_percent", "rss", "num_threads"):
+        values = [getattr(point, field) for point in points]
+        summary[field] = {"min": min(values), "max": max(values),
+                          "mean": float(sum(values)) / len(values)}
+    summary["io_bytes"] = sum(point.io_bytes for point in points)
+    summary["start"] = points[0].time
+    summary["end"] = points[-1].time
+    return summary
+
+
+class TimeSeriesStore(object):
+    """ A ring buffer of points per client, in shared memory.
+
+    Only one request for a client is ever being handled at a time (each client waits for its
+    response), so adding to a ring doesn't need a lock. A point is written before the head moves past
+    it, so readers never see one half written.
+    """
+
+    def __init__(self, capacity=10000, depth=64):
+        """
+        :param int capacity: the most clients, which should match the ClientTable
+        :param int depth: how many recent points to keep in memory for each client
+        """
+        self.capacity = capacity
+        self.depth = depth
+        self.points = RawArray(PointSlot, capacity * depth)
+        self.cursors = RawArray(Cursor, capacity)
+
+    def add(self, index, record):
+        """ Store a process info record as the newest point for a client.
+        :param int index: the client's index in the ClientTable
+        :param record: a procinfo.ProcRecord or procinfo.WindowRecord
+        :return Point: the point that got stored
+        """
+        cursor = self.cursors[index]
+        point = to_point(record, cursor)
+        slot = self.points[index * self.depth + cursor.head % self.depth]
+        slot.time, slot.cpu_percent, slot.rss, slot.io_bytes, slot.num_threads = point
+        cursor.head += 1
+        return point
+
+    def _read(self, index, first, head):
+        base = index * self.depth
+        points = []
+        for i in range(first, head):
+            slot = self.points[base + i % self.depth]
+            points.append(Point(slot.time, slot.cpu_percent, slot.rss, slot.io_bytes, slot.num_threads))
+        return points
+
+    def recent(self, index, count=None):
+        """ Get a client's latest points out of memory.
+        :param int index: the client's index in the ClientTable
+        :param int count: how many; as many as we have if this is None
+        :return list: Points, oldest first
+        """
+        head = self.cursors[index].head
+        # leave one out, in case the client is in the middle of overwriting the oldest
+        available = min(head, self.depth - 1)
+        count = available if count is None else max(min(count, available), 0)
+        return self._read(index, head - count, head)
+
+    def query(self, index, path, start=None, end=None):
+        """ Get a client's points in a time range, from disk and then memory.
+        :param int index: the client's index in the ClientTable
+        :param str path: the client's .ts file
+        :param float start: the earliest time to include
+        :param float end: the latest time to include
+        :return list: Points, oldest first
+        """
+        saved = procinfo.read_range(path, LAYOUT, Point, start, end)
+        last_saved = saved[-1].time if saved else None
+        # anything in memory that's already on disk was counted above
+        for point in self.recent(index):
+            if last_saved is not None and point.time <= last_saved:
+                continue
+            if (start is None or point.time >= start) and (end is None or point.time <= end):
+                saved.append(point)
+        return saved
+
+    def compact(self, clients, sink, log):
+        """ Append every point that hasn't been saved yet to its client's .ts file.
+        :param list clients: (index in the ClientTable, path of the .ts file) for each client
+        :param datasink.DataSink sink: what to write the files with
+        :param logging.Logger log: where to log points that got overwritten before we saved them
+        :return int: how many points got saved
+        """
+        done = []
+        saved = 0
+        for index, path in clients:
+            cursor = self.cursors[index]
+            head = cursor.head
+            first = max(cursor.compacted, head - (self.depth - 1))
+            if first > cursor.compacted:
+                log.warning("{} points for {} were overwritten before they could be saved."
+                            .format(first - cursor.compacted, path))
+            if head > first:
+                sink.write(path, "".join(LAYOUT.pack(*point) for point in self._read(index, first, head)))
+                saved += head - first
+            done.append((cursor, head))
+
+        # only move the cursors on once it's all on disk, so queries never miss a point
+        sink.sync()
+        for cursor, head in done:
+            cursor.compacted = head
+        return saved
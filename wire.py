@@ -0,0 +1,154 @@
+""" Turning request bodies into messages, and checking they're messages we can use.
+
+Clients can send JSON (a single request, an array, or one request per line), or a compact binary
+format if they set the Content-Type to BINARY_TYPE. In the binary format each message is a frame:
+
+    signal (1 byte), data kind (1 byte), time (8 byte double), name length (2 bytes), data length (4 bytes)
+
+followed by the name in UTF-8 and then the data, which is UTF-8 text if the kind is TEXT and JSON if
+it is JSON. Frames are just put one after another, so a batch is a bunch of frames.
+"""
+import json
+import struct
+from collections import namedtuple
+
+from clientstate import NAME_SIZE
+
+# ujson is a good deal faster than the json module, so we use it when it's installed
+try:
+    import ujson as fastjson
+except ImportError:
+    fastjson = None
+
+BINARY_TYPE = "application/x-clientserver"
+# the server puts how long it spent handling a request in this response header, in seconds, so clients
+# can tell that apart from the time spent getting there and back
+PROCESSING_TIME = "X-Processing-Time"
+# and how long it waits without hearing from a client before marking it failed, and how often it would
+# like to hear from one, so clients can send only as many heartbeats as the server needs
+HEARTBEAT_TIMEOUT = "X-Heartbeat-Timeout"
+HEARTBEAT_INTERVAL = "X-Heartbeat-Interval"
+FRAME = struct.Struct("<BBdHI")
+TEXT, JSON = 0, 1
+
+Message = namedtuple("Message", ("name", "signal", "time", "data"))
+# I/O stats come as an object; everything else is text
+IO_STATS = 3
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def loads(body):
+    """ Parse JSON, with the fast backend if we have it.
+    :param str body: the JSON
+    :return: whatever was in it
+    """
+    if fastjson is not None:
+        return fastjson.loads(body)
+    return json.loads(body)
+
+
+def dumps(value):
+    """ Write JSON, with the fast backend if we have it.
+    :return str: the JSON
+    """
+    if fastjson is not None:
+        return fastjson.dumps(value)
+    return json.dumps(value)
+
+
+def validate(request_data):
+    """ Check a request has all four fields, and that each one is the right type.
+    :param dict request_data: the request
+    :return Message: the request's fields
+    """
+    if not isinstance(request_data, dict):
+        raise BadRequest("a request should be an object, not {}".format(type(request_data).__name__))
+    try:
+        name = request_data["name"]
+        signal = request_data["signal"]
+        sent = request_data["time"]
+        data = request_data["data"]
+    except KeyError as e:
+        raise BadRequest("missing field {}".format(e))
+
+    if not isinstance(name, basestring) or not name:
+        raise BadRequest("name should be a non-empty string")
+    if len(name.encode('utf-8')) >= NAME_SIZE:
+        raise BadRequest("name should be shorter than {} bytes".format(NAME_SIZE))
+    # bool is a kind of int, but True isn't a signal
+    if not isinstance(signal, (int, long)) or isinstance(signal, bool) or not 0 <= signal <= 255:
+        raise BadRequest("signal should be an integer from 0 to 255")
+    if not isinstance(sent, (int, long, float)) or isinstance(sent, bool):
+        raise BadRequest("time should be a number")
+    if signal == IO_STATS:
+        if not isinstance(data, dict):
+            raise BadRequest("data should be an object for signal {}".format(signal))
+    elif not isinstance(data, basestring):
+        raise BadRequest("data should be a string for signal {}".format(signal))
+    return Message(name, signal, sent, data)
+
+
+def encode(message):
+    """ Write a message as a binary frame.
+    :param Message message: the message
+    :return str: the frame
+    """
+    name = message.name.encode('utf-8')
+    if isinstance(message.data, basestring):
+        kind, data = TEXT, message.data.encode('utf-8')
+    else:
+        kind, data = JSON, dumps(message.data)
+    return FRAME.pack(message.signal, kind, message.time, len(name), len(data)) + name + data
+
+
+def decode(body):
+    """ Read every binary frame in a body.
+    :param str body: the frames
+    :return list: Messages, in the order they were sent
+    """
+    messages = []
+    offset = 0
+    while offset < len(body):
+        if len(body) - offset < FRAME.size:
+            raise BadRequest("truncated frame header at byte {}".format(offset))
+        signal, kind, sent, name_size, data_size = FRAME.unpack_from(body, offset)
+        offset += FRAME.size
+        if len(body) - offset < name_size + data_size:
+            raise BadRequest("truncated frame at byte {}".format(offset))
+        try:
+            name = body[offset:offset + name_size].decode('utf-8')
+            data = body[offset + name_size:offset + name_size + data_size]
+            data = data.decode('utf-8') if kind == TEXT else loads(data)
+        except ValueError as e:
+            raise BadRequest("bad frame at byte {}: {}".format(offset, e))
+        offset += name_size + data_size
+        messages.append(validate({"name": name, "signal": signal, "time": sent, "data": data}))
+    return messages
+
+
+def parse(body, content_type=None):
+    """ Turn a request body into a list of requests, whichever format it's in.
+    JSON requests come back as they were sent, to be validated one at a time; binary ones are already
+    Messages.
+    :param str body: the raw request body
+    :param str content_type: the request's Content-Type
+    :return list: the requests, in the order they were sent
+    """
+    if content_type and content_type.startswith(BINARY_TYPE):
+        return decode(body)
+    try:
+        batch = loads(body)
+    except ValueError:
+        # not one JSON document, so it should be one per line
+        try:
+            batch = [loads(line) for line in body.splitlines() if line.strip()]
+        except ValueError as e:
+            raise BadRequest(str(e))
+    if isinstance(batch, dict):
+        batch = [batch]
+    if not isinstance(batch, list):
+        raise BadRequest("expected a request or a list of them")
+    return batch